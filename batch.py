@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""Batch mode of GRP-3: extracts and validates the metadata of many DICOM archives
+in one process, with a pool of workers.
+
+Each worker imports the heavy dependencies and compiles the template validator once,
+then processes archives one after the other. For each archive, the metadata and the
+error file (if any) are written side by side to the output directory, mirroring the
+layout of the input directory:
+
+    <output_dir>/<relative dir>/<archive name>.metadata.json
+    <output_dir>/<relative dir>/<archive name>.error.log.json
+    <output_dir>/<relative dir>/<archive name>.metrics.json
+
+A summary of the batch is written to <output_dir>/batch_summary.json. Unlike the gear,
+the batch mode neither splits archives nor looks up or updates files on Flywheel.
+
+Usage:
+    python batch.py INPUT --output-dir OUTPUT_DIR [--template TEMPLATE] [--workers N]
+
+INPUT is a directory, searched recursively for files matching --pattern, or a manifest
+listing one archive path per line (or a JSON list of paths).
+"""
+import argparse
+import fnmatch
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+import pytz
+import tzlocal
+
+from run import (
+    DEFAULT_MAX_SIZE_MB,
+    get_header_cache,
+    get_sequence_policy,
+    process_dicom,
+)
+from utils import metrics
+from utils.deadline import Deadline
+from utils.dicom.archive_reader import get_archive_name_patterns
+from utils.errors import GRP3Error
+from utils.metrics import MetricsRecorder
+from utils.validation import get_enabled_rules, get_template_validator
+
+log = logging.getLogger("grp-3.batch")
+
+BATCH_SUMMARY_NAME = "batch_summary.json"
+METADATA_SUFFIX = ".metadata.json"
+ERROR_LOG_SUFFIX = ".error.log.json"
+METRICS_SUFFIX = ".metrics.json"
+
+# Set in each worker by init_worker
+_worker_state = {}
+
+
+def list_archives(input_path, pattern=None):
+    """Returns the sorted archive paths of input_path and the directory they are
+    relative to in the output directory
+
+    Args:
+        input_path (str): A directory or a manifest file.
+        pattern (str): Pattern of the archive file names in a directory, defaults to
+            the patterns of every archive format the pipeline reads (zip and tar), see
+            utils.dicom.archive_reader.register_archive_reader.
+
+    Returns:
+        tuple: (list of archive paths, root directory)
+    """
+    if os.path.isdir(input_path):
+        patterns = [pattern] if pattern else get_archive_name_patterns()
+        archive_paths = []
+        for dir_path, _, file_names in os.walk(input_path):
+            for file_name in file_names:
+                if any(fnmatch.fnmatch(file_name, pattern) for pattern in patterns):
+                    archive_paths.append(os.path.join(dir_path, file_name))
+        return sorted(archive_paths), input_path
+
+    with open(input_path) as manifest:
+        content = manifest.read()
+    if content.lstrip().startswith("["):
+        archive_paths = json.loads(content)
+    else:
+        archive_paths = [line.strip() for line in content.splitlines() if line.strip()]
+    # Relative paths of the manifest are relative to its directory
+    manifest_dir = os.path.dirname(os.path.abspath(input_path))
+    archive_paths = [os.path.join(manifest_dir, path) for path in archive_paths]
+    if not archive_paths:
+        return [], manifest_dir
+    root_dir = os.path.commonpath([os.path.dirname(path) for path in archive_paths])
+    return archive_paths, root_dir
+
+
+def get_output_paths(archive_path, root_dir, output_dir):
+    """Returns the (metadata path, error file path, metrics path) of archive_path"""
+    relative_dir = os.path.relpath(os.path.dirname(archive_path), root_dir)
+    archive_output_dir = os.path.normpath(os.path.join(output_dir, relative_dir))
+    archive_name = os.path.basename(archive_path)
+    return (
+        os.path.join(archive_output_dir, archive_name + METADATA_SUFFIX),
+        os.path.join(archive_output_dir, archive_name + ERROR_LOG_SUFFIX),
+        os.path.join(archive_output_dir, archive_name + METRICS_SUFFIX),
+    )
+
+
+def init_worker(template, gear_config, timezone_name, root_dir, output_dir, log_level):
+    """Initializes a worker: sets its state, imports the heavy dependencies and
+    compiles the template validator so that every archive does not pay for them
+
+    Args:
+        template (dict): JSON schema template.
+        gear_config (dict): Config options of the gear, see manifest.json.
+        timezone_name (str): Name of the timezone of the DICOM timestamps.
+        root_dir (str): Directory the archive paths are relative to.
+        output_dir (str): Output directory.
+        log_level (str): Logging level of the worker.
+    """
+    logging.basicConfig()
+    logging.getLogger().setLevel(log_level)
+    import pandas  # noqa: F401
+    import nibabel.nicom.dicomwrappers  # noqa: F401
+
+    get_template_validator(template)
+    force = gear_config.get("force_dicom_read", False)
+    sequence_policy = get_sequence_policy(gear_config)
+    _worker_state.update(
+        template=template,
+        force=force,
+        sequence_policy=sequence_policy,
+        rules=get_enabled_rules(gear_config.get("disabled_rules")),
+        time_budget=gear_config.get("time_budget_seconds"),
+        header_cache=get_header_cache(
+            gear_config.get("header_cache_dir"),
+            gear_config.get("header_cache_max_size_mb", DEFAULT_MAX_SIZE_MB),
+            force=force,
+            sequence_policy=sequence_policy,
+        ),
+        timezone=pytz.timezone(timezone_name),
+        root_dir=root_dir,
+        output_dir=output_dir,
+    )
+
+
+def process_archive(archive_path):
+    """Extracts and validates the metadata of archive_path in a worker
+
+    Returns:
+        dict: The result of the archive, with keys path, status (valid, invalid or
+            failed), metadata_path, error_path, metrics_path, duration and message.
+    """
+    start = time.perf_counter()
+    # Each archive has the time budget of a gear job
+    deadline = Deadline(_worker_state["time_budget"])
+    metadata_path, error_path, metrics_path = get_output_paths(
+        archive_path, _worker_state["root_dir"], _worker_state["output_dir"]
+    )
+    os.makedirs(os.path.dirname(metadata_path), exist_ok=True)
+    # Error file of a previous batch
+    if os.path.exists(error_path):
+        os.remove(error_path)
+
+    result = {
+        "path": archive_path,
+        "status": "failed",
+        "metadata_path": None,
+        "error_path": None,
+        "message": None,
+    }
+    metrics_recorder = MetricsRecorder()
+    try:
+        with metrics.recording(metrics_recorder):
+            pipeline_result = process_dicom(
+                archive_path,
+                os.path.dirname(error_path),
+                _worker_state["timezone"],
+                _worker_state["template"],
+                force=_worker_state["force"],
+                header_cache=_worker_state["header_cache"],
+                sequence_policy=_worker_state["sequence_policy"],
+                metadata_path=metadata_path,
+                rules=_worker_state["rules"],
+                deadline=deadline,
+            )
+        result["metadata_path"] = pipeline_result.metadata_path
+        result["error_path"] = pipeline_result.error_path
+        result["status"] = "invalid" if pipeline_result.validation_errors else "valid"
+    except GRP3Error as exc:
+        result["message"] = str(exc)
+        if exc.validation_errors:
+            result["error_path"] = error_path
+    except Exception as exc:
+        log.exception("Processing %s failed", archive_path)
+        result["message"] = repr(exc)
+    result["duration"] = time.perf_counter() - start
+    result["metrics_path"] = metrics_recorder.write(metrics_path)
+    return result
+
+
+def run_batch(
+    archive_paths,
+    root_dir,
+    output_dir,
+    template=None,
+    gear_config=None,
+    timezone_name=None,
+    workers=None,
+    log_level="WARNING",
+):
+    """Processes archive_paths with a pool of workers and writes the batch summary
+
+    Args:
+        archive_paths (list): Paths of the archives.
+        root_dir (str): Directory the archive paths are relative to.
+        output_dir (str): Output directory.
+        template (dict): JSON schema template, None to skip template validation.
+        gear_config (dict): Config options of the gear, see manifest.json.
+        timezone_name (str): Name of the timezone of the DICOM timestamps, defaults to
+            the local timezone.
+        workers (int): Number of worker processes, defaults to the number of CPUs. With
+            1, archives are processed in the current process.
+        log_level (str): Logging level of the workers.
+
+    Returns:
+        dict: The batch summary.
+    """
+    template = template or {}
+    # Fail once, early, on an invalid template or config rather than in every worker
+    get_template_validator(template)
+    get_enabled_rules((gear_config or {}).get("disabled_rules"))
+    timezone_name = timezone_name or str(tzlocal.get_localzone())
+    workers = workers or os.cpu_count() or 1
+    initargs = (template, gear_config or {}, timezone_name, root_dir, output_dir, log_level)
+
+    start = time.perf_counter()
+    os.makedirs(output_dir, exist_ok=True)
+    if workers == 1:
+        init_worker(*initargs)
+        results = [process_archive(path) for path in archive_paths]
+    else:
+        with multiprocessing.Pool(workers, init_worker, initargs) as pool:
+            results = list(pool.imap_unordered(process_archive, archive_paths))
+    results.sort(key=lambda result: result["path"])
+
+    counts = {status: 0 for status in ("valid", "invalid", "failed")}
+    for result in results:
+        counts[result["status"]] += 1
+    summary = {
+        "archive_count": len(results),
+        "counts": counts,
+        "duration": time.perf_counter() - start,
+        "workers": workers,
+        "archives": results,
+    }
+    with open(os.path.join(output_dir, BATCH_SUMMARY_NAME), "w") as fp:
+        json.dump(summary, fp, indent=4)
+    log.info(
+        "Processed %s archives in %.1f s: %s",
+        summary["archive_count"],
+        summary["duration"],
+        counts,
+    )
+    return summary
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("input", help="Directory of archives or manifest of archive paths")
+    parser.add_argument("--output-dir", required=True, help="Output directory")
+    parser.add_argument("--template", help="Path of the JSON schema template")
+    parser.add_argument(
+        "--config",
+        help="Path of a JSON file of gear config options (e.g. force_dicom_read, "
+        "sequence_max_items, header_cache_dir), see manifest.json",
+    )
+    parser.add_argument(
+        "--pattern",
+        help="Pattern of the archive names, defaults to every archive format (zip, tar, "
+        "tar.gz, ...)",
+    )
+    parser.add_argument("--workers", type=int, help="Number of worker processes")
+    parser.add_argument("--timezone", help="Timezone of the DICOM timestamps")
+    parser.add_argument("--log-level", default="WARNING", help="Logging level of the workers")
+    args = parser.parse_args(args)
+
+    logging.basicConfig()
+    log.setLevel(logging.INFO)
+    template = {}
+    if args.template:
+        with open(args.template) as fp:
+            template = json.load(fp)
+    gear_config = {}
+    if args.config:
+        with open(args.config) as fp:
+            gear_config = json.load(fp)
+    archive_paths, root_dir = list_archives(args.input, args.pattern)
+    summary = run_batch(
+        archive_paths,
+        root_dir,
+        args.output_dir,
+        template=template,
+        gear_config=gear_config,
+        timezone_name=args.timezone,
+        workers=args.workers,
+        log_level=args.log_level,
+    )
+    return 1 if summary["counts"]["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
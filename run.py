@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
+import collections
+import functools
+import itertools
 import os
 import re
-import sys
 import json
 import pytz
 import pydicom
@@ -12,15 +14,40 @@ import tzlocal
 import logging
 import zipfile
 import datetime
-import nibabel
 import tempfile
-from pathlib import Path
+import time
 
 
 from utils.dicom import dicom_archive
-from utils.update_file_info import get_file_dict_and_update_metadata_json
+from utils.dicom.archive_reader import (
+    ArchiveMember,
+    extract_archive_members,
+    get_archive_format,
+    get_member_path,
+)
+from utils.dicom.header_index import read_header_index
+from utils.dicom.pixel_data import check_pixel_data, read_pixel_data_error
+from utils.errors import (
+    CorruptedZipError,
+    EmptyFileError,
+    GRP3Error,
+    NoDicomFileError,
+)
+from utils.hashing import get_checksums, get_file_digest, get_member_checksums
+from utils.header_cache import DEFAULT_MAX_SIZE_MB, HeaderCache
+from utils import metrics
+from utils.deadline import Deadline
+from utils.metrics import MetricsRecorder
+from utils.profiling import profiling
+from utils.skip_unchanged import RUN_INFO_KEY, get_run_key, is_unchanged
+from utils.metadata_writer import write_metadata_json
+from utils.update_file_info import (
+    get_file_dict_and_update_metadata_json,
+    prefetch_dest_cont_file_dict,
+)
 from utils.validation import (
-    validate_against_rules,
+    RuleValidator,
+    get_enabled_rules,
     validate_against_template,
     dump_validation_error_file,
     check_file_is_not_empty,
@@ -30,6 +57,27 @@ logging.basicConfig()
 log = logging.getLogger("grp-3")
 
 DEFAULT_TME = "120000.00"
+# Per-frame sequences of enhanced multi-frame objects, that can be summarized
+PER_FRAME_SEQUENCES = ("PerFrameFunctionalGroupsSequence",)
+
+# Bounds applied when converting sequences to the header dictionary, 0 means unbounded:
+# - max_items: items kept per sequence
+# - max_depth: nesting depth of the sequences kept, 1 keeps top-level sequences only
+# - max_value_bytes: values longer than this (as strings) are dropped from sequence items
+# - per_frame_summary_min_items: size from which PER_FRAME_SEQUENCES are summarized
+SequencePolicy = collections.namedtuple(
+    "SequencePolicy",
+    ["max_items", "max_depth", "max_value_bytes", "per_frame_summary_min_items"],
+)
+UNBOUNDED_SEQUENCE_POLICY = SequencePolicy(0, 0, 0, 0)
+# Bounds of the representative header once the time budget is spent: top-level
+# sequences only, truncated. Per-frame sequences are only summarized if configured to,
+# so that the type of their field in the header does not depend on the time budget.
+DEADLINE_SEQUENCE_POLICY = SequencePolicy(10, 1, 1024, 0)
+# Bump whenever a change to get_pydicom_header alters the extracted records
+HEADER_EXTRACTION_VERSION = "2"
+# First of the (Float|DoubleFloat)PixelData tags pydicom stops before
+PIXEL_DATA_FIRST_TAG = 0x7FE00008
 
 
 def fix_VM1_callback(dataset, data_element):
@@ -335,16 +383,24 @@ def format_string(in_string):
     return formatted  # .encode('utf-8').strip()
 
 
-def get_seq_data(sequence, ignore_keys):
+def get_seq_data(sequence, ignore_keys, sequence_policy=None, depth=1):
     """Return list of nested dictionaries matching sequence
 
     Args:
         sequence (pydicom.Sequence): A pydicom sequence
         ignore_keys (list): List of keys to ignore
+        sequence_policy (SequencePolicy): Bounds on the sequence data, unbounded if None
+        depth (int): Nesting depth of sequence, 1 for a top-level sequence
 
     Returns:
         (list): list of nested dictionary matching sequence
     """
+    policy = sequence_policy or UNBOUNDED_SEQUENCE_POLICY
+    if policy.max_items and len(sequence) > policy.max_items:
+        log.debug(
+            "Keeping %s of %s sequence items", policy.max_items, len(sequence)
+        )
+        sequence = itertools.islice(sequence, policy.max_items)
     res = []
     for seq in sequence:
         seq_dict = {}
@@ -357,15 +413,81 @@ def get_seq_data(sequence, ignore_keys):
                 continue
             kw = v.keyword
             if isinstance(v.value, pydicom.sequence.Sequence):
-                seq_dict[kw] = get_seq_data(v, ignore_keys)
+                if policy.max_depth and depth >= policy.max_depth:
+                    continue
+                seq_dict[kw] = get_seq_data(
+                    v.value, ignore_keys, sequence_policy, depth + 1
+                )
+                continue
             elif isinstance(v.value, str):
-                seq_dict[kw] = format_string(v.value)
+                value = format_string(v.value)
             else:
-                seq_dict[kw] = assign_type(v.value)
+                value = assign_type(v.value)
+            if policy.max_value_bytes and len(str(value)) > policy.max_value_bytes:
+                log.debug("Skipping %s, value larger than %s bytes", kw, policy.max_value_bytes)
+                continue
+            seq_dict[kw] = value
         res.append(seq_dict)
     return res
 
 
+def _freeze(value):
+    """Return a hashable equivalent of a header value"""
+    if isinstance(value, dict):
+        return tuple((k, _freeze(v)) for k, v in sorted(value.items()))
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def summarize_functional_groups(sequence, ignore_keys, sequence_policy=None):
+    """Return a summary of a per-frame functional groups sequence
+
+    Each functional group (e.g. PixelMeasuresSequence) is collapsed to its distinct
+    values, in order of first appearance, with the number of frames sharing each value.
+
+    Args:
+        sequence (pydicom.Sequence): A per-frame functional groups sequence
+        ignore_keys (list): List of keys to ignore
+        sequence_policy (SequencePolicy): Bounds on the sequence data
+
+    Returns:
+        dict: The summary with keys ItemCount and FunctionalGroups
+    """
+    groups = {}
+    for item in sequence:
+        # Items are converted one at a time so that only distinct values are held
+        item_dict = get_seq_data([item], ignore_keys, sequence_policy)[0]
+        fix_type_based_on_dicom_vm(item_dict)
+        for group_kw, group_value in item_dict.items():
+            distinct_values = groups.setdefault(group_kw, {})
+            frozen = _freeze(group_value)
+            if frozen in distinct_values:
+                distinct_values[frozen]["Count"] += 1
+            else:
+                distinct_values[frozen] = {"Count": 1, "Value": group_value}
+    return {
+        "ItemCount": len(sequence),
+        "FunctionalGroups": {
+            group_kw: list(distinct_values.values())
+            for group_kw, distinct_values in groups.items()
+        },
+    }
+
+
+def get_sequence_header_value(keyword, sequence, ignore_keys, sequence_policy=None):
+    """Return the header value of a top-level sequence, summarized if sequence_policy
+    says so (see summarize_functional_groups)"""
+    policy = sequence_policy or UNBOUNDED_SEQUENCE_POLICY
+    if (
+        keyword in PER_FRAME_SEQUENCES
+        and policy.per_frame_summary_min_items
+        and len(sequence) >= policy.per_frame_summary_min_items
+    ):
+        return summarize_functional_groups(sequence, ignore_keys, sequence_policy)
+    return get_seq_data(sequence, ignore_keys, sequence_policy)
+
+
 def walk_dicom(dcm, callbacks=None, recursive=True):
     """Same as pydicom.DataSet.walk but with logging the exception instead of raising.
 
@@ -408,6 +530,9 @@ def fix_type_based_on_dicom_vm(header):
         if vr != "SQ":
             if vm != "1" and not isinstance(val, list):  # anything else is a list
                 header[key] = [val]
+        elif key in PER_FRAME_SEQUENCES and isinstance(val, dict):
+            # Summary of the sequence, type fixed by summarize_functional_groups
+            continue
         elif not isinstance(val, list):
             # To deal with DataElement that pydicom did not read as sequence
             # (e.g. stored as OB and pydicom parsing them as binary string)
@@ -421,7 +546,8 @@ def fix_type_based_on_dicom_vm(header):
         )
 
 
-def get_pydicom_header(dcm):
+@metrics.timed("get_pydicom_header")
+def get_pydicom_header(dcm, sequence_policy=None):
     # Extract the header values
     # Load all dcm tags in memory and fix an issue found a LO VR with `\` in it (fix_VM1)
     errors = walk_dicom(dcm, callbacks=[fix_VM1_callback], recursive=True)
@@ -465,7 +591,9 @@ def get_pydicom_header(dcm):
             if (tag not in exclude_tags) and type(
                 dcm.get(tag)
             ) == pydicom.sequence.Sequence:
-                seq_data = get_seq_data(dcm.get(tag), exclude_tags)
+                seq_data = get_sequence_header_value(
+                    tag, dcm.get(tag), exclude_tags, sequence_policy
+                )
                 # Check that the sequence is not empty
                 if seq_data:
                     header[tag] = seq_data
@@ -478,7 +606,11 @@ def get_pydicom_header(dcm):
     return header
 
 
+@metrics.timed("get_csa_header")
 def get_csa_header(dcm):
+    # nibabel is slow to import and only needed for Siemens data
+    import nibabel.nicom.dicomwrappers
+
     exclude_tags = ["PhoenixZIP", "SrMsgBuffer"]
     header = {}
     try:
@@ -518,7 +650,82 @@ def dicom_date_handler(dcm):
     return dcm
 
 
-def get_dcm_data_dict(dcm_path, force=False):
+def get_sequence_policy(gear_config):
+    """Returns the SequencePolicy set by the gear config, see manifest.json"""
+    return SequencePolicy(
+        max_items=gear_config.get("sequence_max_items", 0),
+        max_depth=gear_config.get("sequence_max_depth", 0),
+        max_value_bytes=gear_config.get("sequence_max_value_bytes", 0),
+        # Summaries change PerFrameFunctionalGroupsSequence from an array to an
+        # object, off by default so that templates and searches expecting an array
+        # keep working
+        per_frame_summary_min_items=gear_config.get("per_frame_summary_min_items", 0),
+    )
+
+
+def bound_sequence_policy(sequence_policy, bounds):
+    """Returns the SequencePolicy the strictest of sequence_policy and bounds on each
+    of its fields, 0 being unbounded"""
+    policy = sequence_policy or UNBOUNDED_SEQUENCE_POLICY
+    return SequencePolicy(
+        *(
+            min(value, bound) if value and bound else value or bound
+            for value, bound in zip(policy, bounds)
+        )
+    )
+
+
+def get_header_namespace(force=False, sequence_policy=None):
+    """Returns a string identifying the header extraction version and options
+
+    Header records extracted under a different namespace (e.g. cached or indexed by
+    another gear version) must not be reused.
+    """
+    policy = tuple(sequence_policy or UNBOUNDED_SEQUENCE_POLICY)
+    return (
+        f"{HEADER_EXTRACTION_VERSION}:pydicom={pydicom.__version__}:force={force}"
+        f":sequence_policy={policy}"
+    )
+
+
+def get_pydicom_header_before_pixels(dcm, sequence_policy=None):
+    """Same as get_pydicom_header but restricted to the data elements preceding the
+    pixel data, i.e. the header get_dcm_data_dict extracts with stop_before_pixels=True.
+
+    Args:
+        dcm (pydicom.DataSet): A pydicom DataSet read with its pixel data.
+        sequence_policy (SequencePolicy): Bounds on the sequence data.
+
+    Returns:
+        dict: The header dictionary.
+    """
+    return get_pydicom_header(dcm[:PIXEL_DATA_FIRST_TAG], sequence_policy)
+
+
+def get_header_cache(cache_dir, max_size_mb, force=False, sequence_policy=None):
+    """Returns a HeaderCache namespaced on the header extraction version and options
+
+    Args:
+        cache_dir (str): Directory of the cache, None or empty to disable caching.
+        max_size_mb (int): Size budget of the cache in MB.
+        force (bool): Value of the force_dicom_read config option.
+        sequence_policy (SequencePolicy): Bounds on the sequence data.
+
+    Returns:
+        HeaderCache: The cache or None if disabled.
+    """
+    if not cache_dir:
+        return None
+    return HeaderCache(
+        cache_dir,
+        max_bytes=max_size_mb * 1024 ** 2,
+        namespace=get_header_namespace(force, sequence_policy),
+    )
+
+
+def get_dcm_data_dict(
+    dcm_path, force=False, header_cache=None, cache_key=None, sequence_policy=None
+):
     file_size = os.path.getsize(dcm_path)
     res = {
         "path": dcm_path,
@@ -526,67 +733,245 @@ def get_dcm_data_dict(dcm_path, force=False):
         "force": force,
         "pydicom_exception": False,
         "header": {},
+        "pixel_data_error": None,
     }
     if file_size > 0:
+        if header_cache:
+            if not cache_key:
+                cache_key = header_cache.file_key(dcm_path)
+            cached = header_cache.get(cache_key)
+            if cached is not None:
+                res["pydicom_exception"] = cached["pydicom_exception"]
+                res["header"] = cached["header"]
+                res["pixel_data_error"] = cached["pixel_data_error"]
+                return res
         try:
-            dcm = pydicom.dcmread(dcm_path, force=force, stop_before_pixels=True)
-            res["header"] = get_pydicom_header(dcm)
+            with open(dcm_path, "rb") as fp, metrics.stage(
+                "read_dicom", bytes_read=0
+            ) as counters:
+                dcm = pydicom.dcmread(fp, force=force, stop_before_pixels=True)
+                # Only the header is read, up to the pixel data element
+                counters["bytes_read"] = fp.tell()
+                # The pixel data is seeked past, not read
+                try:
+                    res["pixel_data_error"] = check_pixel_data(fp, dcm, file_size)
+                except Exception:
+                    # A failed check never discards the header
+                    log.exception(
+                        "Cannot check the pixel data of %s", os.path.basename(dcm_path)
+                    )
+            res["header"] = get_pydicom_header(dcm, sequence_policy)
         except Exception:
             log.exception(
                 "Pydicom raised exception reading dicom file %s",
                 os.path.basename(dcm_path),
             )
             res["pydicom_exception"] = True
+        if header_cache:
+            header_cache.put(
+                cache_key,
+                {
+                    "pydicom_exception": res["pydicom_exception"],
+                    "header": res["header"],
+                    "pixel_data_error": res["pixel_data_error"],
+                },
+            )
     return res
 
 
-def dicom_to_json(file_path, outbase, timezone, json_template, force=False):
+class PipelineResult:
+    """Result of processing a DICOM archive or file, see run_pipeline
 
-    error_file_name = os.path.basename(file_path) + ".error.log.json"
-    error_filepath = os.path.join(outbase, error_file_name)
-    validation_errors = list()
+    Attributes:
+        file_path (str): Path of the DICOM archive or file.
+        metadata (dict): The .metadata.json dictionary, None if not extracted.
+        metadata_path (str): Path of the metadata file, None if not written.
+        validation_errors (list): The validation error dicts.
+        error_path (str): Path of the error file, None if not written.
+        split_plan (dict): If the input was split, the tag it was split on ("tag") and
+            the paths of the split archives ("outputs"), None otherwise.
+        timings (dict): Wall time in seconds of each stage.
+        metrics (dict): Metrics of the detailed stages, see utils/metrics.py.
+    """
 
-    # check that input file is not empty
-    validation_errors += check_file_is_not_empty(file_path)
-    if validation_errors:
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.metadata = None
+        self.metadata_path = None
+        self.validation_errors = []
+        self.error_path = None
+        self.split_plan = None
+        self.timings = {}
+        self.metrics = None
+
+
+def get_pixel_data_error(dcm_path, force=False):
+    """Returns the pixel data inconsistency of the file at dcm_path, for files whose
+    header is not read, see utils.dicom.pixel_data.read_pixel_data_error"""
+    try:
+        return read_pixel_data_error(dcm_path, force=force)
+    except Exception:
         log.warning(
-            "File %s is empty which warrants further processing. Logging to error.json and Exiting.",
-            file_path,
+            "Pixel data of %s could not be checked",
+            os.path.basename(dcm_path),
+            exc_info=True,
         )
-        dump_validation_error_file(error_filepath, validation_errors)
-        sys.exit(1)
+        return None
+
+
+def iter_dcm_dicts(
+    file_path,
+    extract_dir,
+    force=False,
+    header_cache=None,
+    sequence_policy=None,
+    member_digests=None,
+):
+    """Yields the data dicts (keys path, size, force, pydicom_exception, header,
+    pixel_data_error, see utils.dicom.pixel_data.check_pixel_data, crc, the CRC of the
+    zip member or None, and sha256, the digest of the file) of the files of the DICOM
+    archive (zip or tar, see utils.dicom.archive_reader) or file at file_path, sorted by
+    path
 
-    # Build list of dcm files
-    if zipfile.is_zipfile(file_path):
+    Args:
+        file_path (str): Path of the DICOM archive or file.
+        extract_dir (str): Directory the archive is extracted to.
+        force (bool): Force reading of files missing the DICOM preamble.
+        header_cache (HeaderCache): Cache of the member headers, None to disable.
+        sequence_policy (SequencePolicy): Bounds on the sequence data.
+        member_digests (dict): If set, filled with the sha256 digests of the members
+            by name, computed as the archive is extracted, before the first data dict
+            is yielded.
+
+    Raises:
+        CorruptedZipError: If the archive cannot be extracted.
+    """
+    if member_digests is None:
+        member_digests = dict()
+    # Extract the members, keeping an ArchiveMember of each
+    archive_format = get_archive_format(file_path)
+    if archive_format is not None:
         try:
             log.info("Extracting %s " % os.path.basename(file_path))
-            zip = zipfile.ZipFile(file_path)
-            tmp_dir = tempfile.TemporaryDirectory().name
-            zip.extractall(path=tmp_dir)
-            dcm_path_list = sorted(Path(tmp_dir).rglob("*"))
-            # keep only files
-            dcm_path_list = [
-                str(path) for path in dcm_path_list if os.path.isfile(path)
-            ]
-        except Exception:
+            with metrics.stage(
+                "extract", bytes_read=os.path.getsize(file_path)
+            ) as counters:
+                members = extract_archive_members(file_path, extract_dir)
+                counters["members"] = len(members)
+                counters["bytes_decompressed"] = sum(member.size for member in members)
+                # Headers indexed by the splitter that produced this archive
+                indexed_headers = {}
+                if archive_format == "zip":
+                    with zipfile.ZipFile(file_path) as zip:
+                        indexed_headers = read_header_index(
+                            zip, get_header_namespace(force, sequence_policy)
+                        )
+            get_path = functools.partial(get_member_path, extract_dir)
+        except Exception as exc:
             log.warning(
-                "Zip file %s is corrupted. Logging to error.json and Exiting.",
-                file_path,
+                "%s file %s is corrupted.", archive_format.capitalize(), file_path
             )
-            error_dict = {"error_message": "Zip corrupted", "revalidate": False}
-            dump_validation_error_file(error_filepath, [error_dict])
-            sys.exit(1)
+            error_dict = {
+                "error_message": f"{archive_format.capitalize()} corrupted",
+                "revalidate": False,
+            }
+            raise CorruptedZipError(
+                f"{archive_format.capitalize()} file {file_path} is corrupted",
+                [error_dict],
+            ) from exc
     else:
         log.info(
-            "Not a zip. Attempting to read %s directly" % os.path.basename(file_path)
+            "Not an archive. Attempting to read %s directly",
+            os.path.basename(file_path),
+        )
+        members = [
+            ArchiveMember(
+                os.path.basename(file_path),
+                os.path.getsize(file_path),
+                None,
+                get_file_digest(file_path),
+            )
+        ]
+        indexed_headers = {}
+        get_path = lambda name: file_path
+    for member in members:
+        member_digests[member.name] = member.digest
+
+    # Get Dicom data dicts (with keys path, size, header)
+    # Closing the generator early, e.g. once the deadline is spent, still prunes the
+    # header cache
+    try:
+        for member in members:
+            dcm_path = get_path(member.name)
+            if member.name in indexed_headers:
+                yield {
+                    "path": dcm_path,
+                    "size": member.size,
+                    "force": force,
+                    "pydicom_exception": False,
+                    "header": indexed_headers.pop(member.name),
+                    "pixel_data_error": get_pixel_data_error(dcm_path, force),
+                    "crc": member.crc,
+                    "sha256": member.digest,
+                }
+                continue
+            cache_key = None
+            if header_cache and member.digest:
+                # The digest computed on extraction, the member is not hashed twice
+                cache_key = header_cache.digest_key(member.digest)
+            dcm_dict = get_dcm_data_dict(
+                dcm_path,
+                force=force,
+                header_cache=header_cache,
+                cache_key=cache_key,
+                sequence_policy=sequence_policy,
+            )
+            dcm_dict["crc"] = member.crc
+            dcm_dict["sha256"] = member.digest
+            yield dcm_dict
+    finally:
+        if header_cache:
+            log.info(
+                "Header cache: %s hits, %s misses",
+                header_cache.hits,
+                header_cache.misses,
+            )
+            header_cache.prune()
+
+
+def get_dcm_dict_list(
+    file_path, extract_dir, force=False, header_cache=None, sequence_policy=None
+):
+    """Returns the data dicts of the files of the DICOM archive or file at file_path,
+    see iter_dcm_dicts"""
+    return list(
+        iter_dcm_dicts(
+            file_path,
+            extract_dir,
+            force=force,
+            header_cache=header_cache,
+            sequence_policy=sequence_policy,
         )
-        dcm_path_list = [file_path]
+    )
+
 
-    # Get list of Dicom data dict (with keys path, size, header)
-    dcm_dict_list = []
-    for dcm_path in dcm_path_list:
-        dcm_dict_list.append(get_dcm_data_dict(dcm_path, force=force))
+def drop_header(dcm_dict):
+    """Returns a copy of dcm_dict without its header but for what
+    select_representative_dcm needs of it, so that the headers of every file are not
+    held at once"""
+    dcm_dict = dict(dcm_dict)
+    if dcm_dict["header"]:
+        dcm_dict["header"] = {"SOPClassUID": dcm_dict["header"].get("SOPClassUID")}
+    return dcm_dict
 
+
+def select_representative_dcm(dcm_dict_list, force=False):
+    """Returns the dataset the metadata is extracted from: the first non-empty file
+    parsed without exception and not Raw Data Storage, unless that is the only file
+
+    Raises:
+        NoDicomFileError: If no file can be used.
+    """
     # Load a representative dcm file
     # Currently: not 0-byte file and SOPClassUID not Raw Data Storage unless that the only file
     dcm = None
@@ -612,7 +997,10 @@ def dicom_to_json(file_path, outbase, timezone, json_template, force=False):
             else:
                 # Note: no need to try/except, all files have already been open when calling get_dcm_data_dict
                 dcm_path = dcm_dict_el["path"]
-                dcm = pydicom.dcmread(dcm_path, force=force)
+                with metrics.stage(
+                    "read_representative_dicom", bytes_read=dcm_dict_el["size"]
+                ):
+                    dcm = pydicom.dcmread(dcm_path, force=force)
                 break
         elif dcm_dict_el["size"] < 1:
             log.warning("%s is empty. Skipping.", os.path.basename(dcm_dict_el["path"]))
@@ -627,11 +1015,19 @@ def dicom_to_json(file_path, outbase, timezone, json_template, force=False):
             "error_message": "No Dicom file found to be parsed",
             "revalidate": False,
         }
-        dump_validation_error_file(error_filepath, [error_dict])
-        sys.exit(1)
-    else:
-        log.info("%s will be used for metadata extraction", os.path.basename(dcm_path))
+        raise NoDicomFileError("No Dicom file found to be parsed", [error_dict])
+    log.info("%s will be used for metadata extraction", os.path.basename(dcm_path))
+    return dcm
 
+
+def get_metadata(dcm, file_path, timezone, sequence_policy=None, deadline=None):
+    """Returns the .metadata.json dictionary of the DICOM archive or file at file_path,
+    built from dcm, its representative dataset
+
+    Once the deadline is spent, the sequences are bounded by DEADLINE_SEQUENCE_POLICY
+    and the CSA header is skipped.
+    """
+    deadline = deadline or Deadline()
     # Build metadata
     metadata = {}
 
@@ -723,80 +1119,430 @@ def dicom_to_json(file_path, outbase, timezone, json_template, force=False):
         metadata["acquisition"]["timestamp"] = acquisition_timestamp
 
     # File metadata from pydicom header
-    pydicom_file["info"]["header"]["dicom"] = get_pydicom_header(dcm)
+    if not deadline.allows("full_sequences"):
+        sequence_policy = bound_sequence_policy(
+            sequence_policy, DEADLINE_SEQUENCE_POLICY
+        )
+    pydicom_file["info"]["header"]["dicom"] = get_pydicom_header(dcm, sequence_policy)
 
     # Add CSAHeader to DICOM
-    if dcm.get("Manufacturer") == "SIEMENS":
+    if dcm.get("Manufacturer") == "SIEMENS" and deadline.allows("csa_header"):
         csa_header = get_csa_header(dcm)
         if csa_header:
             pydicom_file["info"]["header"]["dicom"]["CSAHeader"] = csa_header
 
-    # Validate header data against json schema template
-    validation_errors += validate_against_template(
-        pydicom_file["info"]["header"]["dicom"], json_template
-    )
+    metadata["acquisition"]["files"] = [pydicom_file]
+    return metadata
+
+
+def extract_metadata(
+    file_path,
+    timezone,
+    json_template,
+    force=False,
+    header_cache=None,
+    sequence_policy=None,
+    rules=None,
+    deadline=None,
+    member_digests=None,
+):
+    """Extracts the metadata of the DICOM archive or file at file_path and validates it
+    against json_template and the file rules
+
+    Once the deadline is spent, the files left are not read (as soon as one can be the
+    representative file), the file rules, the full sequences and the CSA header are
+    skipped, and an error lists what was skipped.
 
-    # Validate DICOM header df against file rules
-    rule_errors = validate_against_rules(dcm_dict_list)
+    Args:
+        rules (list): Names of the file rules, see utils.validation.get_enabled_rules.
+            Defaults to every rule.
+        deadline (Deadline): Time budget of the job, unlimited by default.
+        member_digests (dict): If set, filled with the sha256 digests of the members
+            by name, see iter_dcm_dicts.
 
-    # Add error lists together
-    validation_errors = validation_errors + rule_errors
+    Returns:
+        tuple: The .metadata.json dictionary and the list of validation errors.
 
-    # Write error file
+    Raises:
+        GRP3Error: If no metadata can be extracted.
+    """
+    # check that input file is not empty
+    validation_errors = check_file_is_not_empty(file_path)
     if validation_errors:
-        dump_validation_error_file(error_filepath, validation_errors)
+        log.warning(
+            "File %s is empty which warrants further processing.", file_path
+        )
+        raise EmptyFileError(f"File {file_path} is empty", validation_errors)
+
+    with tempfile.TemporaryDirectory() as extract_dir:
+        # Each data dict is fed to the file rules, then only its summary is kept
+        deadline = deadline or Deadline()
+        rule_validator = RuleValidator(rules, deadline=deadline)
+        if member_digests is None:
+            member_digests = dict()
+        dcm_dict_list = []
+        has_representative = False
+        dcm_dicts = iter_dcm_dicts(
+            file_path,
+            extract_dir,
+            force=force,
+            header_cache=header_cache,
+            sequence_policy=sequence_policy,
+            member_digests=member_digests,
+        )
+        for dcm_dict in dcm_dicts:
+            if has_representative and not deadline.allows("file_headers"):
+                # Closed right away so that the header cache is pruned
+                dcm_dicts.close()
+                break
+            rule_validator.add(dcm_dict)
+            dcm_dict = drop_header(dcm_dict)
+            dcm_dict_list.append(dcm_dict)
+            has_representative = has_representative or (
+                dcm_dict["size"] > 0
+                and dcm_dict["header"]
+                and not dcm_dict["pydicom_exception"]
+                and dcm_dict["header"].get("SOPClassUID") != "Raw Data Storage"
+            )
+        dcm = select_representative_dcm(dcm_dict_list, force=force)
+        metadata = get_metadata(dcm, file_path, timezone, sequence_policy, deadline)
+        # Provenance checksums, computed on extraction
+        metadata["acquisition"]["files"][0]["info"]["checksums"] = get_checksums(
+            member_digests
+        )
+
+        # Validate header data against json schema template
+        header = metadata["acquisition"]["files"][0]["info"]["header"]["dicom"]
+        validation_errors += validate_against_template(header, json_template)
+
+        # Validate DICOM header df against file rules
+        validation_errors += rule_validator.finalize()
+
+    deadline_error = deadline.get_error_dict()
+    if deadline_error:
+        validation_errors.append(deadline_error)
+
     if validation_errors:
         metadata["acquisition"]["tags"] = ["error"]
+    return metadata, validation_errors
+
+
+def process_dicom(
+    file_path,
+    outbase,
+    timezone,
+    json_template,
+    force=False,
+    header_cache=None,
+    sequence_policy=None,
+    metadata_path=None,
+    rules=None,
+    deadline=None,
+    run_key=None,
+    checksums_path=None,
+):
+    """Extracts and validates the metadata of the DICOM archive or file at file_path,
+    then writes the error file (if any), the checksums file (if set) and the metadata
+    file
 
-    # Append the pydicom_file to the files array
-    metadata["acquisition"]["files"] = [pydicom_file]
+    Args:
+        file_path (str): Path of the DICOM archive or file.
+        outbase (str): Output directory, the error file is written to it.
+        timezone (pytz.timezone): Timezone of the DICOM timestamps.
+        json_template (dict): JSON schema the header is validated against.
+        force (bool): Force reading of files missing the DICOM preamble.
+        header_cache (HeaderCache): Cache of the member headers, None to disable.
+        sequence_policy (SequencePolicy): Bounds on the sequence data.
+        metadata_path (str): Path of the metadata file to write, defaults to
+            .metadata.json in the directory of outbase.
+        rules (list): Names of the file rules, see utils.validation.get_enabled_rules.
+            Defaults to every rule.
+        deadline (Deadline): Time budget of the job, see extract_metadata. Unlimited
+            by default.
+        run_key (dict): If set and no step was skipped, stored with the archive
+            fingerprint in the file info, see utils.skip_unchanged.
+        checksums_path (str): If set, path of the JSON file the digest of each member
+            is written to, see utils.hashing.get_member_checksums. Only the
+            fingerprint and member count are stored in the file info.
 
-    # Write out the metadata to file (.metadata.json)
-    metafile_outname = os.path.join(os.path.dirname(outbase), ".metadata.json")
-    print_string = json.dumps(
-        metadata, separators=(", ", ": "), sort_keys=True, indent=4
+    Returns:
+        PipelineResult: The result, without split plan nor timings.
+
+    Raises:
+        GRP3Error: If no metadata can be extracted, the error file is written first.
+    """
+    result = PipelineResult(file_path)
+    error_filepath = os.path.join(
+        outbase, os.path.basename(file_path) + ".error.log.json"
     )
-    log.info("DICOM .metadata.json: \n%s\n", print_string)
-    with open(metafile_outname, "w") as metafile:
-        json.dump(metadata, metafile, separators=(", ", ": "), sort_keys=True, indent=4)
+    member_digests = dict()
+    try:
+        result.metadata, result.validation_errors = extract_metadata(
+            file_path,
+            timezone,
+            json_template,
+            force=force,
+            header_cache=header_cache,
+            sequence_policy=sequence_policy,
+            rules=rules,
+            deadline=deadline,
+            member_digests=member_digests,
+        )
+    except GRP3Error as exc:
+        if exc.validation_errors:
+            dump_validation_error_file(error_filepath, exc.validation_errors)
+        raise
+
+    # Write error file
+    if result.validation_errors:
+        dump_validation_error_file(error_filepath, result.validation_errors)
+        result.error_path = error_filepath
+
+    # Write the digest of each member, too large for the file info
+    if checksums_path:
+        with open(checksums_path, "w") as fp:
+            json.dump(get_member_checksums(member_digests), fp, indent=4)
+
+    # Record the run so that later jobs on the same inputs can be skipped
+    if run_key is not None and not (deadline and deadline.skipped):
+        file_info = result.metadata["acquisition"]["files"][0]["info"]
+        file_info[RUN_INFO_KEY] = dict(
+            run_key, fingerprint=file_info["checksums"]["fingerprint"]
+        )
 
-    return metafile_outname
+    # Write out the metadata to file (.metadata.json)
+    result.metadata_path = metadata_path or os.path.join(
+        os.path.dirname(outbase), ".metadata.json"
+    )
+    write_metadata_json(
+        result.metadata, result.metadata_path, "DICOM .metadata.json", log
+    )
+    return result
+
+
+def dicom_to_json(
+    file_path,
+    outbase,
+    timezone,
+    json_template,
+    force=False,
+    header_cache=None,
+    sequence_policy=None,
+    metadata_path=None,
+    rules=None,
+    deadline=None,
+):
+    """Same as process_dicom, returning the path of the metadata file"""
+    return process_dicom(
+        file_path,
+        outbase,
+        timezone,
+        json_template,
+        force=force,
+        header_cache=header_cache,
+        sequence_policy=sequence_policy,
+        metadata_path=metadata_path,
+        rules=rules,
+        deadline=deadline,
+    ).metadata_path
+
+
+def split_embedded_localizer(
+    dcm_archive_path,
+    output_dir,
+    force=False,
+    sequence_policy=None,
+    drop_duplicates=False,
+):
+    """Splits the embedded localizer out of the archive at dcm_archive_path, if any
 
+    Args:
+        drop_duplicates (bool): Leave the members of identical content to a previous
+            member out of the split archives.
 
-def split_embedded_localizer(dcm_archive_path, output_dir, force=False):
+    Returns:
+        dict: The split plan (see PipelineResult.split_plan), None if not split.
+    """
     with dicom_archive.make_temp_directory() as tmp_dir:
         dcm_archive_obj = dicom_archive.DicomArchive(
-            dcm_archive_path, tmp_dir, dataset_list=True, force=force
+            dcm_archive_path,
+            tmp_dir,
+            dataset_list=True,
+            force=force,
+            header_func=functools.partial(
+                get_pydicom_header_before_pixels, sequence_policy=sequence_policy
+            ),
+            header_namespace=get_header_namespace(force, sequence_policy),
+            drop_duplicates=drop_duplicates,
+            stop_before_pixels=True,
         )
         if dcm_archive_obj.contains_embedded_localizer():
             log.info("Splitting embedded localizer...")
-            dcm_archive_obj.split_archive_on_unique_tag(
+            outputs = dcm_archive_obj.split_archive_on_unique_tag(
                 "ImageOrientationPatient", output_dir, "_Localizer", all_unique=False
             )
-            # Exit - gear rule should pick up new files and extract+Validate
             log.info(
                 "Embedded localizer split! Please run this gear on the output dicom archives if a gear rule is not set!"
             )
-            get_file_dict_and_update_metadata_json("dicom", output_filepath)
-            os.sys.exit(0)
+            return {"tag": "ImageOrientationPatient", "outputs": outputs}
+    return None
+
+
+def split_seriesinstanceUID(
+    dcm_archive_path,
+    output_dir,
+    force=False,
+    sequence_policy=None,
+    drop_duplicates=False,
+):
+    """Splits the archive at dcm_archive_path per SeriesInstanceUID, if it has several.
+    The series of the members of an archive with a DICOMDIR are read from it, see
+    utils.dicom.dicomdir.
 
+    Args:
+        drop_duplicates (bool): Leave the members of identical content to a previous
+            member out of the split archives.
 
-def split_seriesinstanceUID(dcm_archive_path, output_dir, force=False):
+    Returns:
+        dict: The split plan (see PipelineResult.split_plan), None if not split.
+    """
     with dicom_archive.make_temp_directory() as tmp_dir:
         dcm_archive_obj = dicom_archive.DicomArchive(
-            dcm_archive_path, tmp_dir, dataset_list=True, force=force
+            dcm_archive_path,
+            tmp_dir,
+            dataset_list=True,
+            force=force,
+            header_func=functools.partial(
+                get_pydicom_header_before_pixels, sequence_policy=sequence_policy
+            ),
+            header_namespace=get_header_namespace(force, sequence_policy),
+            drop_duplicates=drop_duplicates,
+            stop_before_pixels=True,
+            use_dicomdir=True,
         )
         if dcm_archive_obj.contains_different_seriesinstanceUID():
             log.info("Splitting embedded Series...")
-            dcm_archive_obj.split_archive_on_unique_tag(
+            outputs = dcm_archive_obj.split_archive_on_unique_tag(
                 "SeriesInstanceUID", output_dir, "", all_unique=True
             )
-            # Exit - gear rule should pick up new files and extract+Validate
             log.info(
                 "SeriesInstanceUID split! Please run this gear on the output dicom archives if a gear rule is not set!"
             )
-            get_file_dict_and_update_metadata_json("dicom", output_filepath)
-            os.sys.exit(0)
+            return {"tag": "SeriesInstanceUID", "outputs": outputs}
+    return None
+
+
+def run_pipeline(
+    file_path,
+    output_dir,
+    json_template=None,
+    timezone=None,
+    force=False,
+    split_on_seriesuid=False,
+    split_localizer=False,
+    header_cache=None,
+    sequence_policy=None,
+    metadata_path=None,
+    metrics_recorder=None,
+    split_drop_duplicates=False,
+    rules=None,
+    deadline=None,
+    run_key=None,
+    checksums_path=None,
+):
+    """Runs GRP-3 on the DICOM archive or file at file_path: splits it if configured to
+    and needed, otherwise extracts, validates and writes its metadata.
+
+    Nothing is looked up nor updated on Flywheel, see __main__ for the gear.
+
+    Args:
+        file_path (str): Path of the DICOM archive or file.
+        output_dir (str): Directory of the split archives, error file and metadata file.
+        json_template (dict): JSON schema the header is validated against.
+        timezone (pytz.timezone): Timezone of the DICOM timestamps, defaults to the
+            local timezone.
+        force (bool): Force reading of files missing the DICOM preamble.
+        split_on_seriesuid (bool): Split archives with several SeriesInstanceUID.
+        split_localizer (bool): Split embedded localizers out of archives.
+        split_drop_duplicates (bool): Leave the files of identical content to a
+            previous file out of the split archives.
+        header_cache (HeaderCache): Cache of the member headers, None to disable.
+        sequence_policy (SequencePolicy): Bounds on the sequence data.
+        metadata_path (str): Path of the metadata file to write, defaults to
+            .metadata.json in output_dir.
+        metrics_recorder (MetricsRecorder): Recorder of the stage metrics, a new one
+            by default.
+        rules (list): Names of the file rules, see utils.validation.get_enabled_rules.
+            Defaults to every rule.
+        deadline (Deadline): Time budget of the job, see extract_metadata. Unlimited
+            by default.
+        run_key (dict): Recorded in the file info, see process_dicom.
+        checksums_path (str): Path of the checksums file of the members, not written
+            by default, see process_dicom.
+
+    Returns:
+        PipelineResult: The result. If the input was split, its metadata is not
+            extracted, the split archives are meant to be processed on their own.
+
+    Raises:
+        GRP3Error: If no metadata can be extracted.
+        RuntimeError: If the input cannot be parsed as DICOM.
+    """
+    metrics_recorder = metrics_recorder or MetricsRecorder()
+    with metrics.recording(metrics_recorder):
+        timings = {}
+        stage_start = time.perf_counter()
+        validate_dicom(file_path)
+        timings["validate"] = time.perf_counter() - stage_start
+
+        split_plan = None
+        for enabled, split_func in (
+            (split_on_seriesuid, split_seriesinstanceUID),
+            (split_localizer, split_embedded_localizer),
+        ):
+            if not enabled:
+                continue
+            stage_start = time.perf_counter()
+            try:
+                split_plan = split_func(
+                    file_path,
+                    output_dir,
+                    force,
+                    sequence_policy,
+                    drop_duplicates=split_drop_duplicates,
+                )
+            except Exception as err:
+                log.error(
+                    "%s failed! err=%s", split_func.__name__, err, exc_info=True
+                )
+            timings[split_func.__name__] = time.perf_counter() - stage_start
+            if split_plan:
+                break
+
+        if split_plan:
+            result = PipelineResult(file_path)
+            result.split_plan = split_plan
+        else:
+            stage_start = time.perf_counter()
+            result = process_dicom(
+                file_path,
+                output_dir,
+                timezone or validate_timezone(None),
+                json_template or {},
+                force=force,
+                header_cache=header_cache,
+                sequence_policy=sequence_policy,
+                metadata_path=metadata_path
+                or os.path.join(output_dir, ".metadata.json"),
+                rules=rules,
+                deadline=deadline,
+                run_key=run_key,
+                checksums_path=checksums_path,
+            )
+            timings["process_dicom"] = time.perf_counter() - stage_start
+    result.timings = timings
+    result.metrics = metrics_recorder.to_dict()
+    return result
 
 
 if __name__ == "__main__":
@@ -810,6 +1556,9 @@ if __name__ == "__main__":
     with open(config_file_path) as config_data:
         config = json.load(config_data)
 
+    # Time budget of the whole job, optional steps are skipped once it is spent
+    deadline = Deadline(config["config"].get("time_budget_seconds"))
+
     debug = config.get("config").get("debug")
     root_logger = logging.getLogger()
     if debug:
@@ -817,16 +1566,29 @@ if __name__ == "__main__":
     else:
         root_logger.setLevel(logging.INFO)
 
+    # Record the stage metrics of the whole job, Flywheel API calls included
+    metrics_recorder = metrics.start_recording()
+
+    # Look up the input file on Flywheel while the archive is processed
+    dest_file_future = prefetch_dest_cont_file_dict("dicom")
+
     # Get config values
     split_localizer = config["config"]["split_localizer"]
     split_on_seriesuid = config["config"]["split_on_SeriesUID"]
+    split_drop_duplicates = config["config"].get("split_drop_duplicates", False)
     force_dicom_read = config["config"]["force_dicom_read"]
+    sequence_policy = get_sequence_policy(config["config"])
+    rules = get_enabled_rules(config["config"].get("disabled_rules"))
+    header_cache = get_header_cache(
+        config["config"].get("header_cache_dir"),
+        config["config"].get("header_cache_max_size_mb", DEFAULT_MAX_SIZE_MB),
+        force=force_dicom_read,
+        sequence_policy=sequence_policy,
+    )
     # Set dicom path and name from config file
     dicom_filepath = config["inputs"]["dicom"]["location"]["path"]
     dicom_name = config["inputs"]["dicom"]["location"]["name"]
 
-    # Check that input is DICOM
-    validate_dicom(dicom_filepath)
     # Set template json filepath (if provided)
     if config["inputs"].get("json_template"):
         template_filepath = config["inputs"]["json_template"]["location"]["path"]
@@ -836,27 +1598,6 @@ if __name__ == "__main__":
     # Determine the level from which the gear was invoked
     hierarchy_level = config["inputs"]["dicom"]["hierarchy"]["type"]
 
-    # Split seriesinstanceUID
-    if split_on_seriesuid:
-        try:
-            split_seriesinstanceUID(dicom_filepath, output_folder, force_dicom_read)
-
-        except Exception as err:
-            log.error(
-                "split_seriesinstanceUID failed! err={}".format(err), exc_info=True
-            )
-
-    # Split embedded localizers if configured to do so and if the
-    # Dicom archive is a series that contains an embedded localizer
-    if split_localizer:
-        try:
-            split_embedded_localizer(dicom_filepath, output_folder, force_dicom_read)
-
-        except Exception as err:
-            log.error(
-                "split_embedded_localizer failed! err={}".format(err), exc_info=True
-            )
-
     # Configure timezone
     timezone = validate_timezone(tzlocal.get_localzone())
 
@@ -870,11 +1611,77 @@ if __name__ == "__main__":
         template.update(import_template)
     json_template = template.copy()
 
-    metadatafile = dicom_to_json(
-        dicom_filepath, output_folder, timezone, json_template, force=force_dicom_read
+    # Skip the job if the archive was already processed with the same inputs
+    with open(os.path.join(os.path.dirname(__file__), "manifest.json")) as manifest:
+        gear_version = json.load(manifest)["version"]
+    run_key = get_run_key(
+        json_template,
+        config["config"],
+        gear_version,
+        get_header_namespace(force_dicom_read, sequence_policy),
     )
+    # Off by default: the check waits on the file lookup, which otherwise runs
+    # alongside the pipeline
+    if config["config"].get("skip_unchanged", False):
+        with metrics.stage("skip_unchanged_check"):
+            try:
+                dest_file_dict, _ = dest_file_future.result()
+            except Exception:
+                # Reported again when the metadata is updated
+                log.warning("File lookup failed, processing %s", dicom_name)
+                dest_file_dict = {}
+            unchanged = is_unchanged(dest_file_dict, dicom_filepath, run_key)
+        if unchanged:
+            log.info(
+                "%s is unchanged since its last run with the same template, config "
+                "and gear version. Exiting.",
+                dicom_name,
+            )
+            log.info("Metrics: %s", metrics_recorder.summary())
+            os.sys.exit(0)
 
-    get_file_dict_and_update_metadata_json("dicom", metadatafile)
+    exit_code = 0
+    try:
+        with profiling(
+            output_folder,
+            dicom_name,
+            cpu=config["config"].get("profile", False),
+            memory=config["config"].get("profile_memory", False),
+        ):
+            result = run_pipeline(
+                dicom_filepath,
+                output_folder,
+                json_template,
+                timezone,
+                force=force_dicom_read,
+                split_on_seriesuid=split_on_seriesuid,
+                split_localizer=split_localizer,
+                header_cache=header_cache,
+                sequence_policy=sequence_policy,
+                metadata_path=output_filepath,
+                metrics_recorder=metrics_recorder,
+                split_drop_duplicates=split_drop_duplicates,
+                rules=rules,
+                deadline=deadline,
+                run_key=run_key,
+                checksums_path=(
+                    os.path.join(output_folder, dicom_name + ".checksums.json")
+                    if config["config"].get("write_checksums")
+                    else None
+                ),
+            )
+            # After a split, the gear rule should pick up the new files and extract+Validate
+            get_file_dict_and_update_metadata_json(
+                "dicom", output_filepath, dest_file_future
+            )
+    except GRP3Error as err:
+        log.error("%s. Exiting.", err)
+        exit_code = 1
+    finally:
+        log.info("Metrics: %s", metrics_recorder.summary())
+        if config["config"].get("write_metrics"):
+            metrics_recorder.write(
+                os.path.join(output_folder, dicom_name + ".metrics.json")
+            )
 
-    if os.path.isfile(metadatafile):
-        os.sys.exit(0)
+    os.sys.exit(exit_code)
@@ -0,0 +1,79 @@
+"""Benchmark of the gear startup time and of the import cost of each module
+
+Imports run.py in fresh interpreters with `python -X importtime` and reports the
+wall time of the import and the cumulative import time of the slowest modules.
+
+Usage (from the repository root):
+    python -m tests.benchmarks.bench_import_time --repeat 5
+"""
+import argparse
+import collections
+import json
+import os
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Dependencies that must only be imported by the code paths using them
+LAZY_MODULES = ('nibabel', 'pandas', 'jsonschema', 'flywheel', 'backoff')
+
+
+def parse_importtime(stderr):
+    """Returns {module: cumulative import time in seconds} from -X importtime output"""
+    cumulative = dict()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, module = line[len('import time:'):].split('|')
+        cumulative[module.strip()] = int(cumulative_us) / 1e6
+    return cumulative
+
+
+def time_import(module='run'):
+    """Imports module in a fresh interpreter and returns its wall time, the cumulative
+    import time of each module and the lazy modules that got imported"""
+    code = f'import sys; import {module}; print(",".join(m for m in {LAZY_MODULES!r} if m in sys.modules))'
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=REPO_ROOT,
+                          capture_output=True, text=True, check=True)
+    wall_time = time.perf_counter() - start
+    loaded_lazy_modules = [m for m in proc.stdout.strip().split(',') if m]
+    return wall_time, parse_importtime(proc.stderr), loaded_lazy_modules
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='run', help='Module to import')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of fresh interpreters')
+    parser.add_argument('--top', type=int, default=15, help='Number of modules to report')
+    parser.add_argument('--output', help='Path of a JSON file to write the results to')
+    args = parser.parse_args(args)
+
+    wall_times = list()
+    module_times = collections.defaultdict(list)
+    loaded_lazy_modules = list()
+    for _ in range(args.repeat):
+        wall_time, cumulative, loaded_lazy_modules = time_import(args.module)
+        wall_times.append(wall_time)
+        for module, module_time in cumulative.items():
+            module_times[module].append(module_time)
+
+    # Top-level packages only, their cumulative time includes their submodules
+    top_level = {module: min(times) for module, times in module_times.items() if '.' not in module}
+    results = {
+        'module': args.module,
+        'wall_time': min(wall_times),
+        'import_time': top_level.get(args.module),
+        'loaded_lazy_modules': loaded_lazy_modules,
+        'slowest_modules': dict(sorted(top_level.items(), key=lambda item: -item[1])[:args.top])
+    }
+    print(json.dumps(results, indent=4))
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=4)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""Benchmark of the stages of GRP-3 across archive sizes, compared against a baseline
+
+For each size, synthetic archives (see tests/synthetic.py) are generated and the
+following are timed, keeping the best of --repeat runs:
+    - dicom_archive: DicomArchive initialization with the dataset list, as done by
+      the splitters
+    - process_dicom: extraction, validation and writing of the metadata, along with
+      each of its stages recorded by utils.metrics (stage.<name>), e.g. each rule
+    - split_seriesinstanceUID: split of an archive of two series
+    - split_embedded_localizer: split of an archive with an embedded localizer
+
+Usage (from the repository root):
+    python -m tests.benchmarks.bench_pipeline --sizes 10,100,1000 --output results.json
+    python -m tests.benchmarks.bench_pipeline --compare tests/benchmarks/baseline.json
+    python -m tests.benchmarks.bench_pipeline --sizes 10,100,1000 --output tests/benchmarks/baseline.json
+
+Sizes go up to 50000 slices, larger sizes take minutes to generate and run. Timings
+depend on the machine, a baseline is only meaningful on the machine it was saved on.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import pydicom
+
+from run import (
+    get_header_namespace,
+    get_pydicom_header_before_pixels,
+    process_dicom,
+    split_embedded_localizer,
+    split_seriesinstanceUID,
+    validate_timezone,
+)
+from tests.synthetic import make_synthetic_archive
+from utils import metrics
+from utils.dicom.dicom_archive import DicomArchive
+from utils.metrics import MetricsRecorder
+
+DEFAULT_SIZES = (10, 100, 1000)
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+# Timings are regressions if slower than the baseline by this ratio and MIN_DELTA seconds
+DEFAULT_TOLERANCE = 0.25
+MIN_DELTA = 0.05
+
+
+def make_archives(directory, size):
+    """Returns the paths of the synthetic archives benchmarked at size"""
+    plain_path = make_synthetic_archive(
+        os.path.join(directory, f'plain_{size}.dicom.zip'), slice_count=size, siemens_csa=True,
+        missing_slices=1 if size >= 10 else 0, enhanced_multiframe_frames=min(size, 500), zero_byte_members=1
+    )
+    multi_series_path = make_synthetic_archive(
+        os.path.join(directory, f'multi_series_{size}.dicom.zip'), slice_count=max(size // 2, 1), series_count=2
+    )
+    localizer_path = make_synthetic_archive(
+        os.path.join(directory, f'localizer_{size}.dicom.zip'), slice_count=size, localizer_count=3
+    )
+    return plain_path, multi_series_path, localizer_path
+
+
+def best_time(func, repeat):
+    timings = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def bench_size(size, repeat):
+    """Returns the timings, in seconds, of the stages at size"""
+    results = dict()
+    timezone = validate_timezone(None)
+    with tempfile.TemporaryDirectory() as work_dir:
+        plain_path, multi_series_path, localizer_path = make_archives(work_dir, size)
+        output_dir = os.path.join(work_dir, 'output')
+        os.makedirs(output_dir)
+
+        def init_dicom_archive():
+            with tempfile.TemporaryDirectory() as extract_dir:
+                DicomArchive(plain_path, extract_dir, dataset_list=True, header_func=get_pydicom_header_before_pixels,
+                             header_namespace=get_header_namespace())
+
+        results['dicom_archive'] = best_time(init_dicom_archive, repeat)
+
+        stage_timings = dict()
+
+        def run_process_dicom():
+            recorder = MetricsRecorder()
+            with metrics.recording(recorder):
+                process_dicom(plain_path, output_dir + os.path.sep, timezone, {'type': 'object'})
+            for name, stage in recorder.to_dict()['stages'].items():
+                stage_timings.setdefault(name, list()).append(stage['wall_time'])
+
+        results['process_dicom'] = best_time(run_process_dicom, repeat)
+        for name, timings in sorted(stage_timings.items()):
+            results[f'stage.{name}'] = min(timings)
+
+        results['split_seriesinstanceUID'] = best_time(
+            lambda: split_seriesinstanceUID(multi_series_path, output_dir), repeat
+        )
+        results['split_embedded_localizer'] = best_time(
+            lambda: split_embedded_localizer(localizer_path, output_dir), repeat
+        )
+    return results
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Returns the regressions of results against baseline
+
+    Returns:
+        list: (size, name, baseline seconds, result seconds) of the regressions.
+    """
+    regressions = list()
+    for size, timings in results['results'].items():
+        baseline_timings = baseline['results'].get(size, {})
+        for name, seconds in timings.items():
+            baseline_seconds = baseline_timings.get(name)
+            if baseline_seconds is None:
+                continue
+            if seconds > baseline_seconds * (1 + tolerance) and seconds - baseline_seconds > MIN_DELTA:
+                regressions.append((size, name, baseline_seconds, seconds))
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help='Comma separated slice counts, from 10 to 50000')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each stage')
+    parser.add_argument('--output', help='Path of a JSON file to save the results to')
+    parser.add_argument('--compare', nargs='?', const=BASELINE_PATH,
+                        help='Baseline to compare the results against, tests/benchmarks/baseline.json by default')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Slowdown ratio from which a timing is a regression')
+    args = parser.parse_args(args)
+    # The benchmarked archives have invalid members on purpose
+    logging.basicConfig(level=logging.CRITICAL)
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    results = {
+        'machine': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'pydicom': pydicom.__version__,
+            'cpu_count': os.cpu_count(),
+        },
+        'repeat': args.repeat,
+        'results': dict(),
+    }
+    for size in (int(size) for size in args.sizes.split(',')):
+        results['results'][str(size)] = bench_size(size, args.repeat)
+        print(f'{size} slices:')
+        for name, seconds in results['results'][str(size)].items():
+            print(f'    {name:<45} {seconds:10.4f} s')
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=4, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, args.tolerance)
+        for size, name, baseline_seconds, seconds in regressions:
+            print(f'REGRESSION {size} slices {name}: {baseline_seconds:.4f} s -> {seconds:.4f} s')
+        if regressions:
+            return 1
+        print(f'No regression against {args.compare}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+"""Benchmark of the gear latency and Flywheel API time against a local API stand-in
+
+Runs the same sequence as run.py (file lookup, dicom_to_json, .metadata.json update)
+on a synthetic archive, against tests.fw_api_stub.FlywheelApiStub, and reports the
+end-to-end latency, the time spent waiting on the API by the gear and the time spent
+by the stub serving requests.
+
+Usage (from the repository root):
+    python -m tests.benchmarks.bench_update_file_info --latency 0.5 --fail-first 1
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import zipfile
+
+import flywheel
+import pydicom
+from pydicom.data import get_testdata_files
+
+import utils.update_file_info as update_file_info
+from run import dicom_to_json, validate_timezone
+from tests.fw_api_stub import FlywheelApiStub
+
+PARENT_ID = 'acquisition_id'
+FILE_NAME = 'bench.dicom.zip'
+
+
+def legacy_dest_file_dict_request(fw_client, acq_id, file_name):
+    """File lookup through the full parent container, as done before the single
+    round-trip lookup"""
+    file_dict = dict()
+    file_obj = fw_client.get(acq_id).get_file(file_name)
+    if file_obj:
+        file_dict = file_obj.to_dict()
+    return file_dict
+
+
+def make_archive(directory, slice_count):
+    test_dicom_path = get_testdata_files('MR_small.dcm')[0]
+    zip_path = os.path.join(directory, FILE_NAME)
+    dcm = pydicom.dcmread(test_dicom_path)
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for i in range(slice_count):
+            dcm.InstanceNumber = i
+            dcm.SliceLocation = float(i)
+            slice_path = os.path.join(directory, 'slice.dcm')
+            dcm.save_as(slice_path)
+            zipf.write(slice_path, f'{i}.dcm')
+    return zip_path
+
+
+def write_gear_config(gear_dir, api_key, zip_path):
+    config = {
+        'config': {},
+        'inputs': {
+            'api-key': {'base': 'api-key', 'key': api_key},
+            'dicom': {
+                'base': 'file',
+                'location': {'name': FILE_NAME, 'path': zip_path},
+                'hierarchy': {'id': PARENT_ID, 'type': 'acquisition'}
+            }
+        },
+        'destination': {'id': PARENT_ID, 'type': 'acquisition'}
+    }
+    with open(os.path.join(gear_dir, 'config.json'), 'w') as fp:
+        json.dump(config, fp)
+
+
+def run_once(stub, zip_path, gear_dir, overlap):
+    """Runs the gear sequence once and returns its timings in seconds"""
+    # Fresh client and memoization for every run, as in a new gear job
+    update_file_info._gear_context = flywheel.GearContext(gear_path=gear_dir)
+    update_file_info._file_dict_cache.clear()
+    stub.request_log.clear()
+    output_dir = os.path.join(gear_dir, 'output') + os.path.sep
+    os.makedirs(output_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    file_dict_future = update_file_info.prefetch_dest_cont_file_dict('dicom') if overlap else None
+    metadata_path = dicom_to_json(zip_path, output_dir, validate_timezone(None), {})
+    wait_start = time.perf_counter()
+    update_file_info.get_file_dict_and_update_metadata_json('dicom', metadata_path, file_dict_future)
+    end = time.perf_counter()
+    return {
+        'end_to_end': end - start,
+        'api_wait': end - wait_start,
+        'api_server': stub.api_time(),
+        'api_requests': len(stub.request_log),
+        'api_bytes': sum(entry['bytes'] for entry in stub.request_log)
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--slices', type=int, default=50, help='Number of slices of the archive')
+    parser.add_argument('--latency', type=float, default=0.2, help='Latency of each API request in seconds')
+    parser.add_argument('--fail-first', type=int, default=0, help='Number of 504 responses to inject per run')
+    parser.add_argument('--container-files', type=int, default=500,
+                        help='Number of extra files in the parent container payload')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs per scenario')
+    parser.add_argument('--output', help='Path of a JSON file to write the results to')
+    args = parser.parse_args(args)
+
+    scenarios = {
+        'legacy_lookup_sequential': (legacy_dest_file_dict_request, False),
+        'file_lookup_sequential': (update_file_info.dest_file_dict_request, False),
+        'file_lookup_overlapped': (update_file_info.dest_file_dict_request, True),
+    }
+    results = dict()
+    original_request = update_file_info.dest_file_dict_request
+    with tempfile.TemporaryDirectory() as work_dir:
+        zip_path = make_archive(work_dir, args.slices)
+        stub = FlywheelApiStub(latency=args.latency, container_file_count=args.container_files)
+        stub.add_file(PARENT_ID, {'name': FILE_NAME, 'type': 'dicom', 'modality': 'MR', 'info': {}})
+        with stub:
+            write_gear_config(work_dir, stub.api_key, zip_path)
+            for name, (request_func, overlap) in scenarios.items():
+                update_file_info.dest_file_dict_request = request_func
+                runs = list()
+                try:
+                    for _ in range(args.repeat):
+                        stub.fail_first = args.fail_first
+                        runs.append(run_once(stub, zip_path, work_dir, overlap))
+                finally:
+                    update_file_info.dest_file_dict_request = original_request
+                results[name] = {key: min(run[key] for run in runs) for key in runs[0]}
+
+    print(json.dumps(results, indent=4))
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=4)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,2 @@
+"""Differential equivalence checks between the legacy implementations, frozen in
+tests/equivalence/legacy, and the current ones, see check_equivalence.py"""
@@ -0,0 +1,342 @@
+"""Differential check of the current implementations against the legacy ones
+
+Runs the legacy implementations, frozen in tests/equivalence/legacy, and the current
+ones of run.py and utils over a corpus and reports every divergence of:
+    - header: get_pydicom_header of each file or archive member
+    - value: assign_type and format_string of each data element value
+    - metadata / errors: the .metadata.json dictionary and the validation errors of
+      extract_metadata (dicom_to_json of the legacy gear)
+    - rules: the file rules (e.g. check_missing_slices) on the same data dicts
+    - split.<splitter>: whether each splitter splits and the members of its outputs
+    - golden.legacy / golden.current: the headers of MR_small.dcm and CT_small.dcm
+      against tests/data/dicom_out_known_good.json and dicom_out_CT_small.json
+
+The corpus is made of synthetic archives (see tests/synthetic.py), of the pydicom test
+files and of optional archives or files given with --archives. The current
+implementations are checked with their default options, bounded sequence policies
+(see SequencePolicy) change the headers by design. Additions of the current
+implementations, such as the file rules added since and the info.checksums of the
+metadata, are left out of the comparison.
+
+A faster implementation may only replace a current one if this check reports no
+divergence, i.e. the output is identical, types included (1 and 1.0 differ in JSON).
+
+Usage (from the repository root):
+    python -m tests.equivalence.check_equivalence
+    python -m tests.equivalence.check_equivalence --size 1000 --archives /data/*.dicom.zip --output report.json
+"""
+import argparse
+import collections
+import json
+import logging
+import math
+import os
+import sys
+import tempfile
+import zipfile
+
+import pydicom
+from pydicom.data import get_testdata_files
+
+import run
+from tests.equivalence.legacy import run as legacy_run
+from tests.equivalence.legacy import validation as legacy_validation
+from tests.synthetic import make_synthetic_archive
+from utils import validation
+from utils.dicom.header_index import HEADER_INDEX_MEMBER
+from utils.errors import GRP3Error
+
+DATA_ROOT = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+DEFAULT_TEMPLATE_PATH = os.path.join(DATA_ROOT, 'test_jsonschema_template1.json')
+DEFAULT_SIZE = 20
+GOLDENS = (
+    ('MR_small.dcm', 'dicom_out_known_good.json'),
+    ('CT_small.dcm', 'dicom_out_CT_small.json'),
+)
+PYDICOM_TEST_FILES = ('MR_small.dcm', 'CT_small.dcm', 'liver.dcm', 'emri_small.dcm')
+
+# A divergence at path (e.g. acquisition.files[0].info.header.dicom.EchoTime) between
+# the reference (legacy or golden) and the candidate (current) values
+Divergence = collections.namedtuple('Divergence', ['case', 'kind', 'path', 'reference', 'candidate'])
+
+
+class Missing:
+    """Value of a key missing from one of the compared dictionaries"""
+
+    def __repr__(self):
+        return '<missing>'
+
+
+MISSING = Missing()
+
+
+def values_equal(reference, candidate):
+    if type(reference) != type(candidate):
+        return False
+    if isinstance(reference, float) and math.isnan(reference) and math.isnan(candidate):
+        return True
+    return reference == candidate
+
+
+def diff_values(reference, candidate, path=''):
+    """Yields the (path, reference value, candidate value) at which reference and
+    candidate differ, nested dictionaries and lists being compared item by item"""
+    if isinstance(reference, dict) and isinstance(candidate, dict):
+        for key in sorted(set(reference) | set(candidate), key=str):
+            key_path = f'{path}.{key}' if path else str(key)
+            yield from diff_values(reference.get(key, MISSING), candidate.get(key, MISSING), key_path)
+    elif isinstance(reference, (list, tuple)) and type(reference) == type(candidate):
+        if len(reference) != len(candidate):
+            yield path, reference, candidate
+            return
+        for index, (reference_item, candidate_item) in enumerate(zip(reference, candidate)):
+            yield from diff_values(reference_item, candidate_item, f'{path}[{index}]')
+    elif not values_equal(reference, candidate):
+        yield path, reference, candidate
+
+
+def get_divergences(case, kind, reference, candidate):
+    return [Divergence(case, kind, *diff) for diff in diff_values(reference, candidate)]
+
+
+def iter_dicom_paths(file_path, extract_dir):
+    """Yields the paths of the non-empty DICOM files of the archive or file at file_path"""
+    if zipfile.is_zipfile(file_path):
+        with zipfile.ZipFile(file_path) as zipf:
+            for zip_info in zipf.infolist():
+                if zip_info.is_dir() or zip_info.filename == HEADER_INDEX_MEMBER or not zip_info.file_size:
+                    continue
+                yield zipf.extract(zip_info, extract_dir)
+    elif os.path.getsize(file_path):
+        yield file_path
+
+
+def compare_headers(case, dcm_path):
+    """Compares the legacy and current get_pydicom_header of the file at dcm_path"""
+    try:
+        # Each implementation reads its own dataset, walk_dicom fixes it in place
+        legacy_dcm = pydicom.dcmread(dcm_path, force=True)
+        current_dcm = pydicom.dcmread(dcm_path, force=True)
+    except Exception:
+        return []
+    member = os.path.basename(dcm_path)
+    return get_divergences(
+        f'{case}:{member}', 'header', legacy_run.get_pydicom_header(legacy_dcm), run.get_pydicom_header(current_dcm)
+    )
+
+
+def compare_values(case, dcm_path):
+    """Compares the legacy and current assign_type and format_string of the data
+    element values of the file at dcm_path"""
+    try:
+        dcm = pydicom.dcmread(dcm_path, force=True, stop_before_pixels=True)
+        data_elements = list(dcm.iterall())
+    except Exception:
+        return []
+    member = os.path.basename(dcm_path)
+    divergences = list()
+    for data_element in data_elements:
+        if data_element.VR == 'SQ':
+            continue
+        path = data_element.keyword or str(data_element.tag)
+        value = data_element.value
+        divergences += get_divergences(
+            f'{case}:{member}', 'value.assign_type', {path: legacy_run.assign_type(value)},
+            {path: run.assign_type(value)}
+        )
+        divergences += get_divergences(
+            f'{case}:{member}', 'value.format_string', {path: legacy_run.format_string(value)},
+            {path: run.format_string(value)}
+        )
+    return divergences
+
+
+def compare_metadata(case, file_path, timezone, template, force=False):
+    """Compares the legacy and current metadata and validation errors of file_path"""
+    legacy_metadata, legacy_errors = legacy_run.extract_metadata(file_path, timezone, template, force=force)
+    try:
+        metadata, errors = run.extract_metadata(
+            file_path, timezone, template, force=force, rules=legacy_validation.DEFAULT_RULE_LIST
+        )
+    except GRP3Error as exc:
+        metadata, errors = None, exc.validation_errors
+    if metadata:
+        for file_dict in metadata['acquisition']['files']:
+            file_dict['info'].pop('checksums', None)
+    return (
+        get_divergences(case, 'metadata', legacy_metadata, metadata) +
+        get_divergences(case, 'errors', legacy_errors, errors)
+    )
+
+
+def compare_rules(case, file_path, force=False):
+    """Compares the legacy and current file rules on the current data dicts of file_path"""
+    if not os.path.getsize(file_path):
+        return []
+    with tempfile.TemporaryDirectory() as extract_dir:
+        try:
+            dcm_dict_list = run.get_dcm_dict_list(file_path, extract_dir, force=force)
+        except GRP3Error:
+            return []
+        return get_divergences(
+            case, 'rules', legacy_validation.validate_against_rules(dcm_dict_list),
+            validation.validate_against_rules(dcm_dict_list, legacy_validation.DEFAULT_RULE_LIST)
+        )
+
+
+def get_split_outputs(output_dir):
+    """Returns {archive name: {member name: CRC}} of the archives in output_dir"""
+    outputs = dict()
+    for name in sorted(os.listdir(output_dir)):
+        with zipfile.ZipFile(os.path.join(output_dir, name)) as zipf:
+            outputs[name] = {
+                zip_info.filename: zip_info.CRC for zip_info in zipf.infolist()
+                if zip_info.filename != HEADER_INDEX_MEMBER
+            }
+    return outputs
+
+
+def compare_split(case, archive_path, force=False):
+    """Compares the legacy and current splits of the archive at archive_path"""
+    divergences = list()
+    for name in ('split_embedded_localizer', 'split_seriesinstanceUID'):
+        with tempfile.TemporaryDirectory() as legacy_dir, tempfile.TemporaryDirectory() as current_dir:
+            legacy_split = getattr(legacy_run, name)(archive_path, legacy_dir, force=force)
+            current_split = getattr(run, name)(archive_path, current_dir, force=force) is not None
+            divergences += get_divergences(
+                case, f'split.{name}',
+                {'split': legacy_split, 'outputs': get_split_outputs(legacy_dir)},
+                {'split': current_split, 'outputs': get_split_outputs(current_dir)},
+            )
+    return divergences
+
+
+def compare_goldens():
+    """Compares the legacy and current headers of the pydicom test files to the goldens"""
+    divergences = list()
+    for file_name, golden_name in GOLDENS:
+        dcm_path = get_testdata_files(file_name)[0]
+        with open(os.path.join(DATA_ROOT, golden_name)) as fp:
+            golden = json.load(fp)
+        headers = {
+            'golden.legacy': legacy_run.get_pydicom_header(pydicom.dcmread(dcm_path)),
+            'golden.current': run.get_pydicom_header(pydicom.dcmread(dcm_path)),
+        }
+        for kind, header in headers.items():
+            for key, value in golden.items():
+                # Like test_get_pydicom_header_all_tags, empty golden values are not checked
+                if value:
+                    divergences += [
+                        Divergence(golden_name, kind, *diff)
+                        for diff in diff_values(value, header.get(key, MISSING), key)
+                    ]
+    return divergences
+
+
+def build_corpus(directory, size=DEFAULT_SIZE):
+    """Writes the synthetic archives of the corpus to directory
+
+    Args:
+        directory (str): Directory the synthetic archives are written to.
+        size (int): Number of slices of each series of the synthetic archives.
+
+    Returns:
+        list: (case name, path) of the archives and files of the corpus.
+    """
+    corpus = [
+        ('plain', make_synthetic_archive(
+            os.path.join(directory, 'plain.dicom.zip'), slice_count=size, siemens_csa=True, missing_slices=1,
+            enhanced_multiframe_frames=min(size, 100), zero_byte_members=1
+        )),
+        ('complete', make_synthetic_archive(os.path.join(directory, 'complete.dicom.zip'), slice_count=size)),
+        ('multi_series', make_synthetic_archive(
+            os.path.join(directory, 'multi_series.dicom.zip'), slice_count=size, series_count=3
+        )),
+        ('localizer', make_synthetic_archive(
+            os.path.join(directory, 'localizer.dicom.zip'), slice_count=size, localizer_count=3
+        )),
+        ('stored', make_synthetic_archive(
+            os.path.join(directory, 'stored.dicom.zip'), slice_count=3, compression=zipfile.ZIP_STORED
+        )),
+    ]
+    # Flipping a byte of the pixel data of a stored member fails its CRC check
+    corrupted_path = os.path.join(directory, 'corrupted.dicom.zip')
+    with open(corpus[-1][1], 'rb') as fp:
+        content = bytearray(fp.read())
+    content[len(content) // 2] ^= 0xFF
+    with open(corrupted_path, 'wb') as fp:
+        fp.write(content)
+    corpus.append(('corrupted', corrupted_path))
+
+    empty_path = os.path.join(directory, 'empty.dcm')
+    open(empty_path, 'wb').close()
+    corpus.append(('empty', empty_path))
+    corpus.append(('invalid_seriesdescription', os.path.join(DATA_ROOT, 'DICOM', 'invalid',
+                                                             'invalid_seriesdescription.dcm')))
+    for file_name in PYDICOM_TEST_FILES:
+        corpus.append((file_name, get_testdata_files(file_name)[0]))
+    return corpus
+
+
+def check_equivalence(corpus, timezone, template, force=False):
+    """Returns the divergences between the legacy and current implementations
+
+    Args:
+        corpus (list): (case name, path) of the archives and files to check.
+        timezone (pytz.timezone): Timezone of the DICOM timestamps.
+        template (dict): JSON schema template of the metadata validation.
+        force (bool): Force reading of files missing the DICOM preamble.
+
+    Returns:
+        list: The Divergence found, none if the implementations are equivalent.
+    """
+    divergences = compare_goldens()
+    for case, file_path in corpus:
+        divergences += compare_metadata(case, file_path, timezone, template, force=force)
+        divergences += compare_rules(case, file_path, force=force)
+        with tempfile.TemporaryDirectory() as extract_dir:
+            try:
+                dcm_paths = list(iter_dicom_paths(file_path, extract_dir))
+            except zipfile.BadZipFile:
+                continue
+            for dcm_path in dcm_paths:
+                divergences += compare_headers(case, dcm_path)
+                divergences += compare_values(case, dcm_path)
+        if zipfile.is_zipfile(file_path):
+            divergences += compare_split(case, file_path, force=force)
+    return divergences
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=DEFAULT_SIZE, help='Slices per series of the synthetic archives')
+    parser.add_argument('--archives', nargs='*', default=[], help='Additional archives or files to check')
+    parser.add_argument('--template', default=DEFAULT_TEMPLATE_PATH, help='JSON schema template of the validation')
+    parser.add_argument('--force', action='store_true', help='Force reading of files missing the DICOM preamble')
+    parser.add_argument('--output', help='Path of a JSON file to save the divergences to')
+    args = parser.parse_args(args)
+    # The corpus has invalid files on purpose
+    logging.basicConfig(level=logging.CRITICAL)
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    with open(args.template) as fp:
+        template = json.load(fp)
+    timezone = run.validate_timezone(None)
+    with tempfile.TemporaryDirectory() as corpus_dir:
+        corpus = build_corpus(corpus_dir, args.size)
+        corpus += [(os.path.basename(path), path) for path in args.archives]
+        divergences = check_equivalence(corpus, timezone, template, force=args.force)
+
+    for divergence in divergences:
+        print(f'DIVERGENCE {divergence.case} {divergence.kind} {divergence.path}: '
+              f'{divergence.reference!r} != {divergence.candidate!r}')
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump([{key: repr(value) if key in ('reference', 'candidate') else value
+                        for key, value in divergence._asdict().items()} for divergence in divergences], fp, indent=4)
+    print(f'{len(corpus)} archives and files checked, {len(divergences)} divergences')
+    return 1 if divergences else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""Frozen copy of the header extraction of utils/dicom/dicom_metadata.py at the
+baseline, used by the legacy DicomArchive. Do not edit, see tests/equivalence.
+"""
+import logging
+import re
+import string
+
+import pydicom
+
+log = logging.getLogger(__name__)
+
+
+
+def assign_type(s):
+    """
+    Sets the type of a given input.
+    """
+    if isinstance(s, pydicom.valuerep.PersonName):
+        return format_string(s)
+    if type(s) == list or type(s) == pydicom.multival.MultiValue:
+        try:
+            return [float(x) for x in s]
+        except ValueError:
+            try:
+                return [int(x) for x in s]
+            except ValueError:
+                return [format_string(x) for x in s if len(x) > 0]
+    elif type(s) == float or type(s) == int:
+        return s
+    else:
+        s = str(s)
+        try:
+            return int(s)
+        except ValueError:
+            try:
+                return float(s)
+            except ValueError:
+                return format_string(s)
+
+
+def format_string(in_string):
+    # Remove non-ascii characters
+    formatted = re.sub(r"[^\x00-\x7f]", r"", str(in_string))
+    formatted = "".join(filter(lambda x: x in string.printable, formatted))
+    if len(formatted) == 1 and formatted == "?":
+        formatted = None
+    return formatted
+
+
+def get_seq_data(sequence, ignore_keys):
+    seq_dict = {}
+    for seq in sequence:
+        for s_key in seq.dir():
+            s_val = getattr(seq, s_key, "")
+            if type(s_val) is pydicom.uid.UID or s_key in ignore_keys:
+                continue
+
+            if type(s_val) == pydicom.sequence.Sequence:
+                _seq = get_seq_data(s_val, ignore_keys)
+                seq_dict[s_key] = _seq
+                continue
+
+            if type(s_val) == str:
+                s_val = format_string(s_val)
+            else:
+                s_val = assign_type(s_val)
+
+            if s_val:
+                seq_dict[s_key] = s_val
+    return seq_dict
+
+
+def get_pydicom_header(dcm):
+    # Extract the header values
+    header = {}
+    exclude_tags = [
+        "[Unknown]",
+        "PixelData",
+        "Pixel Data",
+        "[User defined data]",
+        "[Protocol Data Block (compressed)]",
+        "[Histogram tables]",
+        "[Unique image iden]",
+    ]
+    tags = dcm.dir()
+    not_found_tags = []
+    for tag in tags:
+        try:
+            if (tag not in exclude_tags) and (
+                type(dcm.get(tag)) != pydicom.sequence.Sequence
+            ):
+                value = dcm.get(tag)
+                if value or value == 0:  # Some values are zero
+                    # Put the value in the header
+                    if (
+                        isinstance(value, str) and len(value) < 10240
+                    ):  # Max pydicom field length
+                        header[tag] = format_string(value)
+                    else:
+                        header[tag] = assign_type(value)
+                else:
+                    not_found_tags.append(tag)
+
+            if type(dcm.get(tag)) == pydicom.sequence.Sequence:
+                seq_data = get_seq_data(dcm.get(tag), exclude_tags)
+                # Check that the sequence is not empty
+                if seq_data:
+                    header[tag] = seq_data
+        except:
+            log.info("An exception was raised when getting tag %s", tag, exc_info=True)
+            pass
+    log.debug("Couldn't find values for tags: " + str(not_found_tags))
+    return header
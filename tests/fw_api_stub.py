@@ -0,0 +1,142 @@
+"""Local stand-in for the few Flywheel API endpoints used by GRP-3
+
+Serves the endpoints used by the SDK client initialization and by
+utils/update_file_info.py over plain HTTP, with configurable latency, injection of
+failures (e.g. 504 to exercise the backoff) and large container payloads. A
+flywheel.Client is connected to it with `FlywheelApiStub.api_key`.
+"""
+import copy
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+FILE_INFO_RE = re.compile(r'^/api/containers/(?P<cid>[^/]+)/files/(?P<name>.+)/info$')
+CONTAINER_RE = re.compile(r'^/api/(?P<type>containers|acquisitions|sessions|subjects|projects)/(?P<cid>[^/]+)$')
+
+
+class FlywheelApiStub:
+    """Flywheel API stand-in running in a background thread
+
+    Args:
+        latency (float): Seconds each request is delayed by.
+        fail_first (int): Number of file/container requests answered with failure_status
+            before the stub starts to answer normally.
+        failure_status (int): HTTP status of the injected failures.
+        container_file_count (int): Number of extra files listed in container payloads.
+        container_file_info_size (int): Approximate size in bytes of the info of each of
+            these extra files.
+    """
+
+    def __init__(self, latency=0.0, fail_first=0, failure_status=504, container_file_count=0,
+                 container_file_info_size=1024):
+        self.latency = latency
+        self.fail_first = fail_first
+        self.failure_status = failure_status
+        self.container_file_count = container_file_count
+        self.container_file_info_size = container_file_info_size
+        self.files = dict()
+        self.request_log = list()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def api_key(self):
+        return f'localhost:{self.port}:__force_insecure:stub-api-key'
+
+    def add_file(self, parent_id, file_dict):
+        """Adds file_dict to the files of container parent_id"""
+        self.files.setdefault(parent_id, dict())[file_dict['name']] = copy.deepcopy(file_dict)
+
+    def api_time(self):
+        """Returns the total time spent serving requests, in seconds"""
+        return sum(entry['duration'] for entry in self.request_log)
+
+    def start(self):
+        self._server = ThreadingHTTPServer(('localhost', 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _take_failure(self):
+        with self._lock:
+            if self.fail_first > 0:
+                self.fail_first -= 1
+                return True
+            return False
+
+    def _container_payload(self, container_type, cid):
+        files = list(self.files.get(cid, {}).values())
+        padding = 'x' * self.container_file_info_size
+        for i in range(self.container_file_count):
+            files.append({'name': f'file_{i}.dcm', 'type': 'dicom', 'modality': 'MR', 'info': {'padding': padding}})
+        if container_type == 'containers':
+            container_type = 'acquisitions'
+        return {'_id': cid, 'id': cid, 'container_type': container_type[:-1], 'label': cid, 'files': files}
+
+    def _route(self, path):
+        """Returns the (status, payload) response to GET path"""
+        if path == '/api/auth/status':
+            return 200, {'origin': {'type': 'user', 'id': 'stub@flywheel.io'}, 'user_is_admin': False,
+                         'is_device': False}
+        if path == '/api/version':
+            return 200, {'database': 70, 'release': '11.0.0', 'flywheel_release': '11.0.0'}
+        if path == '/api/config':
+            return 200, {}
+        file_match = FILE_INFO_RE.match(path)
+        container_match = CONTAINER_RE.match(path)
+        if not file_match and not container_match:
+            return 404, {'message': f'{path} not found'}
+        if self._take_failure():
+            return self.failure_status, {'message': 'Injected failure'}
+        if file_match:
+            file_dict = self.files.get(file_match['cid'], {}).get(unquote(file_match['name']))
+            if file_dict is None:
+                return 404, {'message': 'File not found'}
+            return 200, file_dict
+        return 200, self._container_payload(container_match['type'], container_match['cid'])
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                start = time.perf_counter()
+                if stub.latency:
+                    time.sleep(stub.latency)
+                path = urlparse(self.path).path
+                status, payload = stub._route(path)
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with stub._lock:
+                    stub.request_log.append({
+                        'path': path, 'status': status, 'bytes': len(body),
+                        'duration': time.perf_counter() - start
+                    })
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
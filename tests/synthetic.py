@@ -0,0 +1,202 @@
+"""Generator of synthetic DICOM archives for tests and benchmarks
+
+make_synthetic_archive builds a zip of MR slices with a realistic geometry, optionally
+with several series, an embedded localizer, missing slices, Siemens CSA headers,
+enhanced multi-frame files and zero-byte members. Datasets are generated from scratch
+and written straight to the archive, so large archives are quick to build.
+"""
+import io
+import struct
+import zipfile
+
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4'
+ENHANCED_MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4.1'
+AXIAL_ORIENTATION = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+SAGITTAL_ORIENTATION = [0.0, 1.0, 0.0, 0.0, 0.0, -1.0]
+SLICE_THICKNESS = 2.0
+# UID root of the generated UIDs, so that they are deterministic for a given seed
+UID_ROOT = '1.2.826.0.1.3680043.8.498.'
+
+
+def make_csa_header(tags):
+    """Returns a CSA2 header holding tags, a {name: (vr, list of values)} dictionary"""
+    csa = [b'SV10', b'\x04\x03\x02\x01', struct.pack('<2I', len(tags), 77)]
+    for name, (vr, values) in tags.items():
+        csa.append(struct.pack('<64si4s3i', name.encode(), len(values), vr.encode(), 0, len(values), 77))
+        for value in values:
+            item = str(value).encode() + b'\x00'
+            csa.append(struct.pack('<4i', len(item), len(item), 77, len(item)))
+            csa.append(item + b'\x00' * (-len(item) % 4))
+    return b''.join(csa)
+
+
+class SyntheticSeries:
+    """Parameters of a synthetic series and the generation of its datasets"""
+
+    def __init__(self, study_uid, series_number, rng, rows, columns, siemens_csa):
+        self.study_uid = study_uid
+        self.series_uid = generate_uid(UID_ROOT, [study_uid, str(series_number)])
+        self.frame_of_reference_uid = generate_uid(UID_ROOT, [self.series_uid, 'frame'])
+        self.series_number = series_number
+        self.rng = rng
+        self.rows = rows
+        self.columns = columns
+        self.siemens_csa = siemens_csa
+
+    def make_dataset(self, instance_number, sop_class_uid=MR_IMAGE_STORAGE):
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = sop_class_uid
+        sop_instance_uid = generate_uid(UID_ROOT, [self.series_uid, str(instance_number), sop_class_uid])
+        file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds = FileDataset(None, {}, file_meta=file_meta, preamble=b'\x00' * 128)
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.SOPClassUID = sop_class_uid
+        ds.SOPInstanceUID = sop_instance_uid
+        ds.StudyInstanceUID = self.study_uid
+        ds.SeriesInstanceUID = self.series_uid
+        ds.FrameOfReferenceUID = self.frame_of_reference_uid
+        ds.Modality = 'MR'
+        ds.Manufacturer = 'SIEMENS' if self.siemens_csa else 'GRP3'
+        ds.PatientName = 'Synthetic^Subject'
+        ds.PatientID = 'synthetic'
+        ds.PatientSex = 'O'
+        ds.PatientAge = '042Y'
+        ds.PatientWeight = '70'
+        ds.StudyDate = ds.SeriesDate = ds.AcquisitionDate = '20200101'
+        ds.StudyTime = ds.SeriesTime = ds.AcquisitionTime = '120000.000000'
+        ds.StudyID = '1'
+        ds.SeriesNumber = self.series_number
+        ds.SeriesDescription = f'synthetic_{self.series_number}'
+        ds.InstanceNumber = instance_number
+        ds.SequenceName = '*tfl3d1'
+        ds.RepetitionTime = '2300'
+        ds.EchoTime = '2.98'
+        ds.SliceThickness = str(SLICE_THICKNESS)
+        ds.PixelSpacing = ['1.0', '1.0']
+        ds.Rows = self.rows
+        ds.Columns = self.columns
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = 16
+        ds.BitsStored = 12
+        ds.HighBit = 11
+        ds.PixelRepresentation = 0
+        return ds
+
+    def pixel_data(self, frame_count=1):
+        shape = (frame_count, self.rows, self.columns)
+        return self.rng.integers(0, 4096, size=shape, dtype=np.uint16).tobytes()
+
+    def add_csa_header(self, ds, slice_index):
+        ds.private_block(0x0029, 'SIEMENS CSA HEADER', create=True).add_new(0x10, 'OB', make_csa_header({
+            'SliceMeasurementDuration': ('DS', ['1000.0']),
+            'NumberOfImagesInMosaic': ('US', ['1']),
+            'SlicePosition_PCS': ('FD', [0.0, 0.0, slice_index * SLICE_THICKNESS]),
+            'ImaCoilString': ('LO', ['HEA;HEP']),
+        }))
+
+    def make_slice(self, instance_number, slice_index, localizer=False):
+        ds = self.make_dataset(instance_number)
+        if localizer:
+            ds.ImageType = ['ORIGINAL', 'PRIMARY', 'LOCALIZER', 'NONE']
+            ds.ImageOrientationPatient = SAGITTAL_ORIENTATION
+            ds.ImagePositionPatient = [slice_index * SLICE_THICKNESS, -100.0, 100.0]
+            ds.SliceLocation = str(slice_index * SLICE_THICKNESS)
+        else:
+            ds.ImageType = ['ORIGINAL', 'PRIMARY', 'M', 'ND']
+            ds.ImageOrientationPatient = AXIAL_ORIENTATION
+            ds.ImagePositionPatient = [-100.0, -100.0, slice_index * SLICE_THICKNESS]
+            ds.SliceLocation = str(slice_index * SLICE_THICKNESS)
+        if self.siemens_csa:
+            self.add_csa_header(ds, slice_index)
+        ds.PixelData = self.pixel_data()
+        return ds
+
+    def make_enhanced_multiframe(self, instance_number, frame_count):
+        ds = self.make_dataset(instance_number, ENHANCED_MR_IMAGE_STORAGE)
+        ds.ImageType = ['ORIGINAL', 'PRIMARY', 'M', 'NONE']
+        ds.NumberOfFrames = frame_count
+        shared = Dataset()
+        orientation = Dataset()
+        orientation.ImageOrientationPatient = AXIAL_ORIENTATION
+        shared.PlaneOrientationSequence = Sequence([orientation])
+        ds.SharedFunctionalGroupsSequence = Sequence([shared])
+        per_frame = list()
+        for frame_index in range(frame_count):
+            frame = Dataset()
+            position = Dataset()
+            position.ImagePositionPatient = [-100.0, -100.0, frame_index * SLICE_THICKNESS]
+            frame.PlanePositionSequence = Sequence([position])
+            content = Dataset()
+            content.InStackPositionNumber = frame_index + 1
+            content.StackID = '1'
+            frame.FrameContentSequence = Sequence([content])
+            per_frame.append(frame)
+        ds.PerFrameFunctionalGroupsSequence = Sequence(per_frame)
+        ds.PixelData = self.pixel_data(frame_count)
+        return ds
+
+
+def to_bytes(ds):
+    buffer = io.BytesIO()
+    pydicom.dcmwrite(buffer, ds, write_like_original=False)
+    return buffer.getvalue()
+
+
+def make_synthetic_archive(zip_path, slice_count=10, series_count=1, localizer_count=0, missing_slices=0,
+                           siemens_csa=False, enhanced_multiframe_frames=0, zero_byte_members=0, rows=64,
+                           columns=64, seed=0, compression=zipfile.ZIP_DEFLATED):
+    """Writes a synthetic DICOM archive to zip_path and returns zip_path
+
+    Args:
+        zip_path (str): Path of the archive to write.
+        slice_count (int): Number of slices of each series.
+        series_count (int): Number of series (distinct SeriesInstanceUID).
+        localizer_count (int): Number of localizer slices embedded in the first series,
+            with a different ImageOrientationPatient.
+        missing_slices (int): Number of slices left out of the middle of each series.
+        siemens_csa (bool): Add a Siemens CSA image header to the slices.
+        enhanced_multiframe_frames (int): If not 0, add an enhanced multi-frame file
+            with this many frames to the first series.
+        zero_byte_members (int): Number of empty members.
+        rows (int): Rows of the images.
+        columns (int): Columns of the images.
+        seed (int): Seed of the generated pixel data and UIDs.
+        compression (int): Compression of the members.
+
+    Returns:
+        str: zip_path
+    """
+    rng = np.random.default_rng(seed)
+    study_uid = generate_uid(UID_ROOT, ['study', str(seed)])
+    missing_start = (slice_count - missing_slices) // 2
+    missing = set(range(missing_start, missing_start + missing_slices))
+    with zipfile.ZipFile(zip_path, 'w', compression) as zipf:
+        for series_index in range(series_count):
+            series = SyntheticSeries(study_uid, series_index + 1, rng, rows, columns, siemens_csa)
+            instance_number = 1
+            for slice_index in range(slice_count):
+                if slice_index in missing:
+                    continue
+                ds = series.make_slice(instance_number, slice_index)
+                zipf.writestr(f'series_{series.series_number}/{instance_number:05d}.dcm', to_bytes(ds))
+                instance_number += 1
+            if series_index == 0:
+                for localizer_index in range(localizer_count):
+                    ds = series.make_slice(instance_number, localizer_index - localizer_count // 2, localizer=True)
+                    zipf.writestr(f'series_{series.series_number}/{instance_number:05d}.dcm', to_bytes(ds))
+                    instance_number += 1
+                if enhanced_multiframe_frames:
+                    ds = series.make_enhanced_multiframe(instance_number, enhanced_multiframe_frames)
+                    zipf.writestr(f'series_{series.series_number}/{instance_number:05d}.dcm', to_bytes(ds))
+        for index in range(zero_byte_members):
+            zipf.writestr(f'empty_{index}.dcm', b'')
+    return zip_path
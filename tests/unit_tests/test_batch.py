@@ -0,0 +1,79 @@
+import json
+import os
+import tempfile
+import zipfile
+
+import pydicom
+import pytest
+from pydicom.data import get_testdata_files
+
+from batch import BATCH_SUMMARY_NAME, list_archives, run_batch
+
+
+def make_archive(zip_path, patient_id):
+    dcm = pydicom.dcmread(get_testdata_files('MR_small.dcm')[0])
+    dcm.PatientID = patient_id
+    slice_path = zip_path + '.dcm'
+    dcm.save_as(slice_path)
+    with zipfile.ZipFile(zip_path, 'w') as zipf:
+        zipf.write(slice_path, '0.dcm')
+    os.remove(slice_path)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_run_batch(workers):
+    with tempfile.TemporaryDirectory() as tempdir:
+        input_dir = os.path.join(tempdir, 'input')
+        os.makedirs(os.path.join(input_dir, 'sub'))
+        make_archive(os.path.join(input_dir, 'a.dicom.zip'), 'a')
+        make_archive(os.path.join(input_dir, 'sub', 'a.dicom.zip'), 'b')
+        # Empty archives cannot be processed
+        open(os.path.join(input_dir, 'empty.dicom.zip'), 'w').close()
+
+        archive_paths, root_dir = list_archives(input_dir)
+        assert len(archive_paths) == 3
+        output_dir = os.path.join(tempdir, 'output')
+        template = {'properties': {'Modality': {'enum': ['CT']}}}
+        summary = run_batch(archive_paths, root_dir, output_dir, template=template, timezone_name='UTC',
+                            workers=workers)
+
+        assert summary['counts'] == {'valid': 0, 'invalid': 2, 'failed': 1}
+        with open(os.path.join(output_dir, BATCH_SUMMARY_NAME)) as fp:
+            assert json.load(fp)['counts'] == summary['counts']
+        # Metadata and error files are side by side, mirroring the input layout
+        for relative_dir in ('', 'sub'):
+            metadata_path = os.path.join(output_dir, relative_dir, 'a.dicom.zip.metadata.json')
+            with open(metadata_path) as fp:
+                assert json.load(fp)['acquisition']['tags'] == ['error']
+            assert os.path.exists(os.path.join(output_dir, relative_dir, 'a.dicom.zip.error.log.json'))
+            with open(os.path.join(output_dir, relative_dir, 'a.dicom.zip.metrics.json')) as fp:
+                assert json.load(fp)['stages']['extract']['members'] == 1
+        failed = [result for result in summary['archives'] if result['status'] == 'failed']
+        assert failed[0]['path'].endswith('empty.dicom.zip')
+        assert failed[0]['error_path'] == os.path.join(output_dir, 'empty.dicom.zip.error.log.json')
+
+
+def test_list_archives_from_manifest():
+    with tempfile.TemporaryDirectory() as tempdir:
+        manifest_path = os.path.join(tempdir, 'manifest.txt')
+        with open(manifest_path, 'w') as fp:
+            fp.write('a/1.zip\n\na/b/2.zip\n')
+        archive_paths, root_dir = list_archives(manifest_path)
+        assert archive_paths == [os.path.join(tempdir, 'a/1.zip'), os.path.join(tempdir, 'a/b/2.zip')]
+        assert root_dir == os.path.join(tempdir, 'a')
+
+        with open(manifest_path, 'w') as fp:
+            json.dump(['/data/1.zip'], fp)
+        assert list_archives(manifest_path) == (['/data/1.zip'], '/data')
+
+
+def test_list_archives_of_every_format():
+    with tempfile.TemporaryDirectory() as tempdir:
+        for name in ('a.dicom.zip', 'b.tar', 'c.tar.gz', 'd.tgz', 'e.tar.bz2', 'f.tar.xz', 'g.txt'):
+            open(os.path.join(tempdir, name), 'w').close()
+        archive_paths, _ = list_archives(tempdir)
+        assert [os.path.basename(path) for path in archive_paths] == [
+            'a.dicom.zip', 'b.tar', 'c.tar.gz', 'd.tgz', 'e.tar.bz2', 'f.tar.xz'
+        ]
+        archive_paths, _ = list_archives(tempdir, '*.zip')
+        assert [os.path.basename(path) for path in archive_paths] == ['a.dicom.zip']
@@ -0,0 +1,39 @@
+import math
+
+from utils.deadline import Deadline
+
+
+class FakeClock:
+    """Clock advanced by hand"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_unlimited_deadline():
+    deadline = Deadline()
+    assert deadline.remaining() == math.inf
+    assert not deadline.expired()
+    assert deadline.allows('csa_header')
+    assert deadline.get_error_dict() is None
+    assert Deadline(0).budget is None
+
+
+def test_spent_deadline():
+    clock = FakeClock()
+    deadline = Deadline(0.01, clock=clock)
+    assert deadline.allows('csa_header')
+    clock.now = 0.02
+    assert deadline.expired()
+    assert deadline.remaining() < 0
+    assert not deadline.allows('csa_header')
+    assert not deadline.allows('full_sequences')
+    assert not deadline.allows('csa_header')
+    assert deadline.skipped == ['csa_header', 'full_sequences']
+    assert deadline.get_error_dict() == {
+        'error_message': 'Time budget of 0.01 s exceeded, skipped checks: csa_header, full_sequences',
+        'revalidate': False
+    }
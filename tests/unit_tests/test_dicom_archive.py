@@ -1,13 +1,23 @@
+import hashlib
 import os
 import pathlib
+import tarfile
 import tempfile
 import zipfile
+import zlib
 from unittest.mock import MagicMock
 
 import numpy as np
 import pytest
 from pydicom.data import get_testdata_files
 
+from utils.dicom.archive_reader import (
+    extract_archive_members,
+    extract_member,
+    get_archive_format,
+    get_member_path,
+    get_zip_name,
+)
 from utils.dicom.dicom_archive import DicomArchive
 
 
@@ -86,3 +96,82 @@ def test_dicom_tag_value_dict(mocker):
     assert list(rounded.keys()) == [
         tuple(o) for o in np.unique(np.array(out), axis=0).tolist()
     ]
+
+
+def test_extract_member():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        zip_path = os.path.join(temp_dir, "test.zip")
+        with zipfile.ZipFile(zip_path, "w") as zip_obj:
+            zip_obj.writestr("dir/a.dcm", b"spam")
+            zip_obj.writestr("../b.dcm", b"eggs")
+            zip_obj.writestr("empty_dir/", b"")
+        extract_dir = os.path.join(temp_dir, "extract")
+        with zipfile.ZipFile(zip_path) as zip_obj:
+            results = [
+                extract_member(zip_obj, zip_info, extract_dir)
+                for zip_info in zip_obj.infolist()
+            ]
+        assert results == [
+            (os.path.join(extract_dir, "dir", "a.dcm"), hashlib.sha256(b"spam").hexdigest()),
+            (os.path.join(extract_dir, "b.dcm"), hashlib.sha256(b"eggs").hexdigest()),
+            (os.path.join(extract_dir, "empty_dir"), None),
+        ]
+        with open(results[0][0], "rb") as fp:
+            assert fp.read() == b"spam"
+        assert os.path.isdir(results[2][0])
+
+
+def test_extract_archive_members():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        zip_path = os.path.join(temp_dir, "test.zip")
+        with zipfile.ZipFile(zip_path, "w") as zip_obj:
+            zip_obj.writestr("b/2.dcm", b"spam")
+            zip_obj.writestr("a.dcm", b"first")
+            zip_obj.writestr("empty_dir/", b"")
+            zip_obj.writestr("./a.dcm", b"last")
+        extract_dir = os.path.join(temp_dir, "extract")
+        members = extract_archive_members(zip_path, extract_dir)
+        # Sorted by path, the last member extracted to a path wins
+        assert [member.name for member in members] == ["./a.dcm", "b/2.dcm"]
+        assert members[0].size == 4
+        assert members[0].digest == hashlib.sha256(b"last").hexdigest()
+        with open(get_member_path(extract_dir, members[0].name), "rb") as fp:
+            assert fp.read() == b"last"
+
+
+def test_extract_archive_members_of_tar_and_nested_zips():
+    contents = {"series1/1.dcm": b"spam", "series2/1.dcm": b"eggs"}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # A tar.gz of a zip per series, next to a file named like a zip which is not one
+        tar_path = os.path.join(temp_dir, "test.dicom.tar.gz")
+        with tarfile.open(tar_path, "w:gz") as tar_obj:
+            for name, content in contents.items():
+                series, slice_name = name.split("/")
+                zip_path = os.path.join(temp_dir, f"{series}.zip")
+                with zipfile.ZipFile(zip_path, "w") as zip_obj:
+                    zip_obj.writestr(slice_name, content)
+                tar_obj.add(zip_path, f"{series}.zip")
+            fake_zip_path = os.path.join(temp_dir, "fake.zip")
+            with open(fake_zip_path, "wb") as fp:
+                fp.write(b"ham")
+            tar_obj.add(fake_zip_path, "fake.zip")
+        assert get_archive_format(tar_path) == "tar"
+        assert get_archive_format(zip_path) == "zip"
+        assert get_archive_format(fake_zip_path) is None
+
+        extract_dir = os.path.join(temp_dir, "extract")
+        members = extract_archive_members(tar_path, extract_dir)
+        assert [member.name for member in members] == [
+            "fake.zip",
+            "series1.zip/1.dcm",
+            "series2.zip/1.dcm",
+        ]
+        # Members of nested zips have a CRC, members of the tar do not
+        assert members[0].crc is None
+        assert members[1].crc == zlib.crc32(b"spam")
+        for member, content in zip(members[1:], contents.values()):
+            assert member.digest == hashlib.sha256(content).hexdigest()
+            with open(get_member_path(extract_dir, member.name), "rb") as fp:
+                assert fp.read() == content
+        assert get_zip_name(os.path.basename(tar_path)) == "test.dicom.zip"
+        assert get_zip_name("test.dicom.zip") == "test.dicom.zip"
@@ -17,6 +17,9 @@ from run import (
     fix_type_based_on_dicom_vm,
     get_pydicom_header,
     fix_VM1_callback,
+    get_sequence_policy,
+    SequencePolicy,
+    UNBOUNDED_SEQUENCE_POLICY,
 )
 
 
@@ -62,6 +65,61 @@ def test_get_seq_data():
     assert "DimensionOrganizationUID" in res[0]["DimensionIndexSequence"][0]
 
 
+def test_get_seq_data_sequence_policy():
+    test_dicom_path = get_testdata_files("liver.dcm")[0]
+    dcm = pydicom.read_file(test_dicom_path)
+    dcm.decode()
+    sequence = dcm.get("PerFrameFunctionalGroupsSequence")
+    unbounded = get_seq_data(sequence, [])
+    assert get_seq_data(sequence, [], UNBOUNDED_SEQUENCE_POLICY) == unbounded
+
+    res = get_seq_data(sequence, [], SequencePolicy(2, 0, 0, 0))
+    assert res == unbounded[:2]
+
+    res = get_seq_data(sequence, [], SequencePolicy(0, 1, 0, 0))
+    assert len(res) == len(unbounded)
+    assert res[0] == {}  # items of PerFrameFunctionalGroupsSequence only hold sequences
+    res = get_seq_data(sequence, [], SequencePolicy(0, 2, 0, 0))
+    assert res[0]["FrameContentSequence"] == unbounded[0]["FrameContentSequence"]
+    # sequences nested in DerivationImageSequence items are dropped
+    assert res[0]["DerivationImageSequence"] == [{}]
+
+    res = get_seq_data(sequence, [], SequencePolicy(0, 0, 10, 0))
+    assert "DimensionIndexValues" in res[0]["FrameContentSequence"][0]
+    assert "ReferencedSOPInstanceUID" not in (
+        res[0]["DerivationImageSequence"][0]["SourceImageSequence"][0]
+    )
+
+
+def test_get_pydicom_header_summarizes_per_frame_groups():
+    test_dicom_path = get_testdata_files("liver.dcm")[0]
+    dcm = pydicom.read_file(test_dicom_path)
+    full_header = get_pydicom_header(dcm)
+    assert get_pydicom_header(dcm, get_sequence_policy({})) == full_header
+    # The gear default keeps the array, however many frames
+    many_frames_dcm = pydicom.read_file(test_dicom_path)
+    many_frames_dcm.PerFrameFunctionalGroupsSequence = (
+        list(many_frames_dcm.PerFrameFunctionalGroupsSequence) * 50
+    )
+    header = get_pydicom_header(many_frames_dcm, get_sequence_policy({}))
+    assert isinstance(header["PerFrameFunctionalGroupsSequence"], list)
+    assert len(header["PerFrameFunctionalGroupsSequence"]) == 150
+
+    header = get_pydicom_header(dcm, SequencePolicy(0, 0, 0, 3))
+    summary = header["PerFrameFunctionalGroupsSequence"]
+    assert summary["ItemCount"] == 3
+    groups = summary["FunctionalGroups"]
+    assert set(groups) == set(full_header["PerFrameFunctionalGroupsSequence"][0])
+    # identical functional groups are collapsed
+    assert groups["SegmentIdentificationSequence"] == [
+        {"Count": 3, "Value": full_header["PerFrameFunctionalGroupsSequence"][0]["SegmentIdentificationSequence"]}
+    ]
+    assert [el["Count"] for el in groups["PlanePositionSequence"]] == [1, 1, 1]
+    for key, value in header.items():
+        if key != "PerFrameFunctionalGroupsSequence":
+            assert full_header[key] == value
+
+
 def test_fix_type_based_on_dicom_vm(caplog):
     header = {"ImageType": "Localizer"}
     fix_type_based_on_dicom_vm(header)
@@ -0,0 +1,104 @@
+import os
+import tempfile
+import zipfile
+
+import pydicom
+from pydicom.data import get_testdata_files
+
+from run import split_seriesinstanceUID
+from utils.dicom.archive_reader import extract_archive_members
+from utils.dicom.dicom_archive import DicomArchive
+from utils.dicom.dicomdir import plan_members, read_dicomdir_records
+
+DICOMDIR_PATH = get_testdata_files('DICOMDIR')[0]
+DICOMDIR_ROOT = os.path.dirname(DICOMDIR_PATH)
+
+
+def get_export_files():
+    """Returns the paths, relative to DICOMDIR_ROOT, of the files listed in DICOMDIR"""
+    return sorted(
+        os.path.relpath(os.path.join(dir_path, name), DICOMDIR_ROOT)
+        for dir_path, _, names in os.walk(DICOMDIR_ROOT)
+        for name in names
+        if not name.startswith('DICOMDIR') and not name.endswith('.txt')
+    )
+
+
+def make_export_zip(tempdir, with_dicomdir=True, contents=None):
+    """Zips the pydicom DICOMDIR test export under export/, contents overriding the
+    content of files by relative path"""
+    zip_path = os.path.join(tempdir, 'export.dicom.zip' if with_dicomdir else 'no_dicomdir.dicom.zip')
+    with zipfile.ZipFile(zip_path, 'w') as zipf:
+        if with_dicomdir:
+            zipf.write(DICOMDIR_PATH, 'export/DICOMDIR')
+        for file_path in get_export_files():
+            if contents and file_path in contents:
+                zipf.writestr(f'export/{file_path}', contents[file_path])
+            else:
+                zipf.write(os.path.join(DICOMDIR_ROOT, file_path), f'export/{file_path}')
+    return zip_path
+
+
+def test_read_dicomdir_records():
+    records = read_dicomdir_records(DICOMDIR_PATH)
+    assert len(records) == len(get_export_files())
+    record = records[('77654033', 'cr1', '6154')]
+    dataset = pydicom.dcmread(os.path.join(DICOMDIR_ROOT, '77654033', 'CR1', '6154'), stop_before_pixels=True)
+    for keyword in ('SeriesInstanceUID', 'SOPInstanceUID', 'Modality'):
+        assert record[keyword] == dataset.get(keyword)
+    # Records walked along their offsets, whatever their order
+    assert read_dicomdir_records(os.path.join(DICOMDIR_ROOT, 'DICOMDIR-reordered')) == records
+
+
+def test_plan_members():
+    with tempfile.TemporaryDirectory() as tempdir:
+        extract_dir = os.path.join(tempdir, 'extract')
+        members = extract_archive_members(make_export_zip(tempdir), extract_dir)
+        plan = plan_members(members, extract_dir)
+        assert sorted(plan) == [f'export/{file_path}' for file_path in get_export_files()]
+
+        # A file missing from the DICOMDIR
+        assert plan_members(members + [members[0]._replace(name='export/extra.dcm')], extract_dir) is None
+        # A file listed in the DICOMDIR missing from the archive
+        assert plan_members(members[:-1], extract_dir) is None
+
+
+def test_plan_members_falls_back_on_disagreement():
+    file_path = get_export_files()[0]
+    dataset = pydicom.dcmread(os.path.join(DICOMDIR_ROOT, file_path))
+    dataset.SeriesInstanceUID = dataset.SeriesInstanceUID + '.1'
+    with tempfile.TemporaryDirectory() as tempdir:
+        modified_path = os.path.join(tempdir, 'modified.dcm')
+        dataset.save_as(modified_path)
+        with open(modified_path, 'rb') as fp:
+            zip_path = make_export_zip(tempdir, contents={file_path: fp.read()})
+        archive = DicomArchive(
+            zip_path, os.path.join(tempdir, 'extract'), dataset_list=True, use_dicomdir=True
+        )
+        assert archive.dicomdir_plan is None
+        # Every member read, but the DICOMDIR
+        assert len(archive.dataset_list) == len(get_export_files())
+
+        output_dir = os.path.join(tempdir, 'output')
+        os.makedirs(output_dir)
+        split_plan = split_seriesinstanceUID(zip_path, output_dir)
+        for path in split_plan['outputs']:
+            with zipfile.ZipFile(path) as zipf:
+                assert 'export/DICOMDIR' not in zipf.namelist()
+
+
+def test_split_seriesinstanceUID_with_dicomdir():
+    with tempfile.TemporaryDirectory() as tempdir:
+        split_members = []
+        for with_dicomdir in (True, False):
+            output_dir = os.path.join(tempdir, f'output_{with_dicomdir}')
+            os.makedirs(output_dir)
+            split_plan = split_seriesinstanceUID(make_export_zip(tempdir, with_dicomdir), output_dir)
+            members = set()
+            for path in split_plan['outputs']:
+                with zipfile.ZipFile(path) as zipf:
+                    members.add(tuple(sorted(zipf.namelist())))
+            split_members.append(members)
+        # Same split as from the headers of every member, the DICOMDIR left out
+        assert split_members[0] == split_members[1]
+        assert all('export/DICOMDIR' not in names for names in split_members[0])
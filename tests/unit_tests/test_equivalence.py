@@ -0,0 +1,48 @@
+import json
+import math
+
+from pydicom.data import get_testdata_files
+
+import run
+from tests.equivalence.check_equivalence import (
+    DEFAULT_TEMPLATE_PATH,
+    MISSING,
+    build_corpus,
+    check_equivalence,
+    compare_headers,
+    compare_split,
+    diff_values,
+)
+
+
+def test_diff_values():
+    assert list(diff_values({'a': [1.0, 'x'], 'b': {'c': 1}}, {'a': [1.0, 'x'], 'b': {'c': 1}})) == []
+    assert list(diff_values({'a': 1}, {'a': 1.0})) == [('a', 1, 1.0)]
+    assert list(diff_values({'a': [1, 2]}, {'a': [1, 3]})) == [('a[1]', 2, 3)]
+    assert list(diff_values({'a': [1, 2]}, {'a': [1]})) == [('a', [1, 2], [1])]
+    assert list(diff_values({'a': 1}, {'b': 1})) == [('a', 1, MISSING), ('b', MISSING, 1)]
+    assert list(diff_values(math.nan, math.nan)) == []
+
+
+def test_check_equivalence_corpus(tmpdir):
+    corpus = build_corpus(str(tmpdir), size=10)
+    with open(DEFAULT_TEMPLATE_PATH) as fp:
+        template = json.load(fp)
+
+    assert check_equivalence(corpus, run.validate_timezone(None), template) == []
+
+
+def test_divergences_are_reported(tmpdir, monkeypatch):
+    assign_type = run.assign_type
+    monkeypatch.setattr(run, 'assign_type', lambda s: str(assign_type(s)))
+    divergences = compare_headers('MR_small', get_testdata_files('MR_small.dcm')[0])
+    assert divergences
+    assert {divergence.kind for divergence in divergences} == {'header'}
+    echo_time = [divergence for divergence in divergences if divergence.path == 'EchoTime'][0]
+    assert echo_time.reference == 240.0
+    assert echo_time.candidate == '240.0'
+
+    corpus = dict(build_corpus(str(tmpdir), size=10))
+    monkeypatch.setattr(run, 'split_seriesinstanceUID', lambda *args, **kwargs: None)
+    divergences = compare_split('multi_series', corpus['multi_series'])
+    assert {divergence.kind for divergence in divergences} == {'split.split_seriesinstanceUID'}
@@ -0,0 +1,163 @@
+import hashlib
+import os
+import tarfile
+import tempfile
+import time
+import zipfile
+
+import pydicom
+from pydicom.data import get_testdata_files
+
+import run
+from run import dicom_to_json, get_header_cache, run_pipeline, validate_timezone
+from tests.synthetic import make_synthetic_archive
+from tests.unit_tests.test_deadline import FakeClock
+from utils.deadline import Deadline
+from utils.header_cache import HeaderCache
+
+
+def test_header_cache_put_get():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = HeaderCache(cache_dir, namespace='test')
+        key = cache.digest_key('1234')
+        assert cache.get(key) is None
+        record = {'pydicom_exception': False, 'header': {'Modality': 'MR', 'EchoNumbers': [1.0]}}
+        cache.put(key, record)
+        assert cache.get(key) == record
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        # keys are namespaced
+        other_cache = HeaderCache(cache_dir, namespace='other')
+        assert other_cache.digest_key('1234') != key
+        assert other_cache.get(other_cache.digest_key('1234')) is None
+
+
+def test_header_cache_file_key_is_content_addressed():
+    test_dicom_path = get_testdata_files('MR_small.dcm')[0]
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = HeaderCache(cache_dir)
+        copy_path = os.path.join(cache_dir, 'copy.dcm')
+        with open(test_dicom_path, 'rb') as src, open(copy_path, 'wb') as dst:
+            dst.write(src.read())
+        assert cache.file_key(test_dicom_path) == cache.file_key(copy_path)
+        with open(test_dicom_path, 'rb') as fp:
+            assert cache.file_key(test_dicom_path) == cache.digest_key(hashlib.sha256(fp.read()).hexdigest())
+
+
+def test_header_cache_prune_evicts_least_recently_used():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = HeaderCache(cache_dir, max_bytes=250)
+        keys = [cache.digest_key(str(i)) for i in range(3)]
+        for i, key in enumerate(keys):
+            cache.put(key, {'header': {'value': 'x' * 80}})
+            # Make access times deterministic
+            os.utime(cache._record_path(key), (time.time() + i, time.time() + i))
+        # Touch the oldest record so that keys[1] becomes the least recently used
+        os.utime(cache._record_path(keys[0]), (time.time() + 10, time.time() + 10))
+
+        assert cache.prune() == 1
+        assert cache.get(keys[1]) is None
+        assert cache.get(keys[0]) is not None
+        assert cache.get(keys[2]) is not None
+
+
+def test_header_cache_prune_scans_only_over_budget(mocker):
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = HeaderCache(cache_dir, max_bytes=250)
+        evict = mocker.spy(cache, '_evict')
+        # Nothing written, nothing to do
+        assert cache.prune() == 0
+        assert evict.call_count == 0
+
+        record = {'header': {'value': 'x' * 80}}
+        cache.put(cache.digest_key('0'), record)
+        os.utime(cache._record_path(cache.digest_key('0')), (time.time() - 10, time.time() - 10))
+        # The size of the cache is unknown until scanned once
+        assert cache.prune() == 0
+        assert evict.call_count == 1
+        cache.put(cache.digest_key('1'), record)
+        assert cache.prune() == 0
+        assert evict.call_count == 1
+
+        # Another job sharing the cache goes past the budget
+        other_cache = HeaderCache(cache_dir, max_bytes=250)
+        other_cache.put(other_cache.digest_key('2'), record)
+        assert other_cache.prune() == 1
+        assert cache.get(cache.digest_key('0')) is None
+
+
+def test_get_header_cache_disabled():
+    assert get_header_cache('', 10) is None
+    assert get_header_cache(None, 10) is None
+
+
+def test_dicom_to_json_rerun_skips_parsing(mocker):
+    test_dicom_path = get_testdata_files('MR_small.dcm')[0]
+    with tempfile.TemporaryDirectory() as tempdir:
+        zip_path = os.path.join(tempdir, 'test.dicom.zip')
+        with zipfile.ZipFile(zip_path, 'w') as zipf:
+            for i in range(3):
+                dcm = pydicom.dcmread(test_dicom_path)
+                dcm.InstanceNumber = i
+                slice_path = os.path.join(tempdir, f'{i}.dcm')
+                dcm.save_as(slice_path)
+                zipf.write(slice_path, f'{i}.dcm')
+        outbase = os.path.join(tempdir, 'output') + os.path.sep
+        os.makedirs(outbase)
+        header_cache = get_header_cache(os.path.join(tempdir, 'cache'), 10)
+        timezone = validate_timezone(None)
+
+        dicom_to_json(zip_path, outbase, timezone, {}, header_cache=header_cache)
+        assert header_cache.misses == 3
+        with open(os.path.join(outbase, '.metadata.json')) as fp:
+            first_metadata = fp.read()
+
+        spy = mocker.spy(run, 'get_pydicom_header')
+        dicom_to_json(zip_path, outbase, timezone, {}, header_cache=header_cache)
+        assert header_cache.hits == 3
+        # Only the representative file is parsed
+        assert spy.call_count == 1
+        with open(os.path.join(outbase, '.metadata.json')) as fp:
+            assert fp.read() == first_metadata
+
+
+def test_dicom_to_json_keys_cache_on_extraction_digest(mocker):
+    test_dicom_path = get_testdata_files('MR_small.dcm')[0]
+    with tempfile.TemporaryDirectory() as tempdir:
+        tar_path = os.path.join(tempdir, 'test.dicom.tar')
+        with tarfile.open(tar_path, 'w') as tarf:
+            for i in range(11):
+                dcm = pydicom.dcmread(test_dicom_path)
+                dcm.InstanceNumber = i
+                slice_path = os.path.join(tempdir, f'{i}.dcm')
+                dcm.save_as(slice_path)
+                tarf.add(slice_path, f'{i}.dcm')
+        header_cache = get_header_cache(os.path.join(tempdir, 'cache'), 10)
+        timezone = validate_timezone(None)
+        file_key = mocker.spy(header_cache, 'file_key')
+
+        # Tar members and single files are keyed on the digest computed on extraction
+        for path in (tar_path, slice_path):
+            outbase = os.path.join(tempdir, os.path.basename(path) + '.output') + os.path.sep
+            os.makedirs(outbase)
+            for _ in range(2):
+                dicom_to_json(path, outbase, timezone, {}, header_cache=header_cache)
+        assert file_key.call_count == 0
+        # The single file has the content of the last tar member
+        assert (header_cache.hits, header_cache.misses) == (13, 11)
+
+
+def test_header_cache_pruned_when_deadline_spent(mocker):
+    with tempfile.TemporaryDirectory() as tempdir:
+        zip_path = make_synthetic_archive(os.path.join(tempdir, 'test.dicom.zip'), slice_count=10)
+        header_cache = get_header_cache(os.path.join(tempdir, 'cache'), 10)
+        prune = mocker.spy(header_cache, 'prune')
+        clock = FakeClock()
+        deadline = Deadline(1, clock=clock)
+        clock.now = 1
+
+        run_pipeline(zip_path, tempdir, header_cache=header_cache, deadline=deadline)
+        # The files left are not read, the cache is still pruned
+        assert 'file_headers' in deadline.skipped
+        assert header_cache.misses < 10
+        assert prune.call_count == 1
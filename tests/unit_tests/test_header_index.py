@@ -0,0 +1,110 @@
+import json
+import os
+import tempfile
+import zipfile
+
+import pydicom
+from pydicom.data import get_testdata_files
+
+import run
+from run import dicom_to_json, get_header_namespace, get_pydicom_header_before_pixels, validate_timezone
+from utils.dicom.dicom_archive import DicomArchive, create_zip_from_file_list
+from utils.dicom.header_index import HEADER_INDEX_COMMENT, HEADER_INDEX_MEMBER, read_header_index
+
+
+def make_two_series_zip(tempdir):
+    test_dicom_path = get_testdata_files('MR_small.dcm')[0]
+    zip_path = os.path.join(tempdir, 'test.dicom.zip')
+    with zipfile.ZipFile(zip_path, 'w') as zipf:
+        for i in range(5):
+            dcm = pydicom.dcmread(test_dicom_path)
+            dcm.InstanceNumber = i
+            dcm.SeriesDescription = 'test'
+            dcm.SOPInstanceUID = f'{dcm.SOPInstanceUID}.{i}'
+            if i == 4:
+                dcm.SeriesInstanceUID = dcm.SeriesInstanceUID + '.1'
+            slice_path = os.path.join(tempdir, f'{i}.dcm')
+            dcm.save_as(slice_path)
+            zipf.write(slice_path, f'{i}.dcm')
+    return zip_path
+
+
+def test_create_zip_from_file_list_header_index():
+    with tempfile.TemporaryDirectory() as tempdir:
+        file_paths = list()
+        for i in range(2):
+            file_path = os.path.join(tempdir, f'{i}.dcm')
+            with open(file_path, 'w') as fp:
+                fp.write(f'slice {i}')
+            file_paths.append(file_path)
+        header_dicts = {file_paths[0]: {'InstanceNumber': 0}, file_paths[1]: {'InstanceNumber': 1}}
+        zip_path = create_zip_from_file_list(
+            tempdir, file_paths, os.path.join(tempdir, 'out.zip'), header_dicts=header_dicts,
+            header_namespace='test'
+        )
+        with zipfile.ZipFile(zip_path) as zipf:
+            assert zipf.comment == HEADER_INDEX_COMMENT.encode('utf-8')
+            assert read_header_index(zipf, 'test') == {'0.dcm': {'InstanceNumber': 0}, '1.dcm': {'InstanceNumber': 1}}
+            # Headers extracted by a different version are not trusted
+            assert read_header_index(zipf, 'other') == {}
+
+        # Members whose CRC does not match the index are not trusted
+        with zipfile.ZipFile(zip_path) as zipf:
+            index = zipf.read(HEADER_INDEX_MEMBER)
+        tampered_path = os.path.join(tempdir, 'tampered.zip')
+        with zipfile.ZipFile(tampered_path, 'w') as zipf:
+            zipf.writestr('0.dcm', 'slice 0')
+            zipf.writestr('1.dcm', 'tampered')
+            zipf.writestr(HEADER_INDEX_MEMBER, index)
+        with zipfile.ZipFile(tampered_path) as zipf:
+            assert read_header_index(zipf, 'test') == {'0.dcm': {'InstanceNumber': 0}}
+
+        # comment is written when given
+        zip_path = create_zip_from_file_list(tempdir, file_paths, os.path.join(tempdir, 'out.zip'), comment='spam')
+        with zipfile.ZipFile(zip_path) as zipf:
+            assert zipf.comment == b'spam'
+            assert HEADER_INDEX_MEMBER not in zipf.namelist()
+
+
+def test_split_outputs_skip_header_parsing(mocker):
+    with tempfile.TemporaryDirectory() as tempdir:
+        zip_path = make_two_series_zip(tempdir)
+        split_dir = os.path.join(tempdir, 'split')
+        os.makedirs(split_dir)
+        with tempfile.TemporaryDirectory() as extract_dir:
+            archive = DicomArchive(
+                zip_path, extract_dir, dataset_list=True, header_func=get_pydicom_header_before_pixels,
+                header_namespace=get_header_namespace()
+            )
+            archive.split_archive_on_unique_tag('SeriesInstanceUID', split_dir, '', all_unique=True)
+        split_path = os.path.join(split_dir, 'test.dicom.zip')
+        with zipfile.ZipFile(split_path) as zipf:
+            assert HEADER_INDEX_MEMBER in zipf.namelist()
+
+        # Reference output parsing every member
+        reference_dir = os.path.join(tempdir, 'reference')
+        with tempfile.TemporaryDirectory() as extract_dir:
+            with zipfile.ZipFile(split_path) as zipf:
+                for name in zipf.namelist():
+                    if name != HEADER_INDEX_MEMBER:
+                        zipf.extract(name, extract_dir)
+            os.makedirs(reference_dir)
+            reference_zip = os.path.join(reference_dir, 'test.dicom.zip')
+            with zipfile.ZipFile(reference_zip, 'w') as zipf:
+                for name in sorted(os.listdir(extract_dir)):
+                    zipf.write(os.path.join(extract_dir, name), name)
+        timezone = validate_timezone(None)
+        reference_metadata = dicom_to_json(reference_zip, reference_dir + os.path.sep, timezone, {})
+        with open(reference_metadata) as fp:
+            expected = json.load(fp)
+
+        spy = mocker.spy(run, 'get_pydicom_header')
+        output_dir = os.path.join(tempdir, 'output')
+        os.makedirs(output_dir)
+        metadata_path = dicom_to_json(split_path, output_dir + os.path.sep, timezone, {})
+        # Only the representative file is parsed
+        assert spy.call_count == 1
+        with open(metadata_path) as fp:
+            assert json.load(fp) == expected
+        # The index member is not reported as a non-DICOM file
+        assert not os.path.exists(os.path.join(output_dir, 'test.dicom.zip.error.log.json'))
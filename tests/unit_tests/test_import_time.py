@@ -0,0 +1,7 @@
+from tests.benchmarks.bench_import_time import time_import
+
+
+def test_run_does_not_import_heavy_dependencies():
+    _, cumulative, loaded_lazy_modules = time_import('run')
+    assert 'run' in cumulative
+    assert loaded_lazy_modules == []
@@ -0,0 +1,56 @@
+import json
+import logging
+import os
+import tempfile
+
+from utils.metadata_writer import log_metadata, summarize_metadata, write_metadata_json, MAX_SUMMARY_LENGTH
+
+METADATA = {
+    'session': {'label': 'spam', 'subject': {'sex': 'male'}},
+    'acquisition': {
+        'label': 'eggs',
+        'tags': ['error'],
+        'files': [
+            {
+                'name': 'test.dicom.zip',
+                'modality': 'MR',
+                'info': {'header': {'dicom': {f'Tag{i}': 'x' * 100 for i in range(1000)}}}
+            }
+        ]
+    }
+}
+
+
+def test_summarize_metadata():
+    summary = summarize_metadata(METADATA)
+    assert summary['session'] == METADATA['session']
+    assert summary['acquisition']['tags'] == ['error']
+    file_summary = summary['acquisition']['files'][0]
+    assert file_summary['name'] == 'test.dicom.zip'
+    assert file_summary['info']['header'] == {'dicom': '<1000 data elements>'}
+    # metadata is left untouched
+    assert len(METADATA['acquisition']['files'][0]['info']['header']['dicom']) == 1000
+
+
+def test_log_metadata_is_bounded_unless_debug(caplog):
+    logger = logging.getLogger('test_metadata_writer')
+    logger.setLevel(logging.INFO)
+    with caplog.at_level(logging.INFO, logger='test_metadata_writer'):
+        log_metadata(METADATA, 'Test', logger)
+    assert len(caplog.messages[-1]) < MAX_SUMMARY_LENGTH + 200
+    assert '<1000 data elements>' in caplog.messages[-1]
+
+    logger.setLevel(logging.DEBUG)
+    with caplog.at_level(logging.DEBUG, logger='test_metadata_writer'):
+        log_metadata(METADATA, 'Test', logger)
+    assert 'Tag999' in caplog.messages[-1]
+
+
+def test_write_metadata_json():
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = os.path.join(tempdir, '.metadata.json')
+        assert write_metadata_json(METADATA, path) == path
+        with open(path) as fp:
+            content = fp.read()
+        assert json.loads(content) == METADATA
+        assert content == json.dumps(METADATA, separators=(', ', ': '), sort_keys=True, indent=4)
@@ -0,0 +1,76 @@
+import json
+import os
+import tempfile
+import threading
+
+from run import run_pipeline, validate_timezone
+from tests.unit_tests.test_header_index import make_two_series_zip
+from utils import metrics
+from utils.metrics import MetricsRecorder
+
+
+def test_metrics_recorder():
+    recorder = MetricsRecorder()
+    # Stages are not recorded without an active recorder
+    with metrics.stage('ignored', bytes_read=1) as counters:
+        counters['members'] = 1
+    with metrics.recording(recorder):
+        for _ in range(2):
+            with metrics.stage('extract', bytes_read=10) as counters:
+                counters['members'] = 3
+        # Stages are recorded from other threads too
+        thread = threading.Thread(target=metrics.timed('lookup')(lambda: None))
+        thread.start()
+        thread.join()
+    assert metrics.get_active_recorder() is None
+
+    metrics_dict = recorder.to_dict()
+    assert set(metrics_dict['stages']) == {'extract', 'lookup'}
+    extract = metrics_dict['stages']['extract']
+    assert extract['calls'] == 2
+    assert extract['bytes_read'] == 20
+    assert extract['members'] == 6
+    assert extract['peak_rss_bytes'] > 0
+    assert metrics_dict['stages']['lookup']['calls'] == 1
+    assert 'extract' in recorder.summary()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = recorder.write(os.path.join(tempdir, 'metrics.json'))
+        with open(path) as fp:
+            assert json.load(fp)['stages']['extract']['calls'] == 2
+
+
+def test_run_pipeline_metrics():
+    with tempfile.TemporaryDirectory() as tempdir:
+        zip_path = make_two_series_zip(tempdir)
+        output_dir = os.path.join(tempdir, 'output')
+        os.makedirs(output_dir)
+        result = run_pipeline(zip_path, output_dir, {'type': 'object'}, validate_timezone(None),
+                              split_on_seriesuid=True)
+        stages = result.metrics['stages']
+        assert stages['write_zip']['calls'] == 2
+        assert stages['write_zip']['members'] == 5
+        assert stages['write_zip']['bytes_written'] > 0
+
+        split_path = result.split_plan['outputs'][0]
+        result = run_pipeline(split_path, output_dir, {'type': 'object'}, validate_timezone(None))
+        stages = result.metrics['stages']
+        # The header index member is read, not extracted
+        assert stages['extract']['members'] == 4
+        assert stages['extract']['bytes_decompressed'] > stages['extract']['bytes_read'] > 0
+        assert stages['read_representative_dicom']['calls'] == 1
+        assert stages['validate_template']['calls'] == 1
+        assert {'rule.check_missing_slices', 'rule.check_instance_number_uniqueness'} <= set(stages)
+        assert stages['write_metadata']['bytes_written'] == os.path.getsize(result.metadata_path)
+
+
+def test_read_dicom_bytes_read_stops_before_pixels():
+    with tempfile.TemporaryDirectory() as tempdir:
+        zip_path = make_two_series_zip(tempdir)
+        output_dir = os.path.join(tempdir, 'output')
+        os.makedirs(output_dir)
+        result = run_pipeline(zip_path, output_dir, {'type': 'object'}, validate_timezone(None))
+        read_dicom = result.metrics['stages']['read_dicom']
+        assert read_dicom['calls'] == 5
+        # The headers only, not the 8 KiB of pixel data of each file
+        assert 0 < read_dicom['bytes_read'] < result.metrics['stages']['extract']['bytes_decompressed'] - 5 * 8192
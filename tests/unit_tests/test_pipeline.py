@@ -0,0 +1,245 @@
+import hashlib
+import json
+import os
+import tarfile
+import tempfile
+import zipfile
+
+import pytest
+
+from run import (
+    DEADLINE_SEQUENCE_POLICY,
+    PipelineResult,
+    SequencePolicy,
+    bound_sequence_policy,
+    process_dicom,
+    run_pipeline,
+    validate_timezone,
+)
+from tests.synthetic import make_synthetic_archive
+from tests.unit_tests.test_deadline import FakeClock
+from tests.unit_tests.test_header_index import make_two_series_zip
+from utils.deadline import Deadline
+from utils.errors import EmptyFileError, InvalidTemplateError
+from utils.skip_unchanged import get_archive_fingerprint
+
+
+def test_run_pipeline():
+    with tempfile.TemporaryDirectory() as tempdir:
+        zip_path = make_two_series_zip(tempdir)
+        output_dir = os.path.join(tempdir, 'output')
+        os.makedirs(output_dir)
+        template = {'properties': {'Modality': {'enum': ['CT']}}}
+        result = run_pipeline(zip_path, output_dir, template, validate_timezone(None))
+        assert isinstance(result, PipelineResult)
+        assert result.split_plan is None
+        assert result.metadata['acquisition']['files'][0]['modality'] == 'MR'
+        assert result.metadata['acquisition']['tags'] == ['error']
+        assert result.metadata_path == os.path.join(output_dir, '.metadata.json')
+        with open(result.metadata_path) as fp:
+            assert json.load(fp) == result.metadata
+        assert result.error_path == os.path.join(output_dir, 'test.dicom.zip.error.log.json')
+        with open(result.error_path) as fp:
+            assert json.load(fp) == result.validation_errors
+        assert set(result.timings) == {'validate', 'process_dicom'}
+
+
+def test_run_pipeline_split():
+    with tempfile.TemporaryDirectory() as tempdir:
+        zip_path = make_two_series_zip(tempdir)
+        output_dir = os.path.join(tempdir, 'output')
+        os.makedirs(output_dir)
+        result = run_pipeline(zip_path, output_dir, split_on_seriesuid=True)
+        assert result.metadata is None
+        assert result.split_plan['tag'] == 'SeriesInstanceUID'
+        assert len(result.split_plan['outputs']) == 2
+        assert all(os.path.isfile(path) for path in result.split_plan['outputs'])
+        assert not os.path.exists(os.path.join(output_dir, '.metadata.json'))
+
+
+def test_run_pipeline_raises_instead_of_exiting():
+    with tempfile.TemporaryDirectory() as tempdir:
+        zip_path = make_two_series_zip(tempdir)
+        with pytest.raises(InvalidTemplateError):
+            run_pipeline(zip_path, tempdir, {'type': 'spam'})
+
+        empty_path = os.path.join(tempdir, 'empty.dicom.zip')
+        open(empty_path, 'w').close()
+        with pytest.raises(EmptyFileError) as exc_info:
+            process_dicom(empty_path, tempdir, validate_timezone(None), {})
+        # The error file is still written
+        with open(os.path.join(tempdir, 'empty.dicom.zip.error.log.json')) as fp:
+            assert json.load(fp) == exc_info.value.validation_errors
+
+
+def test_run_pipeline_with_spent_deadline():
+    with tempfile.TemporaryDirectory() as tempdir:
+        zip_path = make_synthetic_archive(
+            os.path.join(tempdir, 'test.dicom.zip'), slice_count=12, missing_slices=2, siemens_csa=True
+        )
+        output_dir = os.path.join(tempdir, 'output')
+        os.makedirs(output_dir)
+        # Deadlines on a clock that does not advance: never spent, or spent from the start
+        clock = FakeClock()
+        result = run_pipeline(zip_path, output_dir, deadline=Deadline(1, clock=clock))
+        header = result.metadata['acquisition']['files'][0]['info']['header']['dicom']
+        assert 'CSAHeader' in header
+        assert len(result.validation_errors) == 1  # missing slices
+
+        deadline = Deadline(1, clock=clock)
+        clock.now = 1
+        result = run_pipeline(zip_path, output_dir, deadline=deadline)
+        # The metadata is still written, without the optional steps
+        with open(result.metadata_path) as fp:
+            assert json.load(fp) == result.metadata
+        header = result.metadata['acquisition']['files'][0]['info']['header']['dicom']
+        assert header['Manufacturer'] == 'SIEMENS'
+        assert 'CSAHeader' not in header
+        assert result.metadata['acquisition']['tags'] == ['error']
+        assert deadline.skipped == [
+            'check_instance_number_uniqueness',
+            'check_duplicate_files',
+            'check_missing_slices',
+            'check_0_byte_files',
+            'check_pydicom_exception',
+            'check_pixel_data',
+            'file_headers',
+            'full_sequences',
+            'csa_header',
+        ]
+        assert result.validation_errors == [deadline.get_error_dict()]
+
+        # Per-frame sequences are truncated, still arrays
+        zip_path = make_synthetic_archive(
+            os.path.join(tempdir, 'multiframe.dicom.zip'), slice_count=1, enhanced_multiframe_frames=20
+        )
+        multiframe_path = os.path.join(tempdir, 'multiframe.dcm')
+        with zipfile.ZipFile(zip_path) as zipf, open(multiframe_path, 'wb') as fp:
+            fp.write(zipf.read(sorted(zipf.namelist())[-1]))
+        deadline = Deadline(1, clock=clock)
+        clock.now += 1
+        result = run_pipeline(multiframe_path, output_dir, deadline=deadline)
+        assert 'full_sequences' in deadline.skipped
+        header = result.metadata['acquisition']['files'][0]['info']['header']['dicom']
+        assert isinstance(header['PerFrameFunctionalGroupsSequence'], list)
+        assert len(header['PerFrameFunctionalGroupsSequence']) == DEADLINE_SEQUENCE_POLICY.max_items
+
+
+def test_bound_sequence_policy():
+    assert bound_sequence_policy(None, DEADLINE_SEQUENCE_POLICY) == DEADLINE_SEQUENCE_POLICY
+    assert bound_sequence_policy(SequencePolicy(5, 0, 4096, 0), SequencePolicy(10, 1, 1024, 0)) == (
+        SequencePolicy(5, 1, 1024, 0)
+    )
+
+
+def test_run_pipeline_with_duplicate_files():
+    with tempfile.TemporaryDirectory() as tempdir:
+        zip_path = make_synthetic_archive(os.path.join(tempdir, 'test.dicom.zip'), slice_count=10, series_count=2)
+        with zipfile.ZipFile(zip_path, 'a') as zipf:
+            name = sorted(zipf.namelist())[0]
+            zipf.writestr('copy/' + os.path.basename(name), zipf.read(name))
+        # Same members in a tar, whose members have no CRC
+        tar_path = os.path.join(tempdir, 'test.dicom.tar')
+        with zipfile.ZipFile(zip_path) as zipf, tarfile.open(tar_path, 'w') as tarf:
+            for zip_info in zipf.infolist():
+                tar_info = tarfile.TarInfo(zip_info.filename)
+                tar_info.size = zip_info.file_size
+                tarf.addfile(tar_info, zipf.open(zip_info))
+
+        for path in (zip_path, tar_path):
+            output_dir = os.path.join(tempdir, os.path.basename(path) + '.output')
+            os.makedirs(output_dir)
+            result = run_pipeline(path, output_dir)
+            error_messages = [error['error_message'] for error in result.validation_errors]
+            assert f"Files have identical content:['{os.path.basename(name)} (same as {os.path.basename(name)})']" \
+                in error_messages
+            assert any(message.startswith('SOPInstanceUID is duplicated') for message in error_messages)
+
+        member_counts = {}
+        for drop_duplicates in (False, True):
+            split_dir = os.path.join(tempdir, f'split_{drop_duplicates}')
+            os.makedirs(split_dir)
+            result = run_pipeline(
+                zip_path, split_dir, split_on_seriesuid=True, split_drop_duplicates=drop_duplicates
+            )
+            member_counts[drop_duplicates] = 0
+            for path in result.split_plan['outputs']:
+                with zipfile.ZipFile(path) as zipf:
+                    member_counts[drop_duplicates] += len(zipf.namelist())
+        assert member_counts[False] - member_counts[True] == 1
+
+
+def test_run_pipeline_checksums():
+    with tempfile.TemporaryDirectory() as tempdir:
+        zip_path = make_synthetic_archive(os.path.join(tempdir, 'test.dicom.zip'), slice_count=10)
+        with zipfile.ZipFile(zip_path) as zipf:
+            members = {name: zipf.read(name) for name in zipf.namelist()}
+        # Same members, in reverse order and stored, then also renamed
+        other_path = os.path.join(tempdir, 'other.dicom.zip')
+        renamed_path = os.path.join(tempdir, 'renamed.dicom.zip')
+        for path, prefix in ((other_path, ''), (renamed_path, 'renamed_')):
+            with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as zipf:
+                for name in sorted(members, reverse=True):
+                    zipf.writestr(prefix + name, members[name])
+
+        checksums = []
+        member_checksums = []
+        for path in (zip_path, other_path, renamed_path):
+            output_dir = os.path.join(tempdir, os.path.basename(path) + '.output')
+            os.makedirs(output_dir)
+            checksums_path = os.path.join(output_dir, 'checksums.json')
+            result = run_pipeline(path, output_dir, checksums_path=checksums_path)
+            checksums.append(result.metadata['acquisition']['files'][0]['info']['checksums'])
+            with open(checksums_path) as fp:
+                member_checksums.append(json.load(fp))
+        # Only the fingerprint and member count in the file info
+        assert checksums[0] == {
+            'algorithm': 'sha256', 'fingerprint': checksums[0]['fingerprint'], 'member_count': len(members)
+        }
+        # Independent of the order and compression of the members, not of their names
+        assert checksums[0]['fingerprint'] == checksums[1]['fingerprint']
+        assert checksums[0]['fingerprint'] != checksums[2]['fingerprint']
+        assert member_checksums[0] == dict(
+            checksums[0], members={name: hashlib.sha256(data).hexdigest() for name, data in members.items()}
+        )
+        assert member_checksums[0]['members'] != member_checksums[2]['members']
+
+        # The checksums file is only written if set
+        output_dir = os.path.join(tempdir, 'output')
+        os.makedirs(output_dir)
+        run_pipeline(zip_path, output_dir)
+        assert sorted(os.listdir(output_dir)) == ['.metadata.json']
+
+
+def test_run_pipeline_tar_and_nested_zips():
+    with tempfile.TemporaryDirectory() as tempdir:
+        zip_path = make_two_series_zip(tempdir)
+        with zipfile.ZipFile(zip_path) as zipf:
+            members = {name: zipf.read(name) for name in zipf.namelist()}
+        tar_path = os.path.join(tempdir, 'test.dicom.tar.gz')
+        with tarfile.open(tar_path, 'w:gz') as tarf:
+            tarf.add(zip_path, 'nested.dicom.zip')
+        nested_path = os.path.join(tempdir, 'nested.zip')
+        with zipfile.ZipFile(nested_path, 'w') as zipf:
+            zipf.write(zip_path, 'nested.dicom.zip')
+
+        fingerprints = []
+        for path in (zip_path, tar_path, nested_path):
+            output_dir = os.path.join(tempdir, os.path.basename(path) + '.output')
+            os.makedirs(output_dir)
+            checksums_path = os.path.join(output_dir, 'checksums.json')
+            result = run_pipeline(path, output_dir, checksums_path=checksums_path)
+            fingerprints.append(result.metadata['acquisition']['files'][0]['info']['checksums']['fingerprint'])
+        with open(checksums_path) as fp:
+            assert sorted(json.load(fp)['members']) == sorted(f'nested.dicom.zip/{name}' for name in members)
+        # The members of the nested zip are named after it, whatever the outer archive
+        assert fingerprints[1] == fingerprints[2] != fingerprints[0]
+        assert get_archive_fingerprint(tar_path) == fingerprints[1]
+
+        # Split archives of a tar are zips
+        output_dir = os.path.join(tempdir, 'split')
+        os.makedirs(output_dir)
+        result = run_pipeline(tar_path, output_dir, split_on_seriesuid=True)
+        assert len(result.split_plan['outputs']) == 2
+        for path in result.split_plan['outputs']:
+            assert path.endswith('.zip') and zipfile.is_zipfile(path)
@@ -0,0 +1,90 @@
+import os
+import tempfile
+import zipfile
+
+import pydicom
+from pydicom.data import get_testdata_files
+
+from run import get_dcm_data_dict, run_pipeline
+from tests.synthetic import make_synthetic_archive
+from utils.dicom.pixel_data import get_expected_pixel_data_length, read_pixel_data_error
+
+
+def write_truncated_copy(name, tempdir, byte_count=100):
+    with open(get_testdata_files(name)[0], 'rb') as fp:
+        data = fp.read()
+    path = os.path.join(tempdir, name)
+    with open(path, 'wb') as fp:
+        fp.write(data[:-byte_count])
+    return path
+
+
+def test_read_pixel_data_error():
+    # native, big endian, implicit VR, encapsulated and multi-frame encapsulated
+    names = [
+        'emri_small.dcm', 'MR_small_bigendian.dcm', 'MR_small_implicit.dcm', 'JPEG2000.dcm',
+        'SC_rgb_rle_2frame.dcm', 'rtplan.dcm'
+    ]
+    for name in names:
+        assert read_pixel_data_error(get_testdata_files(name)[0]) is None
+    assert read_pixel_data_error(get_testdata_files('MR_truncated.dcm')[0]) == 'truncated, 8130 of 8192 bytes'
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        assert read_pixel_data_error(write_truncated_copy('emri_small.dcm', tempdir)) == \
+            'truncated, 81820 of 81920 bytes'
+        assert read_pixel_data_error(write_truncated_copy('SC_rgb_rle_2frame.dcm', tempdir)) == \
+            'truncated in fragment 2'
+        # Only the trailing padding is truncated
+        assert read_pixel_data_error(write_truncated_copy('MR_small.dcm', tempdir)) is None
+
+        dcm = pydicom.dcmread(get_testdata_files('MR_small.dcm')[0])
+        dcm.Rows = 32
+        path = os.path.join(tempdir, 'rows.dcm')
+        dcm.save_as(path)
+        assert read_pixel_data_error(path) == '8192 bytes, 4096 expected'
+
+
+def test_private_transfer_syntax():
+    with tempfile.TemporaryDirectory() as tempdir:
+        dcm = pydicom.dcmread(get_testdata_files('MR_small.dcm')[0])
+        dcm.file_meta.TransferSyntaxUID = '1.2.3.4.5'
+        path = os.path.join(tempdir, 'private.dcm')
+        dcm.save_as(path)
+        # Cannot be checked, the header is kept
+        assert read_pixel_data_error(path) is None
+        dcm_dict = get_dcm_data_dict(path)
+        assert not dcm_dict['pydicom_exception']
+        assert dcm_dict['header']['SOPInstanceUID'] == dcm.SOPInstanceUID
+        assert dcm_dict['pixel_data_error'] is None
+
+
+def test_get_dcm_data_dict_keeps_header_if_check_fails(mocker):
+    mocker.patch('run.check_pixel_data', side_effect=RuntimeError('spam'))
+    dcm_dict = get_dcm_data_dict(get_testdata_files('MR_small.dcm')[0])
+    assert not dcm_dict['pydicom_exception']
+    assert dcm_dict['header']['Modality'] == 'MR'
+    assert dcm_dict['pixel_data_error'] is None
+
+
+def test_get_expected_pixel_data_length():
+    dcm = pydicom.dcmread(get_testdata_files('SC_rgb_rle_2frame.dcm')[0], stop_before_pixels=True)
+    assert get_expected_pixel_data_length(dcm) == 100 * 100 * 3 * 2
+    dcm.BitsAllocated = 1
+    assert get_expected_pixel_data_length(dcm) == (100 * 100 * 3 * 2 + 7) // 8
+    del dcm.Rows
+    assert get_expected_pixel_data_length(dcm) is None
+
+
+def test_run_pipeline_with_truncated_member():
+    with tempfile.TemporaryDirectory() as tempdir:
+        zip_path = make_synthetic_archive(os.path.join(tempdir, 'test.dicom.zip'), slice_count=10)
+        with zipfile.ZipFile(zip_path, 'a') as zipf:
+            name = sorted(zipf.namelist())[-1]
+            zipf.writestr('truncated.dcm', zipf.read(name)[:-10])
+        output_dir = os.path.join(tempdir, 'output')
+        os.makedirs(output_dir)
+        result = run_pipeline(zip_path, output_dir)
+        assert {
+            'error_message': 'PixelData is inconsistent in file: truncated.dcm (truncated, 8182 of 8192 bytes)',
+            'revalidate': False
+        } in result.validation_errors
@@ -0,0 +1,37 @@
+import os
+import pstats
+import tempfile
+
+from run import run_pipeline, validate_timezone
+from tests.unit_tests.test_header_index import make_two_series_zip
+from utils.profiling import profiling
+
+
+def test_profiling():
+    with tempfile.TemporaryDirectory() as tempdir:
+        zip_path = make_two_series_zip(tempdir)
+        output_dir = os.path.join(tempdir, 'output')
+        os.makedirs(output_dir)
+        with profiling(output_dir, 'test.dicom.zip', cpu=True, memory=True, interval=0.001) as paths:
+            run_pipeline(zip_path, output_dir, {}, validate_timezone(None))
+        assert sorted(os.path.basename(path) for path in paths) == [
+            'test.dicom.zip.collapsed.txt', 'test.dicom.zip.profile.txt', 'test.dicom.zip.pstats',
+            'test.dicom.zip.tracemalloc.txt'
+        ]
+        stats = pstats.Stats(os.path.join(output_dir, 'test.dicom.zip.pstats'))
+        assert any(func_name == 'get_pydicom_header' for _, _, func_name in stats.stats)
+        with open(os.path.join(output_dir, 'test.dicom.zip.collapsed.txt')) as fp:
+            for line in fp:
+                stack, count = line.rsplit(' ', 1)
+                assert stack.startswith('MainThread;')
+                assert int(count) > 0
+        with open(os.path.join(output_dir, 'test.dicom.zip.tracemalloc.txt')) as fp:
+            assert fp.readline().startswith('Traced memory')
+
+
+def test_profiling_disabled():
+    with tempfile.TemporaryDirectory() as tempdir:
+        with profiling(tempdir, 'test', cpu=False, memory=False) as paths:
+            pass
+        assert paths == []
+        assert os.listdir(tempdir) == []
@@ -0,0 +1,73 @@
+import os
+import tempfile
+import zipfile
+
+import flywheel
+
+from run import get_header_namespace, run_pipeline
+from tests.fw_api_stub import FlywheelApiStub
+from tests.synthetic import make_synthetic_archive
+from tests.unit_tests.test_deadline import FakeClock
+from utils.deadline import Deadline
+from utils.skip_unchanged import RUN_INFO_KEY, get_archive_fingerprint, get_run_key, is_unchanged
+from utils.update_file_info import dest_file_dict_request
+
+TEMPLATE = {'properties': {'Modality': {'enum': ['MR']}}}
+GEAR_CONFIG = {'split_on_SeriesUID': True, 'split_localizer': True, 'force_dicom_read': False, 'debug': False}
+
+
+def test_get_run_key():
+    run_key = get_run_key(TEMPLATE, GEAR_CONFIG, '1.0.0')
+    assert get_run_key(dict(TEMPLATE), dict(GEAR_CONFIG, debug=True, time_budget_seconds=60), '1.0.0') == run_key
+    assert get_run_key({}, GEAR_CONFIG, '1.0.0')['template_hash'] != run_key['template_hash']
+    assert get_run_key(TEMPLATE, dict(GEAR_CONFIG, force_dicom_read=True), '1.0.0')['config_hash'] != \
+        run_key['config_hash']
+    # The header extraction version changes the key, whatever the gear version
+    assert get_run_key(TEMPLATE, GEAR_CONFIG, '1.0.0', get_header_namespace())['output_version'] != \
+        run_key['output_version']
+
+
+def test_skip_unchanged_against_api_stub():
+    with tempfile.TemporaryDirectory() as tempdir:
+        zip_path = make_synthetic_archive(os.path.join(tempdir, 'test.dicom.zip'), slice_count=10)
+        run_key = get_run_key(TEMPLATE, GEAR_CONFIG, '1.0.0')
+        result = run_pipeline(zip_path, tempdir, TEMPLATE, run_key=run_key)
+        file_info = result.metadata['acquisition']['files'][0]['info']
+        assert file_info[RUN_INFO_KEY] == dict(run_key, fingerprint=file_info['checksums']['fingerprint'])
+        assert get_archive_fingerprint(zip_path) == file_info['checksums']['fingerprint']
+
+        with FlywheelApiStub() as stub:
+            fw_client = flywheel.Client(stub.api_key)
+            # Never processed
+            stub.add_file('acq_id', {'name': 'test.dicom.zip', 'type': 'dicom', 'info': {}})
+            file_dict = dest_file_dict_request(fw_client, 'acq_id', 'test.dicom.zip')
+            assert not is_unchanged(file_dict, zip_path, run_key)
+
+            # Info uploaded from the .metadata.json of the last run
+            stub.add_file('acq_id', {'name': 'test.dicom.zip', 'type': 'dicom', 'info': file_info})
+            file_dict = dest_file_dict_request(fw_client, 'acq_id', 'test.dicom.zip')
+            assert is_unchanged(file_dict, zip_path, run_key)
+            assert not is_unchanged(file_dict, zip_path, get_run_key(TEMPLATE, GEAR_CONFIG, '1.0.1'))
+            assert not is_unchanged(file_dict, zip_path, get_run_key({}, GEAR_CONFIG, '1.0.0'))
+
+            # Same content, members renamed
+            renamed_path = os.path.join(tempdir, 'renamed.dicom.zip')
+            with zipfile.ZipFile(zip_path) as zipf, zipfile.ZipFile(renamed_path, 'w') as renamed_zipf:
+                for name in zipf.namelist():
+                    renamed_zipf.writestr('renamed_' + name, zipf.read(name))
+            assert not is_unchanged(file_dict, renamed_path, run_key)
+
+            with zipfile.ZipFile(zip_path, 'a') as zipf:
+                zipf.writestr('extra.dcm', b'spam')
+            assert not is_unchanged(file_dict, zip_path, run_key)
+
+
+def test_partial_runs_are_not_recorded():
+    with tempfile.TemporaryDirectory() as tempdir:
+        zip_path = make_synthetic_archive(os.path.join(tempdir, 'test.dicom.zip'), slice_count=10)
+        run_key = get_run_key(TEMPLATE, GEAR_CONFIG, '1.0.0')
+        clock = FakeClock()
+        deadline = Deadline(1, clock=clock)
+        clock.now = 1
+        result = run_pipeline(zip_path, tempdir, TEMPLATE, run_key=run_key, deadline=deadline)
+        assert RUN_INFO_KEY not in result.metadata['acquisition']['files'][0]['info']
@@ -0,0 +1,46 @@
+import io
+import os
+import tempfile
+import zipfile
+
+import pydicom
+
+from run import get_csa_header, run_pipeline, validate_timezone
+from tests.benchmarks.bench_pipeline import compare
+from tests.synthetic import ENHANCED_MR_IMAGE_STORAGE, make_synthetic_archive
+
+
+def test_make_synthetic_archive():
+    with tempfile.TemporaryDirectory() as tempdir:
+        zip_path = make_synthetic_archive(
+            os.path.join(tempdir, 'test.dicom.zip'), slice_count=12, series_count=2, localizer_count=3,
+            missing_slices=2, siemens_csa=True, enhanced_multiframe_frames=4, zero_byte_members=1
+        )
+        with zipfile.ZipFile(zip_path) as zipf:
+            members = {name: zipf.read(name) for name in zipf.namelist()}
+        # 2 series of 10 slices, 3 localizers, 1 enhanced multi-frame file, 1 empty member
+        assert len(members) == 25
+        assert members.pop('empty_0.dcm') == b''
+        datasets = [pydicom.dcmread(io.BytesIO(data)) for data in members.values()]
+        assert len({ds.SeriesInstanceUID for ds in datasets}) == 2
+        assert len({tuple(ds.ImageOrientationPatient) for ds in datasets if 'ImageOrientationPatient' in ds}) == 2
+        enhanced = [ds for ds in datasets if ds.SOPClassUID == ENHANCED_MR_IMAGE_STORAGE]
+        assert len(enhanced[0].PerFrameFunctionalGroupsSequence) == 4
+        assert get_csa_header(datasets[0])['ImaCoilString'] == 'HEA;HEP'
+
+        output_dir = os.path.join(tempdir, 'output')
+        os.makedirs(output_dir)
+        result = run_pipeline(zip_path, output_dir, {}, validate_timezone(None), split_localizer=True)
+        assert result.split_plan['tag'] == 'ImageOrientationPatient'
+
+        zip_path = make_synthetic_archive(os.path.join(tempdir, 'gap.dicom.zip'), slice_count=12, missing_slices=2)
+        result = run_pipeline(zip_path, output_dir, {}, validate_timezone(None))
+        assert any('Inconsistent slice intervals' in error['error_message'] for error in result.validation_errors)
+
+
+def test_compare_to_baseline():
+    baseline = {'results': {'10': {'process_dicom': 1.0, 'dicom_archive': 0.01}}}
+    results = {'results': {'10': {'process_dicom': 1.5, 'dicom_archive': 0.02, 'new_stage': 1.0}}}
+    # dicom_archive doubled but by less than MIN_DELTA
+    assert compare(results, baseline, tolerance=0.25) == [('10', 'process_dicom', 1.0, 1.5)]
+    assert compare(results, baseline, tolerance=1.0) == []
@@ -1,10 +1,18 @@
 import copy
 import json
 import tempfile
+import threading
 import os
 
+import flywheel
+import pytest
+from unittest.mock import MagicMock
+
+import utils.update_file_info
+
 from utils.update_file_info import get_meta_file_dict_and_index, update_meta_file_dict, get_file_update_dict, \
-    replace_metadata_file_dict, update_metadata_json
+    replace_metadata_file_dict, update_metadata_json, update_file_metadata, prefetch_dest_cont_file_dict, \
+    get_file_dict_and_update_metadata_json, dest_file_dict_request, get_dest_cont_file_dict
 
 
 METADATA_DICT = {
@@ -169,4 +177,107 @@ def test_update_metadata_json():
         with open(path, 'r') as file_obj:
             result = json.load(file_obj)
 
-        assert expected == result
\ No newline at end of file
+        assert expected == result
+
+def test_update_file_metadata_copy_on_write():
+    metadata_dict = copy.deepcopy(METADATA_DICT)
+    metadata_dict['session'] = {'label': 'spam'}
+    metadata_before = copy.deepcopy(metadata_dict)
+    fw_file_dict = copy.deepcopy(FW_FILE_DICT)
+    fw_file_before = copy.deepcopy(fw_file_dict)
+
+    result = update_file_metadata(fw_file_dict, metadata_dict, 'acquisition')
+
+    # inputs are untouched
+    assert metadata_dict == metadata_before
+    assert fw_file_dict == fw_file_before
+    assert result['acquisition']['files'][0]['info']['export'] == {'origin_id': 'test_id'}
+    assert result['acquisition']['files'][0]['type'] == 'dicom'
+    # unchanged subtrees are shared rather than copied
+    assert result['session'] is metadata_dict['session']
+    result_header = result['acquisition']['files'][0]['info']['header']
+    assert result_header is metadata_dict['acquisition']['files'][0]['info']['header']
+    # values taken from the flywheel file are copied
+    result['acquisition']['files'][0]['info']['export']['origin_id'] = 'spam'
+    assert fw_file_dict['info']['export']['origin_id'] == 'test_id'
+
+
+def test_prefetch_dest_cont_file_dict(mocker):
+    release = threading.Event()
+
+    def lookup(input_key):
+        release.wait(5)
+        return copy.deepcopy(FW_FILE_DICT), 'acquisition'
+
+    get_dest = mocker.patch('utils.update_file_info.get_dest_cont_file_dict', side_effect=lookup)
+    future = prefetch_dest_cont_file_dict('dicom')
+    # the lookup runs in the background
+    assert not future.done()
+    release.set()
+
+    with tempfile.TemporaryDirectory() as tempd:
+        path = os.path.join(tempd, '.metadata.json')
+        with open(path, 'w') as fp:
+            json.dump(METADATA_DICT, fp)
+        get_file_dict_and_update_metadata_json('dicom', path, future)
+        with open(path) as fp:
+            result = json.load(fp)
+    assert result['acquisition']['files'][0]['info']['export'] == {'origin_id': 'test_id'}
+    get_dest.assert_called_once_with('dicom')
+
+
+def test_prefetch_dest_cont_file_dict_raises_on_join(mocker):
+    mocker.patch('utils.update_file_info.get_dest_cont_file_dict', side_effect=ValueError('spam'))
+    future = prefetch_dest_cont_file_dict('dicom')
+    with pytest.raises(ValueError):
+        get_file_dict_and_update_metadata_json('dicom', 'unused', future)
+
+
+def test_dest_file_dict_request():
+    fw_client = MagicMock()
+    fw_client.get_container_file_info.return_value.to_dict.return_value = {'name': 'test.dicom.zip'}
+    assert dest_file_dict_request(fw_client, 'acq_id', 'test.dicom.zip') == {'name': 'test.dicom.zip'}
+    # the parent container is not fetched
+    fw_client.get.assert_not_called()
+    fw_client.get_container_file_info.assert_called_once_with('acq_id', 'test.dicom.zip')
+
+    fw_client.get_container_file_info.side_effect = flywheel.rest.ApiException(status=404)
+    assert dest_file_dict_request(fw_client, 'acq_id', 'missing.dicom.zip') == {}
+
+
+def test_get_dest_cont_file_dict_reuses_client_and_memoizes(mocker):
+    mocker.patch.object(utils.update_file_info, '_gear_context', None)
+    mocker.patch.object(utils.update_file_info, '_file_dict_cache', dict())
+    gear_context_cls = mocker.patch('flywheel.GearContext')
+    gear_context = gear_context_cls.return_value
+    gear_context.get_input.return_value = {
+        'location': {'name': 'test.dicom.zip'},
+        'hierarchy': {'id': 'acq_id', 'type': 'acquisition'}
+    }
+    fw_client = gear_context.client
+    fw_client.get_container_file_info.return_value.to_dict.return_value = copy.deepcopy(FW_FILE_DICT)
+
+    for _ in range(2):
+        file_dict, parent_type = get_dest_cont_file_dict('dicom')
+        assert file_dict == FW_FILE_DICT
+        assert parent_type == 'acquisition'
+    gear_context_cls.assert_called_once()
+    fw_client.get_container_file_info.assert_called_once_with('acq_id', 'test.dicom.zip')
+
+
+def test_dest_file_dict_request_against_api_stub():
+    from tests.fw_api_stub import FlywheelApiStub
+
+    with FlywheelApiStub(fail_first=1) as stub:
+        stub.add_file('acq_id', {'name': 'test.dicom.zip', 'type': 'dicom', 'modality': 'MR', 'info': {}})
+        fw_client = flywheel.Client(stub.api_key)
+        file_dict = dest_file_dict_request(fw_client, 'acq_id', 'test.dicom.zip')
+        assert file_dict['name'] == 'test.dicom.zip'
+        assert file_dict['modality'] == 'MR'
+        # The injected 504 is retried
+        file_requests = [entry['status'] for entry in stub.request_log if '/files/' in entry['path']]
+        assert file_requests == [504, 200]
+
+        assert dest_file_dict_request(fw_client, 'acq_id', 'missing.dicom.zip') == {}
+        # Only the file records were requested, never the parent container
+        assert not [entry for entry in stub.request_log if entry['path'].endswith('/acq_id')]
@@ -5,10 +5,17 @@ from pathlib import Path
 from tempfile import NamedTemporaryFile
 
 import jsonschema
+import pytest
 
 from utils.validation import get_validation_error_dict, validate_against_template, validate_against_rules, \
-    check_0_byte_files, check_instance_number_uniqueness, check_missing_slices, check_pydicom_exception, \
-    check_file_is_not_empty, dump_validation_error_file, get_most_frequent
+    check_0_byte_files, check_duplicate_files, check_instance_number_uniqueness, check_missing_slices, check_pydicom_exception, \
+    check_file_is_not_empty, dump_validation_error_file, get_most_frequent, MissingSlices, RuleValidator, RULE_REGISTRY, \
+    DEFAULT_RULE_LIST, get_enabled_rules
+from utils import metrics
+from utils.deadline import Deadline
+from utils.metrics import MetricsRecorder
+from tests.equivalence.legacy import validation as legacy_validation
+from tests.unit_tests.test_deadline import FakeClock
 
 
 DATA_ROOT = Path(__file__).parents[1] / 'data'
@@ -273,3 +280,158 @@ def test_get_most_frequent_returns_value_according_to_rounding():
 
     arr = [1.1, 1.2, 1.3, 2, 2]
     assert get_most_frequent(arr, rounding=[0]) == 1
+
+
+def make_slice_dict(index, sequence_name='S1', instance_number=None, size=1000, pydicom_exception=False):
+    header = {}
+    if size and not pydicom_exception:
+        header = {
+            'SequenceName': sequence_name,
+            'InstanceNumber': index + 1 if instance_number is None else instance_number,
+            'ImageType': ['ORIGINAL', 'PRIMARY'],
+            'ImageOrientationPatient': [1.0, 0.0, 0.0, 0.0, 1.0, 0.0],
+            'ImagePositionPatient': [0.0, 0.0, 2.0 * index],
+        }
+    return {'path': f'path{index}', 'size': size, 'force': False, 'pydicom_exception': pydicom_exception,
+            'header': header}
+
+
+def test_rule_validator_matches_legacy_rules():
+    dcm_dict_list = [make_slice_dict(index) for index in range(20) if index != 7]
+    dcm_dict_list += [make_slice_dict(index, sequence_name='S2') for index in range(12)]
+    dcm_dict_list += [make_slice_dict(index, sequence_name='S1', instance_number=3) for index in range(30, 45)]
+    dcm_dict_list.append(make_slice_dict(50, size=0))
+    dcm_dict_list.append(make_slice_dict(51, pydicom_exception=True))
+    expected = legacy_validation.validate_against_rules(dcm_dict_list)
+    assert len(expected) == 4
+
+    validator = RuleValidator()
+    for dcm_dict in dcm_dict_list:
+        validator.add(dcm_dict)
+    assert validator.finalize() == expected
+    assert validate_against_rules(dcm_dict_list) == expected
+
+    # Instance numbers pandas does not hold as integers
+    dcm_dict_list = [make_slice_dict(index, instance_number=number) for index, number in enumerate([1, None, 1.5])]
+    dcm_dict_list.append(make_slice_dict(3, instance_number=None))
+    assert check_instance_number_uniqueness(dcm_dict_list) == \
+        legacy_validation.check_instance_number_uniqueness(dcm_dict_list)
+
+
+def test_missing_slices_keeps_only_current_sequence():
+    accumulator = MissingSlices()
+    for index in range(20):
+        if index != 7:
+            accumulator.add(make_slice_dict(index, sequence_name='S1'))
+    assert len(accumulator._slice_records) == 19
+    assert not accumulator.error_list
+
+    accumulator.add(make_slice_dict(0, sequence_name='S2'))
+    assert len(accumulator._slice_records) == 1
+    assert len(accumulator.error_list) == 1
+    assert accumulator.finalize() == accumulator.error_list
+    assert accumulator.sequence_names == ['S1', 'S2']
+
+
+def test_rule_registry():
+    assert sorted(RULE_REGISTRY) == sorted(DEFAULT_RULE_LIST)
+    assert RULE_REGISTRY['check_missing_slices'] is MissingSlices
+    assert MissingSlices.name == 'check_missing_slices'
+
+
+def test_get_enabled_rules():
+    assert get_enabled_rules() == DEFAULT_RULE_LIST
+    assert get_enabled_rules('') == DEFAULT_RULE_LIST
+    assert get_enabled_rules(' check_missing_slices, check_0_byte_files') == [
+        'check_instance_number_uniqueness', 'check_duplicate_files', 'check_pydicom_exception', 'check_pixel_data'
+    ]
+    assert get_enabled_rules(DEFAULT_RULE_LIST) == []
+    with pytest.raises(ValueError):
+        get_enabled_rules('check_everything')
+
+
+def test_rule_validator_report():
+    dcm_dict_list = [make_slice_dict(index) for index in range(20) if index != 7]
+    dcm_dict_list.append(make_slice_dict(50, size=0))
+    recorder = MetricsRecorder()
+    with metrics.recording(recorder):
+        validator = RuleValidator()
+        for dcm_dict in dcm_dict_list:
+            validator.add(dcm_dict)
+        result = validator.finalize()
+        assert result == validate_against_rules(dcm_dict_list)
+    assert [error['error_message'].split(' ')[0] for error in result] == ['Inconsistent', 'Dicom']
+    assert validator.report['check_missing_slices']['errors'] == 1
+    assert validator.report['check_instance_number_uniqueness']['errors'] == 0
+    stage = recorder.to_dict()['stages']['rule.check_0_byte_files']
+    assert stage['calls'] == 2
+    assert stage['files'] == 2 * len(dcm_dict_list)
+    assert stage['errors'] == 2
+
+    validator = RuleValidator(get_enabled_rules('check_missing_slices'))
+    for dcm_dict in dcm_dict_list:
+        validator.add(dcm_dict)
+    assert len(validator.finalize()) == 1
+    assert 'check_missing_slices' not in validator.report
+
+
+def test_missing_slices_skips_localizer_only_sequences():
+    dcm_dict_list = [make_slice_dict(index) for index in range(20) if index != 7]
+    for dcm_dict in dcm_dict_list:
+        dcm_dict['header']['ImageType'] = ['ORIGINAL', 'PRIMARY', 'LOCALIZER']
+    # Without SliceLocation, no slice is left to orient the sequence: the legacy
+    # check raised
+    with pytest.raises(IndexError):
+        legacy_validation.check_missing_slices(dcm_dict_list)
+    assert check_missing_slices(dcm_dict_list) == []
+
+    # A localizer slice in a sequence is still ignored, the gap is still reported
+    for dcm_dict in dcm_dict_list:
+        dcm_dict['header']['ImageType'] = ['ORIGINAL', 'PRIMARY']
+    dcm_dict_list[3]['header']['ImageType'] = ['ORIGINAL', 'PRIMARY', 'LOCALIZER']
+    assert len(check_missing_slices(dcm_dict_list)) == 1
+
+
+def test_rule_validator_skips_rules_past_deadline():
+    dcm_dict_list = [make_slice_dict(index) for index in range(20) if index != 7]
+    clock = FakeClock()
+    deadline = Deadline(60, clock=clock)
+    validator = RuleValidator(deadline=deadline)
+    for dcm_dict in dcm_dict_list:
+        validator.add(dcm_dict)
+    clock.now = 60
+    assert validator.finalize() == []
+    assert deadline.skipped == DEFAULT_RULE_LIST
+    assert validator.report == {}
+
+
+def test_check_duplicate_files(tmpdir):
+    contents = {'a.dcm': b'spam', 'b.dcm': b'eggs', 'c.dcm': b'spam', 'd.dcm': b'spam'}
+    dcm_dict_list = []
+    for index, (name, content) in enumerate(contents.items()):
+        path = tmpdir.join(name)
+        path.write_binary(content)
+        dcm_dict = make_slice_dict(index, size=len(content))
+        dcm_dict.update(path=str(path), crc=0)
+        dcm_dict['header']['SOPInstanceUID'] = '1.2.3' if name == 'b.dcm' else f'1.2.{index}'
+        dcm_dict_list.append(dcm_dict)
+    dcm_dict_list[-1]['header']['SOPInstanceUID'] = '1.2.3'
+
+    assert check_duplicate_files(dcm_dict_list) == [
+        {'error_message': "SOPInstanceUID is duplicated for values:['1.2.3']", 'revalidate': False},
+        {
+            'error_message': "Files have identical content:['c.dcm (same as a.dcm)', 'd.dcm (same as a.dcm)']",
+            'revalidate': False
+        },
+    ]
+    # Files of different CRC are not compared
+    dcm_dict_list[2]['crc'] = 1
+    dcm_dict_list[3]['crc'] = 2
+    assert check_duplicate_files(dcm_dict_list)[1:] == []
+    # Files without CRC, e.g. tar members, are compared on their size
+    for dcm_dict in dcm_dict_list:
+        dcm_dict['crc'] = None
+    assert check_duplicate_files(dcm_dict_list)[1:] == [{
+        'error_message': "Files have identical content:['c.dcm (same as a.dcm)', 'd.dcm (same as a.dcm)']",
+        'revalidate': False
+    }]
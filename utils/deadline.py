@@ -0,0 +1,77 @@
+"""Time budget of a job, for graceful degradation
+
+Optional expensive steps ask the deadline before running and are skipped once the
+budget is spent, so that a job over budget still writes a partial but valid result
+instead of being killed by the cluster:
+
+    deadline = Deadline(600)
+    if deadline.allows('csa_header'):
+        header['CSAHeader'] = get_csa_header(dcm)
+    ...
+    error_dict = deadline.get_error_dict()  # None if nothing was skipped
+
+The required steps (reading the archive, the representative header, the template
+validation and writing .metadata.json) are never skipped, the budget should therefore
+leave a margin below the hard limit of the cluster.
+"""
+import logging
+import math
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Deadline:
+    """Wall-clock time budget started on creation
+
+    Args:
+        budget (float): Budget in seconds, None or 0 for an unlimited budget.
+        clock (callable): Returns the current time in seconds, time.perf_counter by
+            default.
+
+    Attributes:
+        skipped (list): Names of the steps skipped for lack of time, in order.
+    """
+
+    def __init__(self, budget=None, clock=time.perf_counter):
+        self.budget = budget or None
+        self.skipped = []
+        self._clock = clock
+        self._start = clock()
+
+    def elapsed(self):
+        """Returns the seconds elapsed since the deadline was created"""
+        return self._clock() - self._start
+
+    def remaining(self):
+        """Returns the seconds left in the budget, inf if unlimited"""
+        if self.budget is None:
+            return math.inf
+        return self.budget - self.elapsed()
+
+    def expired(self):
+        """Returns True if the budget is spent"""
+        return self.remaining() <= 0
+
+    def skip(self, step):
+        """Records that the step is skipped for lack of time"""
+        if step not in self.skipped:
+            log.warning('Time budget of %s s spent after %.1f s, skipping %s', self.budget, self.elapsed(), step)
+            self.skipped.append(step)
+
+    def allows(self, step):
+        """Returns True if the optional step can run, otherwise records it as skipped"""
+        if self.expired():
+            self.skip(step)
+            return False
+        return True
+
+    def get_error_dict(self):
+        """Returns the validation error dict listing the skipped steps, None if no step
+        was skipped"""
+        if not self.skipped:
+            return None
+        return {
+            'error_message': f'Time budget of {self.budget} s exceeded, skipped checks: {", ".join(self.skipped)}',
+            'revalidate': False
+        }
@@ -0,0 +1,232 @@
+"""Streaming enumeration and extraction of the members of DICOM archives
+
+Members are enumerated one at a time, never as lists of names or paths. What is kept of
+each member is an ArchiveMember, its path on disk is derived from its name and the
+extraction directory when needed.
+
+Archive formats are read by the member readers registered with register_archive_reader:
+zip (Zip64 included) and tar, plain or gzip, bzip2 or xz compressed. Zips found in an
+archive, e.g. a zip of per-series zips, are read in place of their member, so that
+every format is enumerated the same way and in a single sequential pass:
+
+    for name, size, crc, stream in iter_member_streams(path):
+        ...
+"""
+import collections
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+
+from ..hashing import DIGEST_ALGORITHM, DIGEST_CHUNK_SIZE
+from .header_index import HEADER_INDEX_MEMBER
+
+# name: name of the member in the archive, prefixed with the name of the nested zip
+#   it is read from, if any, e.g. 'series1.zip/1.dcm'
+# size: size in bytes of its content
+# crc: CRC-32 of its content, None if unknown (tar members)
+# digest: hex digest of its content, computed on extraction
+ArchiveMember = collections.namedtuple('ArchiveMember', ['name', 'size', 'crc', 'digest'])
+
+# Members of this suffix are read as nested zips if they are zips
+NESTED_ZIP_SUFFIX = '.zip'
+# Nested zips deeper than this are kept as regular members
+MAX_NESTING_DEPTH = 2
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+# Member readers and detection functions of the archive formats by name, in detection
+# order, see register_archive_reader
+ARCHIVE_READERS = collections.OrderedDict()
+# File name patterns of the archive formats by name, e.g. to list the archives of a
+# directory, see register_archive_reader
+ARCHIVE_NAME_PATTERNS = collections.OrderedDict()
+
+_INVALID_PATH_PARTS = ('', os.curdir, os.pardir)
+
+
+def get_member_parts(name):
+    """Returns the components of the path a member named name is extracted to, relative
+    to the extraction directory: no absolute path, drive nor '..' component, as
+    ZipFile.extract does. Sorting members on their parts sorts them like their paths."""
+    name = os.path.splitdrive(name.replace('/', os.path.sep))[1]
+    return tuple(part for part in name.split(os.path.sep) if part not in _INVALID_PATH_PARTS)
+
+
+def get_member_path(extract_dir, name):
+    """Returns the path the member named name is extracted to in extract_dir"""
+    return os.path.join(extract_dir, *get_member_parts(name))
+
+
+def get_zip_name(name):
+    """Returns the name of a zip of the members of the archive named name: name for a
+    zip, name with its tar suffix replaced by .zip for a tar"""
+    for suffix in TAR_SUFFIXES:
+        if name.lower().endswith(suffix):
+            return name[:-len(suffix)] + '.zip'
+    return name
+
+
+def register_archive_reader(name, accepts, patterns=()):
+    """Function decorator registering the member reader of the archive format name
+
+    A member reader takes the path or binary file object of an archive and yields a
+    (name, size, crc, stream) tuple per file member, in archive order, the stream being
+    readable until the next member is yielded. Directories, links and the header index
+    are left out.
+
+    Args:
+        name (str): Name of the format, e.g. 'zip'.
+        accepts (callable): Returns True if the file at a path is an archive of the
+            format.
+        patterns (tuple): fnmatch patterns of the file names of archives of the format,
+            e.g. ('*.zip',).
+    """
+
+    def decorator(func):
+        ARCHIVE_READERS[name] = (accepts, func)
+        ARCHIVE_NAME_PATTERNS[name] = tuple(patterns)
+        return func
+
+    return decorator
+
+
+def get_archive_name_patterns():
+    """Returns the file name patterns of every registered archive format"""
+    return [pattern for patterns in ARCHIVE_NAME_PATTERNS.values() for pattern in patterns]
+
+
+def get_archive_format(path):
+    """Returns the name of the format of the archive at path, None if it is not an
+    archive, e.g. a single DICOM file"""
+    for name, (accepts, _) in ARCHIVE_READERS.items():
+        if accepts(path):
+            return name
+    return None
+
+
+def iter_zip_members(zipf):
+    """Yields the ZipInfo of the file members of the open zip, in archive order,
+    leaving out directories and the header index"""
+    for zip_info in zipf.infolist():
+        if not zip_info.is_dir() and zip_info.filename != HEADER_INDEX_MEMBER:
+            yield zip_info
+
+
+@register_archive_reader('zip', zipfile.is_zipfile, patterns=('*.zip',))
+def read_zip_members(file):
+    """Member reader of zips, see register_archive_reader"""
+    with zipfile.ZipFile(file) as zipf:
+        for zip_info in iter_zip_members(zipf):
+            with zipf.open(zip_info) as stream:
+                yield zip_info.filename, zip_info.file_size, zip_info.CRC, stream
+
+
+def is_tar_archive(path):
+    """Returns True if the file at path is a tar, compressed or not"""
+    return os.path.isfile(path) and tarfile.is_tarfile(path)
+
+
+@register_archive_reader('tar', is_tar_archive, patterns=tuple('*' + suffix for suffix in TAR_SUFFIXES))
+def read_tar_members(file):
+    """Member reader of tars, see register_archive_reader
+
+    The tar is read as a stream, compressed tars are therefore decompressed once, front
+    to back. Tar members have no CRC.
+    """
+    if isinstance(file, (str, os.PathLike)):
+        tarf = tarfile.open(file, mode='r|*')
+    else:
+        tarf = tarfile.open(fileobj=file, mode='r|*')
+    with tarf:
+        for tar_info in tarf:
+            if tar_info.isfile():
+                yield tar_info.name, tar_info.size, None, tarf.extractfile(tar_info)
+
+
+def _read_nested_zips(members, prefix='', depth=0):
+    """Yields the members of a member reader, reading the nested zips in place of their
+    member up to MAX_NESTING_DEPTH, see iter_member_streams"""
+    for name, size, crc, stream in members:
+        name = prefix + name
+        if depth >= MAX_NESTING_DEPTH or not name.lower().endswith(NESTED_ZIP_SUFFIX):
+            yield name, size, crc, stream
+            continue
+        # A zip is read from its central directory at its end, the nested zip is
+        # therefore spooled to a temporary file
+        with tempfile.TemporaryFile() as nested_file:
+            shutil.copyfileobj(stream, nested_file, DIGEST_CHUNK_SIZE)
+            if zipfile.is_zipfile(nested_file):
+                yield from _read_nested_zips(read_zip_members(nested_file), f'{name}/', depth + 1)
+            else:
+                nested_file.seek(0)
+                yield name, size, crc, nested_file
+
+
+def iter_member_streams(path):
+    """Yields a (name, size, crc, stream) tuple per file member of the archive at path, in
+    a single sequential pass, see register_archive_reader
+
+    The members of nested zips are yielded in place of the nested zip, named after it,
+    e.g. 'series1.zip/1.dcm'.
+
+    Raises:
+        ValueError: If the file at path is not an archive of a registered format.
+    """
+    archive_format = get_archive_format(path)
+    if archive_format is None:
+        raise ValueError(f'{os.path.basename(path)} is not an archive')
+    _, read_members = ARCHIVE_READERS[archive_format]
+    yield from _read_nested_zips(read_members(path))
+
+
+def write_member(stream, target_path, algorithm=DIGEST_ALGORITHM):
+    """Writes the content of the member stream to target_path, returns its hex digest,
+    computed as it is written so that it is not read twice"""
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    digest = hashlib.new(algorithm)
+    with open(target_path, 'wb') as target:
+        for chunk in iter(lambda: stream.read(DIGEST_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            target.write(chunk)
+    return digest.hexdigest()
+
+
+def extract_member(zipf, zip_info, output_directory, algorithm=DIGEST_ALGORITHM):
+    """
+    extracts a zip member like ZipFile.extract, computing the digest of its content as it
+    is written so that it is not read twice
+    :param zipf: the open zip
+    :param zip_info: ZipInfo of the member
+    :param output_directory: directory to which to extract the member
+    :param algorithm: hashlib algorithm of the digest
+    :return: the path of the extracted member and its hex digest, None for a directory
+    """
+    target_path = os.path.normpath(get_member_path(output_directory, zip_info.filename))
+    if zip_info.is_dir():
+        os.makedirs(target_path, exist_ok=True)
+        return target_path, None
+    with zipf.open(zip_info) as source:
+        return target_path, write_member(source, target_path, algorithm)
+
+
+def iter_archive_members(path, extract_dir):
+    """Extracts the file members of the archive at path to extract_dir one at a time,
+    yielding the ArchiveMember of each once it is on disk, in archive order, see
+    iter_member_streams"""
+    for name, size, crc, stream in iter_member_streams(path):
+        yield ArchiveMember(name, size, crc, write_member(stream, get_member_path(extract_dir, name)))
+
+
+def extract_archive_members(path, extract_dir):
+    """Extracts the file members of the archive at path to extract_dir
+
+    Returns:
+        list: The ArchiveMember of each extracted file, sorted by path. Of members
+            extracted to the same path, only the last one, whose content is on disk, is
+            kept.
+    """
+    members = dict()
+    for member in iter_archive_members(path, extract_dir):
+        members[get_member_parts(member.name)] = member
+    return [members[parts] for parts in sorted(members)]
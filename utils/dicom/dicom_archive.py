@@ -11,7 +11,12 @@ import zipfile
 import pydicom
 from pydicom.multival import MultiValue
 
+from .. import metrics
+from ..hashing import DuplicateFinder
+from .archive_reader import get_archive_format, get_member_path, get_zip_name, iter_archive_members
 from .dicom_metadata import get_pydicom_header
+from .dicomdir import is_dicomdir, plan_members
+from .header_index import read_header_index, write_header_index
 
 log = logging.getLogger(__name__)
 
@@ -37,10 +42,30 @@ def make_list_items_hashable(input_list):
     return output_list
 
 
-def create_zip_from_file_list(root_dir, file_list, output_path, comment=None):
-    with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for fp in file_list:
-            zipf.write(fp, os.path.relpath(fp, root_dir))
+def create_zip_from_file_list(root_dir, file_list, output_path, comment=None, header_dicts=None,
+                              header_namespace=None):
+    """
+    zips the files in file_list, optionally embedding the header index of the members
+    :param root_dir: directory the member names are relative to
+    :param file_list: paths of the files to zip
+    :param output_path: path of the zip to create
+    :param comment: archive comment
+    :param header_dicts: header dictionaries keyed by file path, written to the header index
+    :param header_namespace: header extraction version and options header_dicts were extracted with
+    :return: output_path
+    """
+    with metrics.stage('write_zip', members=len(file_list)) as counters:
+        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for fp in file_list:
+                zipf.write(fp, os.path.relpath(fp, root_dir))
+            if header_dicts is not None and header_namespace is not None:
+                index_dicts = {
+                    os.path.relpath(fp, root_dir): header_dicts[fp] for fp in file_list if fp in header_dicts
+                }
+                write_header_index(zipf, index_dicts, header_namespace)
+            if comment:
+                zipf.comment = comment.encode('utf-8') if isinstance(comment, str) else comment
+        counters['bytes_written'] = os.path.getsize(output_path)
     return output_path
 
 
@@ -76,38 +101,79 @@ def extract_files(zip_path, output_directory):
 
 
 class DicomFile:
-    def __init__(self, file_path, root_path, force=False):
+    # The dataset and header_dict are read from the file
+    planned = False
+
+    def __init__(self, file_path, root_path, force=False, header_func=None, header_dict=None,
+                 stop_before_pixels=False):
         self.path = file_path
         self.relpath = os.path.relpath(file_path, root_path)
         filename = os.path.basename(file_path)
         try:
-            self.dataset = pydicom.dcmread(file_path, force=force)
+            self.dataset = pydicom.dcmread(file_path, force=force, stop_before_pixels=stop_before_pixels)
 
         except Exception as e:
             log.error(f'Exception occurred when reading {filename}: {e}')
             self.dataset = None
+        if header_dict is not None and self.dataset:
+            # Header already extracted, e.g. found in the archive header index
+            self.header_dict = header_dict
+            return
         try:
-            self.header_dict = get_pydicom_header(self.dataset)
+            self.header_dict = (header_func or get_pydicom_header)(self.dataset)
         except Exception as e:
             log.error(f'Exception occurred when parsing header for  {filename}: {e}')
             self.header_dict = None
 
 
+class PlannedDicomFile:
+    """Member of an archive planned from its DICOMDIR record, see utils.dicom.dicomdir,
+    without reading it: its dataset and header_dict only hold the attributes of the
+    record"""
+    planned = True
+
+    def __init__(self, file_path, root_path, record):
+        self.path = file_path
+        self.relpath = os.path.relpath(file_path, root_path)
+        self.header_dict = dict(record)
+        self.dataset = pydicom.Dataset()
+        for keyword, value in record.items():
+            setattr(self.dataset, keyword, value)
+
+
 class DicomArchive:
-    def __init__(self, zip_path, extract_dir, dataset_list=False, force=False, validate=True):
+    def __init__(self, zip_path, extract_dir, dataset_list=False, force=False, validate=True, header_func=None,
+                 header_namespace=None, drop_duplicates=False, stop_before_pixels=False, use_dicomdir=False):
         self.path = zip_path
         self.dataset = None
         self.dataset_list = None
         self.extract_dir = extract_dir
         self.force = force
-        if zipfile.is_zipfile(self.path):
-            with zipfile.ZipFile(self.path) as zipf:
-                file_list = zipf.namelist()
-                # Get full paths and remove directories from list
-                self.file_list = [fp for fp in file_list if not fp.endswith(os.path.sep)]
-        else:
-            log.info(f'{self.path} is not a zip')
-            self.file_list = [self.path]
+        # header_func extracts DicomFile.header_dict, if header_namespace is set the
+        # headers are carried over to the header index of the split archives
+        self.header_func = header_func
+        self.header_namespace = header_namespace
+        # If drop_duplicates, members of identical content to a previous member are left
+        # out of the dataset list, hence of the split archives
+        self.drop_duplicates = drop_duplicates
+        self.dropped_duplicates = list()
+        # Digests of the members by name, computed on extraction
+        self.member_digests = dict()
+        # If stop_before_pixels, the datasets are read without their pixel data, so
+        # that the dataset list of large archives fits in memory
+        self.stop_before_pixels = stop_before_pixels
+        # If use_dicomdir, DICOMDIR members are left out of the dataset list, and the
+        # dataset list of an archive with a DICOMDIR that agrees with its members is
+        # planned from the DICOMDIR. The datasets then only hold the SeriesInstanceUID,
+        # SOPInstanceUID, SOPClassUID, Modality, SeriesNumber and InstanceNumber.
+        self.use_dicomdir = use_dicomdir
+        self.dicomdir_plan = None
+        # Number of members read by initialize_dataset, all of them unless a dataset was
+        # found and dataset_list is False
+        self.member_count = 0
+        self.archive_format = get_archive_format(self.path)
+        if self.archive_format is None:
+            log.info(f'{self.path} is not an archive')
         try:
             self.initialize_dataset(dataset_list=dataset_list)
         except Exception as e:
@@ -120,41 +186,75 @@ class DicomArchive:
         if not os.path.exists(self.path):
             error_detail = f'File {basename} does not exist! Exiting...'
             raise FileNotFoundError(error_detail)
-        elif not self.file_list:
+        elif not self.member_count:
             error_detail = f'No files were found within archive {basename}! Exiting...'
             raise RuntimeError(error_detail)
         elif not self.dataset:
-            error_detail = f'failed to parse DICOMs at {basename}. File list: {self.file_list}. Exiting...'
+            error_detail = f'failed to parse DICOMs at {basename}. Member count: {self.member_count}. Exiting...'
             raise RuntimeError(error_detail)
         return None
 
     def initialize_dataset(self, dataset_list=False):
         if dataset_list:
             self.dataset_list = list()
-        if zipfile.is_zipfile(self.path):
-            for fp in self.file_list:
+        if self.archive_format is not None:
+            header_index = dict()
+            duplicate_finder = DuplicateFinder()
+            self.member_count = 0
+            if self.archive_format == 'zip' and self.header_namespace is not None:
                 with zipfile.ZipFile(self.path) as zipf:
-                    extract_path = zipf.extract(fp, self.extract_dir)
-                    if os.path.isfile(extract_path):
-                        dicom_file = DicomFile(extract_path, self.extract_dir, force=self.force)
-                        file_dataset = dicom_file.dataset
-                        if file_dataset:
-                            # Here we check for the Raw Data Storage SOP Class, if there
-                            # are other pydicom files in the zip then we read the next one,
-                            # if this is the only class of pydicom in the file, we accept
-                            # our fate and move on.
-                            if file_dataset.get('SOPClassUID') == 'Raw Data Storage' and not self.dataset:
-                                log.info(f'{os.path.basename(fp)} is Raw Data Storage. Skipping...')
-                                continue
-                            if dataset_list:
-                                self.dataset_list.append(dicom_file)
-                                if not self.dataset:
-                                    self.dataset = file_dataset
-                            else:
-                                self.dataset = file_dataset
-                                break
+                    header_index = read_header_index(zipf, self.header_namespace)
+            members = iter_archive_members(self.path, self.extract_dir)
+            self.dicomdir_plan = None
+            if dataset_list and self.use_dicomdir:
+                # Every member is extracted before any is read, the DICOMDIR can be
+                # anywhere in the archive
+                members = list(members)
+                self.dicomdir_plan = plan_members(members, self.extract_dir, force=self.force)
+            for member in members:
+                fp = member.name
+                extract_path = get_member_path(self.extract_dir, fp)
+                self.member_count += 1
+                self.member_digests[fp] = member.digest
+                if self.use_dicomdir and is_dicomdir(fp):
+                    # Not an instance, whether or not it agrees with the members
+                    continue
+                if self.drop_duplicates:
+                    original_path = duplicate_finder.find(extract_path, (member.crc, member.size), member.digest)
+                    if original_path:
+                        log.info(f'{fp} is a duplicate of {os.path.relpath(original_path, self.extract_dir)}. '
+                                 f'Dropping...')
+                        self.dropped_duplicates.append(fp)
+                        continue
+                if self.dicomdir_plan is not None:
+                    dicom_file = PlannedDicomFile(extract_path, self.extract_dir, self.dicomdir_plan[fp])
+                else:
+                    dicom_file = DicomFile(
+                        extract_path, self.extract_dir, force=self.force, header_func=self.header_func,
+                        header_dict=header_index.get(fp), stop_before_pixels=self.stop_before_pixels
+                    )
+                file_dataset = dicom_file.dataset
+                if file_dataset:
+                    # Here we check for the Raw Data Storage SOP Class, if there
+                    # are other pydicom files in the zip then we read the next one,
+                    # if this is the only class of pydicom in the file, we accept
+                    # our fate and move on.
+                    if file_dataset.get('SOPClassUID') == 'Raw Data Storage' and not self.dataset:
+                        log.info(f'{os.path.basename(fp)} is Raw Data Storage. Skipping...')
+                        continue
+                    if dataset_list:
+                        self.dataset_list.append(dicom_file)
+                        if not self.dataset:
+                            self.dataset = file_dataset
+                    else:
+                        self.dataset = file_dataset
+                        break
         elif os.path.isfile(self.path):
-            dicom_file = DicomFile(self.path, os.path.dirname(self.path), self.force)
+            self.member_count = 1
+            dicom_file = DicomFile(
+                self.path, os.path.dirname(self.path), self.force, header_func=self.header_func,
+                stop_before_pixels=self.stop_before_pixels
+            )
             file_dataset = dicom_file.dataset
             if file_dataset:
                 self.dataset = file_dataset
@@ -214,14 +314,28 @@ class DicomArchive:
 
         tag_dict = self.dicom_tag_value_dict(dicom_tag)
         top_value = max(tag_dict, key=lambda x: len(tag_dict[x]))
-
+        zip_kwargs = dict()
+        if self.header_namespace is not None:
+            zip_kwargs = {
+                'header_dicts': {
+                    dcm.path: dcm.header_dict for dcm in self.dataset_list
+                    if dcm.header_dict is not None and not dcm.planned
+                },
+                'header_namespace': self.header_namespace
+            }
+
+        # Split archives are zips, whatever the format of the archive
+        archive_name = get_zip_name(os.path.basename(self.path))
+        out_paths = list()
         index = 1
         for tag_value, image_paths in tag_dict.items():
             if tag_value == top_value:
-                out_path = os.path.join(output_dir, os.path.basename(self.path))
-                create_zip_from_file_list(self.extract_dir, image_paths, out_path)
+                out_path = os.path.join(output_dir, archive_name)
+                create_zip_from_file_list(self.extract_dir, image_paths, out_path, **zip_kwargs)
+                out_paths.append(out_path)
                 if len(tag_dict.keys()) == 2 and not all_unique:
-                    other_image_paths = [dcm.path for dcm in self.dataset_list if dcm.path not in image_paths]
+                    top_image_paths = set(image_paths)
+                    other_image_paths = [dcm.path for dcm in self.dataset_list if dcm.path not in top_image_paths]
                     if not append_str:
                         dcm = pydicom.dcmread(other_image_paths[0])
                         sd_safe = re.sub(SERIES_DESCRIPTION_SANITIZER, '_', dcm.SeriesDescription)
@@ -230,7 +344,8 @@ class DicomArchive:
                         app_str = append_str
                     out_path = append_str_to_dcm_zip_path(out_path, app_str)
                     log.info('Creating {out_path}...')
-                    create_zip_from_file_list(self.extract_dir, other_image_paths, out_path)
+                    create_zip_from_file_list(self.extract_dir, other_image_paths, out_path, **zip_kwargs)
+                    out_paths.append(out_path)
             elif len(tag_dict.keys()) >= 2 and all_unique:
                 if not append_str:
                     dcm = pydicom.dcmread(image_paths[0])
@@ -240,12 +355,14 @@ class DicomArchive:
                     app_str = append_str
                     tmp_append_str = app_str + str(index)
                     index += 1
-                basename = append_str_to_dcm_zip_path(os.path.basename(self.path), tmp_append_str)
+                basename = append_str_to_dcm_zip_path(archive_name, tmp_append_str)
                 out_path = os.path.join(output_dir, basename)
                 log.info('Creating {out_path}...')
-                create_zip_from_file_list(self.extract_dir, image_paths, out_path)
+                create_zip_from_file_list(self.extract_dir, image_paths, out_path, **zip_kwargs)
+                out_paths.append(out_path)
             else:
                 continue
+        return out_paths
 
     @staticmethod
     def _iop_means(iop_val_list):
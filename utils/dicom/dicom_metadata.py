@@ -3,7 +3,6 @@ import logging
 import re
 import string
 
-import nibabel
 import pytz
 import tzlocal
 import pydicom
@@ -71,6 +70,9 @@ def get_seq_data(sequence, ignore_keys):
 
 
 def get_csa_header(dcm):
+    # nibabel is slow to import and only needed for Siemens data
+    import nibabel.nicom.dicomwrappers
+
     exclude_tags = ["PhoenixZIP", "SrMsgBuffer"]
     header = {}
     try:
@@ -0,0 +1,176 @@
+"""Plans of the members of archives with a DICOMDIR, e.g. CD or PACS exports
+
+A DICOMDIR lists every instance of an export along with its series. When it agrees with
+the members of the archive, the series of each member is taken from its directory
+record instead of its header, only the first member of each series being read to
+confirm the record:
+
+    plan = plan_members(members, extract_dir)  # None if it disagrees, or no DICOMDIR
+    if plan is not None:
+        record = plan[member.name]  # e.g. record['SeriesInstanceUID']
+"""
+import logging
+
+import pydicom
+
+from .archive_reader import get_member_parts, get_member_path
+
+log = logging.getLogger(__name__)
+
+DICOMDIR_NAME = 'DICOMDIR'
+# Attributes of the planned record of a member, by keyword of the directory record,
+# from the record of the instance or of its series
+RECORD_KEYWORDS = {
+    'ReferencedSOPInstanceUIDInFile': 'SOPInstanceUID',
+    'ReferencedSOPClassUIDInFile': 'SOPClassUID',
+    'InstanceNumber': 'InstanceNumber',
+    'SeriesInstanceUID': 'SeriesInstanceUID',
+    'SeriesNumber': 'SeriesNumber',
+    'Modality': 'Modality',
+}
+# Attributes of the records checked against the header of the member they reference
+CONFIRMED_KEYWORDS = ['SeriesInstanceUID', 'SOPInstanceUID']
+
+
+def is_dicomdir(name):
+    """Returns True if the member named name is a DICOMDIR"""
+    parts = get_member_parts(name)
+    return bool(parts) and parts[-1].upper() == DICOMDIR_NAME
+
+
+def _get_record_values(record):
+    """Returns the planned attributes of the directory record, see RECORD_KEYWORDS"""
+    values = dict()
+    for record_keyword, keyword in RECORD_KEYWORDS.items():
+        value = record.get(record_keyword)
+        if value is None or value == '':
+            continue
+        values[keyword] = int(value) if keyword in ('InstanceNumber', 'SeriesNumber') else str(value)
+    return values
+
+
+def _get_file_key(file_id):
+    """Returns the key of the file referenced by the ReferencedFileID file_id, its path
+    components relative to the DICOMDIR, case insensitive"""
+    if isinstance(file_id, str):
+        file_id = file_id.replace('\\', '/').split('/')
+    return tuple(str(part).casefold() for part in file_id)
+
+
+def read_dicomdir_records(path):
+    """Returns the planned record of each file listed in the DICOMDIR at path
+
+    The records are walked from the root directory entity along the record offsets,
+    whatever their order in the directory record sequence and the offset of the root
+    directory entity. The record of a file holds the attributes of its record and of
+    the SERIES record above it, see RECORD_KEYWORDS.
+
+    Returns:
+        dict: Planned records by file key (see _get_file_key), None if the DICOMDIR
+            cannot be read, its records are inconsistent or a file record is missing
+            its SeriesInstanceUID.
+    """
+    try:
+        dicomdir = pydicom.dcmread(path, force=True)
+        records_by_offset = {record.seq_item_tell: record for record in dicomdir.DirectoryRecordSequence}
+    except Exception as exc:
+        log.info('Cannot read the DICOMDIR %s: %s', path, exc)
+        return None
+    # The records of the root directory entity are those no record points to
+    referenced_offsets = set()
+    for record in records_by_offset.values():
+        referenced_offsets.add(record.get('OffsetOfTheNextDirectoryRecord'))
+        referenced_offsets.add(record.get('OffsetOfReferencedLowerLevelDirectoryEntity'))
+
+    file_records = dict()
+    visited_offsets = set()
+    # (offset of the record, values of the series above it)
+    pending = [(offset, {}) for offset in records_by_offset if offset not in referenced_offsets]
+    while pending:
+        offset, series_values = pending.pop()
+        if not offset:
+            continue
+        record = records_by_offset.get(offset)
+        if record is None or offset in visited_offsets:
+            log.info('Directory record offset %s of %s is invalid', offset, path)
+            return None
+        visited_offsets.add(offset)
+        pending.append((record.get('OffsetOfTheNextDirectoryRecord'), series_values))
+        if record.get('DirectoryRecordType') == 'SERIES':
+            child_values = _get_record_values(record)
+        else:
+            child_values = series_values
+        pending.append((record.get('OffsetOfReferencedLowerLevelDirectoryEntity'), child_values))
+        file_id = record.get('ReferencedFileID')
+        if file_id and record.get('DirectoryRecordType') != 'SERIES':
+            values = dict(series_values, **_get_record_values(record))
+            if not values.get('SeriesInstanceUID'):
+                log.info('File %s of %s is not in a series', file_id, path)
+                return None
+            file_records[_get_file_key(file_id)] = values
+    return file_records
+
+
+def confirm_record(path, record, force=False):
+    """Returns True if the header of the DICOM file at path agrees with its planned
+    record on CONFIRMED_KEYWORDS, only these attributes are read"""
+    try:
+        dataset = pydicom.dcmread(path, force=force, stop_before_pixels=True, specific_tags=CONFIRMED_KEYWORDS)
+    except Exception as exc:
+        log.info('Cannot read %s: %s', path, exc)
+        return False
+    return all(
+        dataset.get(keyword) == record[keyword] for keyword in CONFIRMED_KEYWORDS if keyword in record
+    )
+
+
+def plan_members(members, extract_dir, force=False):
+    """Returns the planned record of the members of an archive from its DICOMDIR
+
+    The DICOMDIR agrees with the members if it lists every member but itself, every
+    file it lists is a member and the first member of each series, in archive order,
+    has the SeriesInstanceUID and SOPInstanceUID of its record.
+
+    Args:
+        members (list): ArchiveMember of each member of the archive, see
+            utils.dicom.archive_reader.iter_archive_members.
+        extract_dir (str): Directory the members are extracted to.
+        force (bool): Force reading of files missing the DICOM preamble.
+
+    Returns:
+        dict: The planned record of each member but the DICOMDIR by name, None if the
+            archive does not have exactly one DICOMDIR or it disagrees with the
+            members, which must then all be read.
+    """
+    dicomdir_names = [member.name for member in members if is_dicomdir(member.name)]
+    if len(dicomdir_names) != 1:
+        return None
+    dicomdir_name = dicomdir_names[0]
+    file_records = read_dicomdir_records(get_member_path(extract_dir, dicomdir_name))
+    if file_records is None:
+        return None
+
+    prefix = get_member_parts(dicomdir_name)[:-1]
+    plan = dict()
+    confirmed_series = set()
+    for member in members:
+        if member.name == dicomdir_name:
+            continue
+        parts = get_member_parts(member.name)
+        record = None
+        if parts[:len(prefix)] == prefix:
+            record = file_records.pop(tuple(part.casefold() for part in parts[len(prefix):]), None)
+        if record is None:
+            log.info('%s is not listed in %s, reading every member', member.name, dicomdir_name)
+            return None
+        if record['SeriesInstanceUID'] not in confirmed_series:
+            if not confirm_record(get_member_path(extract_dir, member.name), record, force=force):
+                log.info('%s disagrees with %s, reading every member', member.name, dicomdir_name)
+                return None
+            confirmed_series.add(record['SeriesInstanceUID'])
+        plan[member.name] = record
+    if file_records:
+        log.info('%s files listed in %s are missing, reading every member', len(file_records), dicomdir_name)
+        return None
+    log.info('Planned %s members from %s', len(plan), dicomdir_name)
+    return plan
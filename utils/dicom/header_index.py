@@ -0,0 +1,73 @@
+"""Per-member header index embedded in the archives written by the splitter"""
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+HEADER_INDEX_VERSION = 1
+HEADER_INDEX_MEMBER = '.grp3_header_index.json'
+HEADER_INDEX_COMMENT = f'grp3-header-index:v{HEADER_INDEX_VERSION}:{HEADER_INDEX_MEMBER}'
+
+
+def write_header_index(zipf, header_dicts, namespace):
+    """Writes the header index member to an open zip
+
+    Must be called after all the DICOM members have been written, the CRC and size
+    of each member are read back from the zip so that readers can check them.
+
+    Args:
+        zipf (zipfile.ZipFile): Zip opened for writing.
+        header_dicts (dict): Header dictionaries keyed by member name.
+        namespace (str): Header extraction version and options the headers were
+            extracted with.
+    """
+    members = dict()
+    for arcname, header_dict in header_dicts.items():
+        zip_info = zipf.getinfo(arcname)
+        members[arcname] = {
+            'crc': zip_info.CRC,
+            'size': zip_info.file_size,
+            'header': header_dict
+        }
+    index = {'version': HEADER_INDEX_VERSION, 'namespace': namespace, 'members': members}
+    try:
+        index_str = json.dumps(index, separators=(',', ':'))
+    except (TypeError, ValueError):
+        log.warning('Header index could not be serialized, skipping it', exc_info=True)
+        return
+    zipf.writestr(HEADER_INDEX_MEMBER, index_str)
+    zipf.comment = HEADER_INDEX_COMMENT.encode('utf-8')
+
+
+def read_header_index(zipf, namespace):
+    """Returns the header dictionaries of the zip members that match the index
+
+    A member is only trusted if the index was written with the same namespace and
+    its CRC and size match the ones of the member in the zip central directory.
+
+    Args:
+        zipf (zipfile.ZipFile): Zip opened for reading.
+        namespace (str): Header extraction version and options of the reader.
+
+    Returns:
+        dict: Header dictionaries keyed by member name.
+    """
+    if HEADER_INDEX_MEMBER not in zipf.NameToInfo:
+        return dict()
+    try:
+        index = json.loads(zipf.read(HEADER_INDEX_MEMBER))
+    except (ValueError, OSError):
+        log.warning('Failed to read the header index, ignoring it', exc_info=True)
+        return dict()
+    if index.get('version') != HEADER_INDEX_VERSION or index.get('namespace') != namespace:
+        log.info('Header index was written by a different header extraction, ignoring it')
+        return dict()
+
+    header_dicts = dict()
+    for arcname, member in index.get('members', {}).items():
+        zip_info = zipf.NameToInfo.get(arcname)
+        if zip_info and zip_info.CRC == member.get('crc') and zip_info.file_size == member.get('size'):
+            header_dicts[arcname] = member['header']
+    log.info('Header index matches %s of %s members', len(header_dicts), len(index.get('members', {})))
+    return header_dicts
+
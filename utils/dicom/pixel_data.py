@@ -0,0 +1,143 @@
+"""Consistency checks of the pixel data of DICOM files, without loading nor decoding it
+
+The pixel data element header is read where pydicom.dcmread(fp, stop_before_pixels=True)
+leaves the file, its value is then seeked past: only the element and item headers are
+read, whatever the size of the pixel data.
+"""
+import logging
+import os
+import struct
+
+import pydicom
+
+log = logging.getLogger(__name__)
+
+# FloatPixelData, DoubleFloatPixelData and PixelData
+PIXEL_DATA_TAGS = (0x7FE00008, 0x7FE00009, 0x7FE00010)
+ITEM_TAG = 0xFFFEE000
+SEQUENCE_DELIMITER_TAG = 0xFFFEE0DD
+UNDEFINED_LENGTH = 0xFFFFFFFF
+# VRs of explicit VR elements with a 4 bytes length
+LONG_LENGTH_VRS = (b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'UC', b'UN', b'UR', b'UT')
+# Attributes the expected pixel data length is computed from
+PIXEL_DESCRIPTION_KEYWORDS = ['Rows', 'Columns', 'SamplesPerPixel', 'BitsAllocated', 'NumberOfFrames']
+
+
+def get_number_of_frames(dataset):
+    """Returns the NumberOfFrames of dataset, 1 if missing or invalid"""
+    try:
+        return max(int(dataset.get('NumberOfFrames') or 1), 1)
+    except (TypeError, ValueError):
+        return 1
+
+
+def get_expected_pixel_data_length(dataset):
+    """Returns the length in bytes of the native pixel data described by dataset, None if
+    Rows, Columns or BitsAllocated is missing"""
+    rows, columns, bits_allocated = dataset.get('Rows'), dataset.get('Columns'), dataset.get('BitsAllocated')
+    if not rows or not columns or not bits_allocated:
+        return None
+    samples_per_pixel = dataset.get('SamplesPerPixel') or 1
+    bit_count = rows * columns * samples_per_pixel * bits_allocated * get_number_of_frames(dataset)
+    return (bit_count + 7) // 8
+
+
+def _read_tag_and_length(fp, endian, is_implicit_VR):
+    """Reads an element header, returns (tag, length), None at the end of the file"""
+    data = fp.read(8)
+    if len(data) < 8:
+        return None
+    group, element = struct.unpack(endian + 'HH', data[:4])
+    tag = group << 16 | element
+    if is_implicit_VR or tag in (ITEM_TAG, SEQUENCE_DELIMITER_TAG):
+        return tag, struct.unpack(endian + 'L', data[4:])[0]
+    if data[4:6] in LONG_LENGTH_VRS:
+        data = fp.read(4)
+        if len(data) < 4:
+            return None
+        return tag, struct.unpack(endian + 'L', data)[0]
+    return tag, struct.unpack(endian + 'H', data[6:])[0]
+
+
+def _check_fragments(fp, endian, file_size, frame_count):
+    """Walks the items of encapsulated pixel data, returns an error message or None"""
+    item_count = 0
+    while True:
+        tag_and_length = _read_tag_and_length(fp, endian, True)
+        if tag_and_length is None:
+            return 'truncated, the sequence delimiter is missing'
+        tag, length = tag_and_length
+        if tag == SEQUENCE_DELIMITER_TAG:
+            break
+        if tag != ITEM_TAG:
+            return f'unexpected tag {tag:08X} in the encapsulated pixel data'
+        if length == UNDEFINED_LENGTH or fp.tell() + length > file_size:
+            return f'truncated in fragment {item_count}'
+        fp.seek(length, os.SEEK_CUR)
+        item_count += 1
+    # The first item is the basic offset table
+    fragment_count = item_count - 1
+    if fragment_count < 1:
+        return 'no fragment in the encapsulated pixel data'
+    if fragment_count < frame_count:
+        return f'{fragment_count} fragments for {frame_count} frames'
+    return None
+
+
+def check_pixel_data(fp, dataset, file_size):
+    """Checks the pixel data element of a DICOM file against its pixel description
+
+    Native pixel data must have the length computed from Rows, Columns,
+    SamplesPerPixel, BitsAllocated and NumberOfFrames (plus a padding byte), encapsulated
+    pixel data must have at least a fragment per frame, and neither may go past the end
+    of the file.
+
+    Args:
+        fp (file): The file, positioned at the pixel data element, as left by
+            pydicom.dcmread(fp, stop_before_pixels=True).
+        dataset (pydicom.Dataset): The dataset read from fp.
+        file_size (int): Size of the file in bytes.
+
+    Returns:
+        str: Description of the inconsistency, None if the pixel data is consistent,
+            missing or cannot be checked (deflated, private or unknown transfer
+            syntax).
+    """
+    transfer_syntax = getattr(getattr(dataset, 'file_meta', None), 'TransferSyntaxUID', None)
+    is_compressed = False
+    if transfer_syntax is not None:
+        try:
+            if transfer_syntax.is_deflated:
+                return None
+            is_compressed = transfer_syntax.is_compressed
+        except ValueError:
+            # Private or unknown transfer syntax, whose encoding pydicom does not know
+            return None
+    endian = '<' if dataset.is_little_endian in (True, None) else '>'
+    is_implicit_VR = bool(dataset.is_implicit_VR)
+    tag_and_length = _read_tag_and_length(fp, endian, is_implicit_VR)
+    if tag_and_length is None or tag_and_length[0] not in PIXEL_DATA_TAGS:
+        return None
+    _, length = tag_and_length
+
+    if length == UNDEFINED_LENGTH:
+        return _check_fragments(fp, endian, file_size, get_number_of_frames(dataset))
+    available_length = file_size - fp.tell()
+    if length > available_length:
+        return f'truncated, {available_length} of {length} bytes'
+    if is_compressed:
+        return None
+    expected_length = get_expected_pixel_data_length(dataset)
+    if expected_length is not None and length not in (expected_length, expected_length + 1):
+        return f'{length} bytes, {expected_length} expected'
+    return None
+
+
+def read_pixel_data_error(path, force=False):
+    """Returns the pixel data inconsistency of the DICOM file at path, see
+    check_pixel_data, only reading its pixel description and the element headers"""
+    with open(path, 'rb') as fp:
+        dataset = pydicom.dcmread(
+            fp, force=force, stop_before_pixels=True, specific_tags=PIXEL_DESCRIPTION_KEYWORDS
+        )
+        return check_pixel_data(fp, dataset, os.path.getsize(path))
@@ -0,0 +1,30 @@
+"""Errors stopping the processing of a DICOM archive or file"""
+
+
+class GRP3Error(Exception):
+    """Base class of the errors stopping the processing of a DICOM archive or file
+
+    Args:
+        message (str): The error message.
+        validation_errors (list): Error dicts to write to the error file, if any.
+    """
+
+    def __init__(self, message, validation_errors=None):
+        super().__init__(message)
+        self.validation_errors = validation_errors or []
+
+
+class EmptyFileError(GRP3Error):
+    """The input file is empty"""
+
+
+class CorruptedZipError(GRP3Error):
+    """The input archive cannot be extracted"""
+
+
+class NoDicomFileError(GRP3Error):
+    """No file of the input can be parsed as DICOM"""
+
+
+class InvalidTemplateError(GRP3Error):
+    """The json_template is not a valid JSON schema"""
@@ -0,0 +1,100 @@
+"""Content digests of files and detection of files of identical content"""
+import hashlib
+import logging
+
+log = logging.getLogger(__name__)
+
+DIGEST_ALGORITHM = 'sha256'
+DIGEST_CHUNK_SIZE = 1024 * 1024
+
+
+def get_stream_digest(fp, algorithm=DIGEST_ALGORITHM):
+    """Returns the hex digest of the content of the binary file object fp, read by
+    chunks"""
+    digest = hashlib.new(algorithm)
+    for chunk in iter(lambda: fp.read(DIGEST_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_file_digest(path, algorithm=DIGEST_ALGORITHM):
+    """Returns the hex digest of the content of the file at path, read by chunks"""
+    with open(path, 'rb') as fp:
+        return get_stream_digest(fp, algorithm)
+
+
+def get_fingerprint(member_digests, algorithm=DIGEST_ALGORITHM):
+    """Returns the digest of the sorted names and digests of the members, a fingerprint
+    of an archive independent of the order and compression of its members, not of
+    their names
+
+    Args:
+        member_digests (dict): Digests of the members by name.
+    """
+    lines = sorted(f'{name}\0{digest}' for name, digest in member_digests.items())
+    return hashlib.new(algorithm, '\n'.join(lines).encode()).hexdigest()
+
+
+def get_checksums(member_digests, algorithm=DIGEST_ALGORITHM):
+    """Returns the checksums stored in the file info: the algorithm, the fingerprint of
+    the archive and its number of members. The digests of the members, megabytes for
+    large archives, are left to get_member_checksums.
+
+    Args:
+        member_digests (dict): Digests of the members by name.
+    """
+    return {
+        'algorithm': algorithm,
+        'fingerprint': get_fingerprint(member_digests, algorithm),
+        'member_count': len(member_digests),
+    }
+
+
+def get_member_checksums(member_digests, algorithm=DIGEST_ALGORITHM):
+    """Returns the checksums of get_checksums along with the digest of each member by
+    name, see run.process_dicom
+
+    Args:
+        member_digests (dict): Digests of the members by name.
+    """
+    return dict(get_checksums(member_digests, algorithm), members=dict(sorted(member_digests.items())))
+
+
+class DuplicateFinder:
+    """Finds files of identical content among the files added one at a time
+
+    Files are first compared on a cheap key, e.g. their zip CRC and size. Their digest
+    is only computed when keys collide, i.e. for likely duplicates.
+    """
+
+    def __init__(self):
+        # [path, digest or None if not computed yet] of the files by key
+        self._candidates = dict()
+
+    def find(self, path, key, digest=None):
+        """Adds the file at path and returns the path of a previously added file of
+        identical content, None if there is none
+
+        Args:
+            path (str): Path of the file.
+            key (hashable): Key of the file content, files of different keys are never
+                compared.
+            digest (str): Digest of the file if already known, the file is then not
+                read.
+        """
+        candidates = self._candidates.setdefault(key, [])
+        if not candidates:
+            candidates.append([path, digest])
+            return None
+        try:
+            digest = digest or get_file_digest(path)
+            for candidate in candidates:
+                if candidate[1] is None:
+                    candidate[1] = get_file_digest(candidate[0])
+                if candidate[1] == digest:
+                    return candidate[0]
+        except OSError as exc:
+            log.warning('Cannot compare the content of %s: %s', path, exc)
+            return None
+        candidates.append([path, digest])
+        return None
@@ -0,0 +1,175 @@
+"""Persistent content-addressed cache of per-slice DICOM header records"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+log = logging.getLogger(__name__)
+
+# Bump when the layout of the cached records changes
+HEADER_CACHE_VERSION = 1
+DEFAULT_MAX_SIZE_MB = 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+# File tracking the size of the cache as records are written, so that pruning only
+# scans the cache once it is over budget
+SIZE_FILE_NAME = 'size.json'
+
+
+class HeaderCache:
+    """On-disk cache of extracted header records keyed on member content.
+
+    Records are stored as one JSON file per key under `cache_dir`. Keys are derived
+    from the SHA-256 digest of the member content, computed on extraction, combined
+    with `namespace` so that a change of header extraction code or options never
+    serves stale records. A CRC32 and size key is not used: slices of a series mostly
+    have the same size, CRC32 collisions across a shared cache would serve the header
+    of another slice. Least recently used
+    records are evicted by `prune` when the cache grows past `max_bytes`, which is
+    tracked in `SIZE_FILE_NAME` as records are written rather than scanned every job.
+
+    Args:
+        cache_dir (str): Directory holding the cache, may be a shared volume.
+        max_bytes (int): Size budget of the cache in bytes.
+        namespace (str): Identifies the header extraction version and options.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_SIZE_MB * 1024 ** 2, namespace=''):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.namespace = f'v{HEADER_CACHE_VERSION}:{namespace}'
+        self.hits = 0
+        self.misses = 0
+        # Bytes of the records put since the last prune
+        self.bytes_written = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _key(self, *parts):
+        key_str = ':'.join([self.namespace] + [str(part) for part in parts])
+        return hashlib.sha256(key_str.encode('utf-8')).hexdigest()
+
+    def digest_key(self, digest):
+        """Returns the cache key of a file given the SHA-256 hex digest of its content"""
+        return self._key('sha256', digest)
+
+    def file_key(self, file_path):
+        """Returns the cache key of a file given the SHA-256 of its content"""
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return self.digest_key(digest.hexdigest())
+
+    def _record_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def get(self, key):
+        """Returns the record stored under key or None on a miss.
+
+        A hit refreshes the record modification time, which is what `prune` uses as
+        the last access time.
+        """
+        record_path = self._record_path(key)
+        try:
+            with open(record_path) as fp:
+                record = json.load(fp)
+            os.utime(record_path)
+        except (OSError, ValueError):
+            # Missing, concurrently evicted or partially written record
+            self.misses += 1
+            return None
+        self.hits += 1
+        return record
+
+    def put(self, key, record):
+        """Stores record under key. The write is atomic so concurrent readers never see
+        a partial record."""
+        record_path = self._record_path(key)
+        record_dir = os.path.dirname(record_path)
+        try:
+            os.makedirs(record_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=record_dir, suffix='.tmp')
+            try:
+                data = json.dumps(record, separators=(',', ':'))
+                with os.fdopen(fd, 'w') as fp:
+                    fp.write(data)
+                os.replace(tmp_path, record_path)
+                # ASCII, the JSON being serialized with ensure_ascii
+                self.bytes_written += len(data)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+        except (OSError, TypeError, ValueError):
+            log.debug('Failed to cache header record %s', key, exc_info=True)
+
+    def prune(self):
+        """Evicts least recently used records until the cache fits within max_bytes
+
+        The size of the cache tracked in SIZE_FILE_NAME is increased by the bytes
+        written since the last call. The records are only scanned and evicted when the
+        tracked size goes past max_bytes or is unknown, the scan then resetting it to
+        the actual size. Nothing is done if no record was written.
+
+        Returns:
+            int: Number of records evicted.
+        """
+        if not self.bytes_written:
+            return 0
+        evicted = 0
+        try:
+            with open(os.path.join(self.cache_dir, SIZE_FILE_NAME), 'a+') as fp:
+                # Serializes the updates of the concurrent jobs sharing the cache
+                fcntl.flock(fp, fcntl.LOCK_EX)
+                fp.seek(0)
+                try:
+                    total_size = json.load(fp)['bytes'] + self.bytes_written
+                except (ValueError, KeyError, TypeError):
+                    total_size = None
+                if total_size is None or total_size > self.max_bytes:
+                    evicted, total_size = self._evict()
+                fp.seek(0)
+                fp.truncate()
+                json.dump({'bytes': total_size}, fp)
+        except OSError:
+            log.debug('Failed to prune header cache %s', self.cache_dir, exc_info=True)
+            return evicted
+        self.bytes_written = 0
+        return evicted
+
+    def _evict(self):
+        """Scans the records and evicts the least recently used ones until the cache fits
+        within max_bytes
+
+        Returns:
+            tuple: Number of records evicted and size in bytes of the cache.
+        """
+        entries = list()
+        total_size = 0
+        for sub_dir in os.scandir(self.cache_dir):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+
+        evicted = 0
+        if total_size > self.max_bytes:
+            entries.sort()
+            for _, size, path in entries:
+                if total_size <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total_size -= size
+                evicted += 1
+            log.info('Evicted %s records from header cache %s', evicted, self.cache_dir)
+        return evicted, total_size
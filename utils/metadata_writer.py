@@ -0,0 +1,79 @@
+"""Writing and logging of .metadata.json"""
+import json
+import logging
+import os
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+MAX_SUMMARY_LENGTH = 4096
+JSON_DUMP_KWARGS = {'separators': (', ', ': '), 'sort_keys': True, 'indent': 4}
+
+
+def summarize_metadata(metadata):
+    """Returns a bounded copy of metadata suitable for logging
+
+    File headers are replaced by their number of data elements, everything else is
+    kept as is.
+
+    Args:
+        metadata (dict): The .metadata.json dictionary.
+
+    Returns:
+        dict: The summary.
+    """
+    summary = dict()
+    for container, container_dict in metadata.items():
+        if not isinstance(container_dict, dict):
+            summary[container] = container_dict
+            continue
+        summary[container] = dict(container_dict)
+        if isinstance(container_dict.get('files'), list):
+            summary[container]['files'] = [summarize_file_dict(file_dict) for file_dict in container_dict['files']]
+    return summary
+
+
+def summarize_file_dict(file_dict):
+    if not isinstance(file_dict, dict) or not isinstance(file_dict.get('info'), dict):
+        return file_dict
+    file_summary = dict(file_dict)
+    file_summary['info'] = dict(file_dict['info'])
+    header = file_dict['info'].get('header')
+    if isinstance(header, dict):
+        file_summary['info']['header'] = {
+            key: f'<{len(value)} data elements>' if isinstance(value, dict) else value
+            for key, value in header.items()
+        }
+    return file_summary
+
+
+def log_metadata(metadata, title, logger=log):
+    """Logs metadata in full if logger is in debug, otherwise a bounded summary"""
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('%s: \n%s', title, json.dumps(metadata, **JSON_DUMP_KWARGS))
+    else:
+        summary_str = json.dumps(summarize_metadata(metadata), **JSON_DUMP_KWARGS)
+        if len(summary_str) > MAX_SUMMARY_LENGTH:
+            summary_str = summary_str[:MAX_SUMMARY_LENGTH] + '\n... (truncated, enable debug for the full metadata)'
+        logger.info('%s (summary): \n%s', title, summary_str)
+
+
+def write_metadata_json(metadata, metadata_json_path, title='.metadata.json', logger=log):
+    """Serializes metadata once, streaming it to metadata_json_path, and logs it
+
+    Args:
+        metadata (dict): The .metadata.json dictionary.
+        metadata_json_path (str): Path of the file to write.
+        title (str): Title of the log record.
+        logger (logging.Logger): Logger to log the metadata with.
+
+    Returns:
+        str: metadata_json_path
+    """
+    log_metadata(metadata, title, logger)
+    with metrics.stage('write_metadata') as counters:
+        with open(metadata_json_path, 'w') as metafile:
+            json.dump(metadata, metafile, **JSON_DUMP_KWARGS)
+        counters['bytes_written'] = os.path.getsize(metadata_json_path)
+    return metadata_json_path
@@ -0,0 +1,162 @@
+"""Per-stage timing and resource metrics
+
+Stages are recorded into the active MetricsRecorder, if any, so that instrumented
+code does not need to pass a recorder around:
+
+    recorder = MetricsRecorder()
+    with recording(recorder):
+        with stage('extract', bytes_read=size) as counters:
+            counters['members'] = extract(...)
+    recorder.write('metrics.json')
+
+Stages can nest (e.g. get_pydicom_header within read_dicom), their times are therefore
+not additive. Stages recorded several times are aggregated: calls, wall_time,
+cpu_time and counters are summed. cpu_time is the CPU time of the recording thread.
+"""
+import contextlib
+import functools
+import json
+import resource
+import sys
+import threading
+import time
+
+METRICS_VERSION = 1
+
+# Recorder stages are recorded into, see recording
+_active_recorder = None
+
+
+def get_peak_rss_bytes():
+    """Returns the peak resident set size of the process in bytes"""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class MetricsRecorder:
+    """Aggregates the wall time, CPU time, counters and peak RSS of stages"""
+
+    def __init__(self):
+        self.stages = dict()
+        self._lock = threading.Lock()
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+
+    @contextlib.contextmanager
+    def stage(self, name, **counters):
+        """Records the stage name around the with block
+
+        Yields:
+            dict: The counters of the stage (e.g. bytes_read, bytes_written, members),
+                initialized from counters and recorded on exit.
+        """
+        counters = dict(counters)
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield counters
+        finally:
+            self.record(
+                name, time.perf_counter() - wall_start, time.thread_time() - cpu_start, **counters
+            )
+
+    def record(self, name, wall_time=0.0, cpu_time=0.0, **counters):
+        """Adds a call of the stage name to its aggregate"""
+        peak_rss_bytes = get_peak_rss_bytes()
+        with self._lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0})
+            stage['calls'] += 1
+            stage['wall_time'] += wall_time
+            stage['cpu_time'] += cpu_time
+            for key, value in counters.items():
+                stage[key] = stage.get(key, 0) + value
+            stage['peak_rss_bytes'] = peak_rss_bytes
+
+    def to_dict(self):
+        """Returns the metrics as a JSON serializable dictionary"""
+        with self._lock:
+            stages = {name: dict(stage) for name, stage in self.stages.items()}
+        return {
+            'version': METRICS_VERSION,
+            'wall_time': time.perf_counter() - self._wall_start,
+            'cpu_time': time.process_time() - self._cpu_start,
+            'peak_rss_bytes': get_peak_rss_bytes(),
+            'stages': stages,
+        }
+
+    def summary(self):
+        """Returns a single line summary of the metrics, slowest stages first"""
+        metrics = self.to_dict()
+        stages = sorted(metrics['stages'].items(), key=lambda item: -item[1]['wall_time'])
+        stage_strs = [f'{name} {stage["wall_time"]:.3f}s/{stage["calls"]}' for name, stage in stages]
+        return (
+            f'{metrics["wall_time"]:.3f}s wall, {metrics["cpu_time"]:.3f}s CPU, '
+            f'peak RSS {metrics["peak_rss_bytes"] / 1024 ** 2:.0f} MB | ' + ', '.join(stage_strs)
+        )
+
+    def write(self, path):
+        """Writes the metrics to the JSON file path and returns path"""
+        with open(path, 'w') as fp:
+            json.dump(self.to_dict(), fp, indent=4, sort_keys=True)
+        return path
+
+
+@contextlib.contextmanager
+def recording(recorder):
+    """Makes recorder the active recorder, in every thread, around the with block"""
+    global _active_recorder
+    previous_recorder = _active_recorder
+    _active_recorder = recorder
+    try:
+        yield recorder
+    finally:
+        _active_recorder = previous_recorder
+
+
+def start_recording(recorder=None):
+    """Makes recorder, a new MetricsRecorder by default, the active recorder for the
+    rest of the process and returns it"""
+    global _active_recorder
+    _active_recorder = recorder or MetricsRecorder()
+    return _active_recorder
+
+
+def get_active_recorder():
+    return _active_recorder
+
+
+@contextlib.contextmanager
+def stage(name, **counters):
+    """Records the stage name into the active recorder, see MetricsRecorder.stage
+
+    Yields:
+        dict: The counters of the stage, ignored if no recorder is active.
+    """
+    recorder = _active_recorder
+    if recorder is None:
+        yield dict(counters)
+    else:
+        with recorder.stage(name, **counters) as stage_counters:
+            yield stage_counters
+
+
+def record(name, wall_time=0.0, cpu_time=0.0, **counters):
+    """Records a call of the stage name, timed by the caller, into the active recorder"""
+    recorder = _active_recorder
+    if recorder is not None:
+        recorder.record(name, wall_time, cpu_time, **counters)
+
+
+def timed(name):
+    """Decorator recording each call of the decorated function as the stage name"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
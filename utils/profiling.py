@@ -0,0 +1,154 @@
+"""Opt-in profiling of a job, see the profile and profile_memory config options
+
+Within the profiling context manager, the following files are written to the output
+directory, named after prefix (e.g. the input file name):
+    - <prefix>.pstats: cProfile statistics of the calling thread, to be loaded with
+      pstats or snakeviz
+    - <prefix>.profile.txt: the functions of highest cumulative time
+    - <prefix>.collapsed.txt: stacks of every thread, sampled at a regular interval,
+      in the collapsed format of flamegraph.pl and speedscope
+    - <prefix>.tracemalloc.txt (memory only): the top allocators and the peak of
+      traced memory
+"""
+import collections
+import contextlib
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SAMPLING_INTERVAL = 0.005
+DEFAULT_TOP_COUNT = 50
+TRACEMALLOC_FRAME_COUNT = 10
+
+
+class StackSampler:
+    """Samples the stacks of every other thread of the process in a background thread
+
+    Args:
+        interval (float): Seconds between two samples.
+    """
+
+    def __init__(self, interval=DEFAULT_SAMPLING_INTERVAL):
+        self.interval = interval
+        self.counts = collections.Counter()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def format_frame(frame):
+        code = frame.f_code
+        return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+    def sample(self):
+        """Adds the current stack of every other thread to counts"""
+        own_ident = threading.get_ident()
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = list()
+            while frame is not None:
+                stack.append(self.format_frame(frame))
+                frame = frame.f_back
+            stack.append(thread_names.get(ident, str(ident)))
+            self.counts[';'.join(reversed(stack))] += 1
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def write(self, path):
+        """Writes the sampled stacks in the collapsed format and returns path"""
+        with open(path, 'w') as fp:
+            for stack, count in sorted(self.counts.items()):
+                fp.write(f'{stack} {count}\n')
+        return path
+
+
+def write_pstats_summary(profiler, path, top_count=DEFAULT_TOP_COUNT):
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats('cumulative').print_stats(top_count)
+    with open(path, 'w') as fp:
+        fp.write(stream.getvalue())
+    return path
+
+
+def write_tracemalloc_summary(snapshot, path, top_count=DEFAULT_TOP_COUNT):
+    """Writes the top allocators of snapshot, by traceback, and the traced memory peak"""
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    ))
+    current, peak = tracemalloc.get_traced_memory()
+    with open(path, 'w') as fp:
+        fp.write(f'Traced memory: current {current / 1024 ** 2:.1f} MB, peak {peak / 1024 ** 2:.1f} MB\n')
+        for index, stat in enumerate(snapshot.statistics('traceback')[:top_count]):
+            fp.write(f'\n#{index + 1}: {stat.size / 1024:.1f} KiB in {stat.count} blocks\n')
+            for line in stat.traceback.format():
+                fp.write(line + '\n')
+    return path
+
+
+@contextlib.contextmanager
+def profiling(output_dir, prefix, cpu=True, memory=False, interval=DEFAULT_SAMPLING_INTERVAL,
+              top_count=DEFAULT_TOP_COUNT):
+    """Profiles the with block and writes the profiles to output_dir
+
+    Args:
+        output_dir (str): Directory the profiles are written to.
+        prefix (str): Prefix of the profile file names.
+        cpu (bool): Profile with cProfile and sample the stacks.
+        memory (bool): Trace the memory allocations with tracemalloc.
+        interval (float): Seconds between two stack samples.
+        top_count (int): Number of entries of the text summaries.
+
+    Yields:
+        list: The paths of the profile files, filled in on exit.
+    """
+    paths = list()
+    profiler = sampler = None
+    if memory:
+        tracemalloc.start(TRACEMALLOC_FRAME_COUNT)
+    if cpu:
+        sampler = StackSampler(interval).start()
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield paths
+    finally:
+        if cpu:
+            profiler.disable()
+            sampler.stop()
+            pstats_path = os.path.join(output_dir, prefix + '.pstats')
+            profiler.dump_stats(pstats_path)
+            paths.append(pstats_path)
+            paths.append(write_pstats_summary(
+                profiler, os.path.join(output_dir, prefix + '.profile.txt'), top_count
+            ))
+            paths.append(sampler.write(os.path.join(output_dir, prefix + '.collapsed.txt')))
+        if memory:
+            snapshot = tracemalloc.take_snapshot()
+            paths.append(write_tracemalloc_summary(
+                snapshot, os.path.join(output_dir, prefix + '.tracemalloc.txt'), top_count
+            ))
+            tracemalloc.stop()
+        if paths:
+            log.info('Profiles written to %s', ', '.join(paths))
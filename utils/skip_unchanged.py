@@ -0,0 +1,92 @@
+"""Skip-if-unchanged: jobs on an archive already processed with the same template,
+config and gear version exit early, without parsing it
+
+Each run stores, in the info of the file, the fingerprint of the archive (see
+utils.hashing.get_fingerprint) along with the hashes of the template and config, the
+gear version and the output version, together the run info. A later job compares them to its own before
+doing anything else: the hashes and version first, the fingerprint, which needs the
+archive members to be read (but not extracted nor parsed), only if they match.
+"""
+import hashlib
+import json
+import logging
+import os
+
+from .dicom.archive_reader import get_archive_format, iter_member_streams
+from .hashing import get_file_digest, get_fingerprint, get_stream_digest
+
+log = logging.getLogger(__name__)
+
+# Key of the run info in the file info
+RUN_INFO_KEY = 'grp3_run'
+# Bump whenever a change alters the metadata or validation errors written for the same
+# archive, template and config, so that earlier runs are not taken as unchanged even if
+# the gear version is not bumped
+OUTPUT_VERSION = '1'
+# Config options that do not change the metadata, left out of the config hash
+OUTPUT_INDEPENDENT_CONFIG_KEYS = (
+    'debug',
+    'profile',
+    'profile_memory',
+    'write_metrics',
+    'header_cache_dir',
+    'header_cache_max_size_mb',
+    'time_budget_seconds',
+    'skip_unchanged',
+)
+
+
+def get_json_hash(value):
+    """Returns the sha256 hex digest of the canonical JSON serialization of value"""
+    return hashlib.sha256(json.dumps(value, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def get_run_key(template, gear_config, gear_version, header_namespace=''):
+    """Returns the part of the run info that is known before the archive is read
+
+    Args:
+        template (dict): JSON schema template.
+        gear_config (dict): Config options of the gear, see manifest.json.
+        gear_version (str): Version of the gear.
+        header_namespace (str): Header extraction version and options, see
+            run.get_header_namespace.
+    """
+    gear_config = {
+        key: value for key, value in (gear_config or {}).items() if key not in OUTPUT_INDEPENDENT_CONFIG_KEYS
+    }
+    return {
+        'gear_version': gear_version,
+        'output_version': f'{OUTPUT_VERSION}:{header_namespace}',
+        'template_hash': get_json_hash(template or {}),
+        'config_hash': get_json_hash(gear_config),
+    }
+
+
+def get_archive_fingerprint(file_path):
+    """Returns the fingerprint of the DICOM archive or file at file_path, as stored in
+    info.checksums by extract_metadata, streaming the members without extracting them"""
+    if get_archive_format(file_path) is None:
+        return get_fingerprint({os.path.basename(file_path): get_file_digest(file_path)})
+    return get_fingerprint({name: get_stream_digest(stream) for name, _, _, stream in iter_member_streams(file_path)})
+
+
+def is_unchanged(file_dict, file_path, run_key):
+    """Returns True if the file at file_path was last processed with run_key
+
+    Args:
+        file_dict (dict): The Flywheel file record, see
+            utils.update_file_info.get_dest_cont_file_dict.
+        file_path (str): Path of the DICOM archive or file.
+        run_key (dict): The run key of the job, see get_run_key.
+    """
+    run_info = ((file_dict or {}).get('info') or {}).get(RUN_INFO_KEY)
+    if not isinstance(run_info, dict):
+        return False
+    changed_keys = [key for key, value in run_key.items() if run_info.get(key) != value]
+    if changed_keys:
+        log.info('%s changed since the last run of %s', ', '.join(changed_keys), os.path.basename(file_path))
+        return False
+    if run_info.get('fingerprint') != get_archive_fingerprint(file_path):
+        log.info('Content of %s changed since its last run', os.path.basename(file_path))
+        return False
+    return True
@@ -1,34 +1,110 @@
+import concurrent.futures
 import copy
 import json
 import logging
 import os
+import threading
 
-import backoff
-import flywheel
+from . import metrics
+from .metadata_writer import write_metadata_json
 
 WHITELIST_KEYS = ('classification', 'info', 'modality', 'type', 'name')
 
 log = logging.getLogger(__name__)
-log.setLevel('INFO')
+
+# flywheel and backoff are slow to import, they are imported by the functions using them
+# so that jobs failing early or never reaching the API do not pay for them
+
+# Shared by the lookups of a run, see get_gear_context and get_memoized_dest_file_dict
+_gear_context = None
+_file_dict_cache = dict()
+_lookup_lock = threading.Lock()
+# dest_file_dict_request with retries, see _get_retrying_request
+_retrying_request = None
 
 
 def false_if_exc_is_timeout(exception):
-    if exception.status in [504]:
+    import flywheel
+
+    if isinstance(exception, flywheel.rest.ApiException) and exception.status in [504]:
         return False
     return True
 
 
-@backoff.on_exception(backoff.expo, flywheel.rest.ApiException,
-                      max_time=300, giveup=false_if_exc_is_timeout)
+def _get_retrying_request():
+    """Returns _request_file_dict retried with exponential backoff, decorated on first
+    use. Only flywheel.rest.ApiException timeouts are retried, see
+    false_if_exc_is_timeout."""
+    global _retrying_request
+    if _retrying_request is None:
+        import backoff
+
+        _retrying_request = backoff.on_exception(
+            backoff.expo, Exception, max_time=300, giveup=false_if_exc_is_timeout
+        )(_request_file_dict)
+    return _retrying_request
+
+
 def dest_file_dict_request(fw_client, acq_id, file_name):
+    """
+    Fetches the file record of file_name from its parent container, without fetching
+    the parent container itself, retrying timeouts for up to 300 s
+    :param fw_client: the flywheel client
+    :param acq_id: id of the parent container
+    :param file_name: name of the file
+    :return: a dictionary representing the file object, empty if the file does not exist
+    """
+    return _get_retrying_request()(fw_client, acq_id, file_name)
+
+
+def _request_file_dict(fw_client, acq_id, file_name):
+    """Same as dest_file_dict_request, without retries"""
+    import flywheel
+
     file_dict = dict()
-    cont_obj = fw_client.get(acq_id)
-    file_obj = cont_obj.get_file(file_name)
+    try:
+        file_obj = fw_client.get_container_file_info(acq_id, file_name)
+    except flywheel.rest.ApiException as exc:
+        if exc.status == 404:
+            return file_dict
+        raise
     if file_obj:
         file_dict = file_obj.to_dict()
     return file_dict
 
 
+def get_gear_context():
+    """
+    Returns the GearContext of the run. It is created once so that its client, and
+    with it the HTTP connection pool, is reused by every API call of the run.
+    :rtype: flywheel.GearContext
+    """
+    import flywheel
+
+    global _gear_context
+    with _lookup_lock:
+        if _gear_context is None:
+            _gear_context = flywheel.GearContext()
+        return _gear_context
+
+
+def get_memoized_dest_file_dict(fw_client, parent_id, file_name):
+    """
+    Same as dest_file_dict_request but memoized per (parent_id, file_name) within a run
+    :return: a dictionary representing the file object
+    """
+    key = (parent_id, file_name)
+    with _lookup_lock:
+        if key in _file_dict_cache:
+            log.debug('Using memoized file record of %s in %s', file_name, parent_id)
+            return _file_dict_cache[key]
+    with metrics.stage('flywheel_file_lookup'):
+        file_dict = dest_file_dict_request(fw_client, parent_id, file_name)
+    with _lookup_lock:
+        _file_dict_cache[key] = file_dict
+    return file_dict
+
+
 def get_dest_cont_file_dict(input_key):
     """
     Gets the current file info for the file, if the input parent
@@ -36,39 +112,58 @@ def get_dest_cont_file_dict(input_key):
     :type input_key: str
     :return: a dictionary representing the file object
     """
-    with flywheel.GearContext() as gear_context:
-        file_name = gear_context.get_input(input_key).get('location', {}).get('name')
-        parent_id = gear_context.get_input(input_key).get('hierarchy', {}).get('id')
-        parent_type = gear_context.get_input(input_key).get('hierarchy', {}).get('type')
-        if parent_id == 'aex':
-            parent_id = '5e6937e3529e160bd3812da1'
-        if not file_name:
-            file_dict = dict()
-        else:
-            fw_client = gear_context.client
-            file_dict = dest_file_dict_request(fw_client, parent_id, file_name)
-        return file_dict, parent_type
+    gear_context = get_gear_context()
+    file_name = gear_context.get_input(input_key).get('location', {}).get('name')
+    parent_id = gear_context.get_input(input_key).get('hierarchy', {}).get('id')
+    parent_type = gear_context.get_input(input_key).get('hierarchy', {}).get('type')
+    if parent_id == 'aex':
+        parent_id = '5e6937e3529e160bd3812da1'
+    if not file_name:
+        file_dict = dict()
+    else:
+        fw_client = gear_context.client
+        file_dict = get_memoized_dest_file_dict(fw_client, parent_id, file_name)
+    return file_dict, parent_type
+
+
+def prefetch_dest_cont_file_dict(input_key):
+    """
+    Starts get_dest_cont_file_dict in the background so that the Flywheel API calls
+    overlap with the local DICOM processing
+    :param input_key: the key for the input in the manifest
+    :type input_key: str
+    :return: a future of the (file_dict, parent_type) tuple returned by get_dest_cont_file_dict
+    :rtype: concurrent.futures.Future
+    """
+    future = concurrent.futures.Future()
+
+    def _lookup():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(get_dest_cont_file_dict(input_key))
+        except BaseException as exc:
+            future.set_exception(exc)
+
+    # daemon so that an early exit of the gear does not wait on the API
+    threading.Thread(target=_lookup, name=f'{input_key}-file-lookup', daemon=True).start()
+    return future
 
 
 def get_file_update_dict(fw_file_dict):
     """
     Removes info.header from input_dict.info and any non-info keys that aren't in
-    WHITELIST_KEYS or evaluate to False
+    WHITELIST_KEYS or evaluate to False. Nothing is copied, the returned dict shares
+    its values with fw_file_dict which is left untouched.
     :param fw_file_dict: a dictionary representing a flywheel file
     :return:
     """
-    fw_file_dict = copy.deepcopy(fw_file_dict)
-    remove_keys = list()
-    for key, value in fw_file_dict.items():
-        if key not in WHITELIST_KEYS:
-            remove_keys.append(key)
-    for key in remove_keys:
-        fw_file_dict.pop(key)
+    fw_file_dict = {key: value for key, value in fw_file_dict.items() if key in WHITELIST_KEYS}
 
     # Remove header info
     if isinstance(fw_file_dict.get('info'), dict):
         if 'header' in fw_file_dict['info'].keys():
-            fw_file_dict['info'].pop('header')
+            fw_file_dict['info'] = {key: value for key, value in fw_file_dict['info'].items() if key != 'header'}
 
     return fw_file_dict
 
@@ -77,7 +172,8 @@ def get_meta_file_dict_and_index(metadata_dict, file_name, parent_type):
     """
     Returns a tuple of the parent_type.files list index for the file named file_name
     if a dictionary for file_name exists within parent_type.files. The index is set to None if
-    the file does not yet exist in the parent metadata.
+    the file does not yet exist in the parent metadata. The file dictionary is the one
+    within metadata_dict, it must not be modified in place.
     """
 
     file_index = None
@@ -87,7 +183,7 @@ def get_meta_file_dict_and_index(metadata_dict, file_name, parent_type):
             for index, file_item in enumerate(metadata_dict[parent_type]['files']):
                 if isinstance(file_item, dict):
                     if file_item.get('name') == file_name:
-                        file_dict = copy.deepcopy(file_item)
+                        file_dict = file_item
                         file_index = index
     return file_index, file_dict
 
@@ -95,18 +191,21 @@ def get_meta_file_dict_and_index(metadata_dict, file_name, parent_type):
 def update_meta_file_dict(meta_file_dict, fw_file_dict):
     """
     updates meta_file_dict with fw_file_dict for keys that fw_file_dict doesn't have
+    Neither input is modified, only the values taken from fw_file_dict are copied, the
+    rest of the returned dict is shared with meta_file_dict.
     :param meta_file_dict: dictionary representation of the gear-generated file dict in .metadata.json
     :param fw_file_dict: dictionary representation of the flywheel file object
     :return: meta_file_dict with updated fw_file_dict
     """
-    fw_file_dict = copy.deepcopy(fw_file_dict)
-    meta_file_dict = copy.deepcopy(meta_file_dict)
     fw_file_dict = get_file_update_dict(fw_file_dict)
+    meta_file_dict = dict(meta_file_dict)
     meta_file_dict['info'] = meta_file_dict.get('info', {})
+    if isinstance(meta_file_dict['info'], dict):
+        meta_file_dict['info'] = dict(meta_file_dict['info'])
 
     for key in WHITELIST_KEYS:
         if not meta_file_dict.get(key) and fw_file_dict.get(key):
-            meta_file_dict[key] = fw_file_dict[key]
+            meta_file_dict[key] = copy.deepcopy(fw_file_dict[key])
     for key, value in fw_file_dict['info'].items():
         if not meta_file_dict['info'].get(key):
             meta_file_dict['info'][key] = copy.deepcopy(value)
@@ -121,11 +220,11 @@ def replace_metadata_file_dict(metadata_dict, index, meta_file_dict, parent_type
     :param index: index at which to replace the file dictionary within the parent's file list
     :param meta_file_dict: the dictionary to place within the parent's file list
     :param parent_type: the container type of the file's parent (i.e. session, acquisition)
-    :return:
+    :return: a copy of metadata_dict, only the parent container and its file list are copied
     """
-    metadata_dict = copy.deepcopy(metadata_dict)
-    metadata_dict[parent_type] = metadata_dict.get(parent_type, {})
-    metadata_dict[parent_type]['files'] = metadata_dict[parent_type].get('files', list())
+    metadata_dict = dict(metadata_dict)
+    metadata_dict[parent_type] = dict(metadata_dict.get(parent_type, {}))
+    metadata_dict[parent_type]['files'] = list(metadata_dict[parent_type].get('files', list()))
     if index is None or len(metadata_dict[parent_type]['files']) <= index:
         metadata_dict[parent_type]['files'].append(meta_file_dict)
     else:
@@ -169,18 +268,22 @@ def update_metadata_json(fw_file_dict, metadata_json_path, parent_type):
         updated_metadata_dict = update_file_metadata(fw_file_dict, metadata_dict, parent_type)
 
         if updated_metadata_dict:
-            print_string = json.dumps(updated_metadata_dict, separators=(', ', ': '), sort_keys=True, indent=4)
-            log.info('Updated .metadata.json: \n%s', print_string)
-            with open(metadata_json_path, 'w') as metafile:
-                json.dump(updated_metadata_dict, metafile, separators=(', ', ': '), sort_keys=True, indent=4)
+            write_metadata_json(updated_metadata_dict, metadata_json_path, 'Updated .metadata.json', log)
 
 
-def get_file_dict_and_update_metadata_json(input_key, metadata_json_path):
+def get_file_dict_and_update_metadata_json(input_key, metadata_json_path, file_dict_future=None):
     """
     updates file metadata in the metadata_json_path with that from flywheel
     :param input_key: the key under which the file is represented in manifest.json
     :param metadata_json_path: the path the the metadata.json file to be uploaded to flywheel
+    :param file_dict_future: future returned by prefetch_dest_cont_file_dict, if None the file is looked up now
     :return:
     """
-    file_dict, parent_type = get_dest_cont_file_dict(input_key)
+    if file_dict_future is None:
+        file_dict, parent_type = get_dest_cont_file_dict(input_key)
+    else:
+        if not file_dict_future.done():
+            log.info('Waiting for the %s file lookup to complete...', input_key)
+        with metrics.stage('flywheel_file_lookup_wait'):
+            file_dict, parent_type = file_dict_future.result()
     update_metadata_json(file_dict, metadata_json_path, parent_type)
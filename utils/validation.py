@@ -1,26 +1,40 @@
 """Validation module"""
 from collections import Counter
-import itertools
 import logging
 import os
 import json
+import time
 
 
-import jsonschema
 import numpy as np
-import pandas as pd
+# pandas and jsonschema are slow to import, they are imported by the functions using them
+
+from . import metrics
+from .deadline import Deadline
+from .errors import InvalidTemplateError
+from .hashing import DuplicateFinder
 
 log = logging.getLogger(__name__)
 
 
 DEFAULT_RULE_LIST = [
     'check_instance_number_uniqueness',
+    'check_duplicate_files',
     'check_missing_slices',
     'check_0_byte_files',
-    'check_pydicom_exception'
+    'check_pydicom_exception',
+    'check_pixel_data'
 ]
 
 MIN_NUM_SLICES_TO_CHECK_MISSING_SLICES = 10
+# Header values check_missing_slices keeps of each slice
+SLICE_RECORD_KEYS = ['SliceLocation', 'ImageType', 'ImageOrientationPatient', 'ImagePositionPatient']
+
+# Validators compiled by get_template_validator, by serialized template
+_template_validators = dict()
+
+# File rules by name, see register_rule
+RULE_REGISTRY = dict()
 
 
 def dump_validation_error_file(error_filepath, validation_errors):
@@ -28,11 +42,6 @@ def dump_validation_error_file(error_filepath, validation_errors):
         json.dump(validation_errors, outfile, separators=(', ', ': '), sort_keys=True, indent=4)
 
 
-def get_rule_function(func_name):
-    """Return function in current module by name"""
-    return globals()[func_name]
-
-
 def get_most_frequent(array, rounding=None):
     """Get the most frequent element in array that is at least found len(array)/2 of times.
 
@@ -75,166 +84,412 @@ def check_file_is_not_empty(file_path):
     return validation_errors
 
 
-def check_missing_slices(dcm_dict_list):
-    """Check for missing slices based on some geometric heuristic
+def register_rule(name):
+    """Class decorator registering a RuleAccumulator as the file rule name
+
+    Args:
+        name (str): Name of the rule, e.g. in the disabled_rules config option.
+    """
+
+    def decorator(cls):
+        cls.name = name
+        RULE_REGISTRY[name] = cls
+        return cls
+
+    return decorator
 
-    Check is performed for each individual sequence (SequenceName) in the dicom header
+
+def get_enabled_rules(disabled_rules=None):
+    """Returns the names of the rules of DEFAULT_RULE_LIST not in disabled_rules
 
     Args:
-        dcm_dict_list (list): List of dict containing dicom data with keys: 'path', 'size', 'header'.
+        disabled_rules (str or list): Names of the rules to skip, a comma separated
+            string or a list.
 
-    Returns:
-        list: List of errors.
+    Raises:
+        ValueError: If a disabled rule is not registered.
     """
+    if isinstance(disabled_rules, str):
+        disabled_rules = [rule.strip() for rule in disabled_rules.split(',') if rule.strip()]
+    disabled_rules = disabled_rules or []
+    unknown_rules = [rule for rule in disabled_rules if rule not in RULE_REGISTRY]
+    if unknown_rules:
+        raise ValueError(f'Unknown rules {unknown_rules}, rules are {sorted(RULE_REGISTRY)}')
+    return [rule for rule in DEFAULT_RULE_LIST if rule not in disabled_rules]
 
-    def _check_missing_slices(ddl, seq_mes):
-        error_list = []
-        locations = []
-        data = []
-        for el in ddl:
-            data.append({
-                'path': el['path'],
-                'SliceLocation': el['header'].get('SliceLocation'),
-                'ImageType': el['header'].get('ImageType'),
-                'ImageOrientationPatient': el['header'].get('ImageOrientationPatient'),
-                'ImagePositionPatient': el['header'].get('ImagePositionPatient'),
-            })
-        df = pd.DataFrame(data)
-
-        # Attempt to find locations via SliceLocation header
-        if all(elem in df.columns for elem in ['SliceLocation', 'ImageType']) and \
-                len(df.dropna(subset=['SliceLocation', 'ImageType'])) > 1:
-            df.dropna(subset=['SliceLocation', 'ImageType'], inplace=True)
-            # This line iterates through all SliceLocations in rows where LOCALIZER not in ImageType
-            for location in (df.loc[~df['ImageType'].str.join('').str.contains('LOCALIZER')])['SliceLocation']:
-                locations.append(location)
-
-        # Attempt to find locations by ImageOrientationPatient and ImagePositionPatient headers
-        elif all(elem in df.columns for elem in ['ImageOrientationPatient', 'ImagePositionPatient', 'ImageType']) and \
-            len(df.dropna(subset=['ImageOrientationPatient', 'ImagePositionPatient', 'ImageType'])) > 1:
-            df.dropna(subset=['ImageOrientationPatient', 'ImageType', 'ImagePositionPatient'], inplace=True)
-            # DICOM headers annoyingly hold arrays as strings with puncuation
-            # This function is needed to turn that string into a real data structure
-            def string_to_array(input_str, expected_length):
-                s = input_str.replace('[', '')
-                s = s.replace(']', '')
-                s = s.replace(',', '')
-                s = s.replace('(', '')
-                s = s.replace(')', '')
-                array = s.split()
-                return_arr = [float(x) for x in array]
-                # If new array is not expected length, something's gone wrong
-                if len(return_arr) == expected_length:
-                    return return_arr
-                else:
-                    return False
-
-            # Find normal vector of patient's orientation
-            # This line below finds the first ImageOrientationPatient where LOCALIZER not in ImageType
-            arr = (df.loc[~df['ImageType'].str.join('').str.contains('LOCALIZER')])['ImageOrientationPatient'].values[0]
-            if arr:
-                v1 = [arr[0], arr[1], arr[2]]
-                v2 = [arr[3], arr[4], arr[5]]
-                normal = np.cross(v2, v1)
-
-                # Slice locations are the position vectors times the normal vector from above
-                # This line iterates through all ImagePositionPatient in rows where LOCALIZER not in ImageType
-                for pos in (df.loc[~df['ImageType'].str.join('').str.contains('LOCALIZER')])['ImagePositionPatient']:
-                    if pos:
-                        location = np.dot(normal, pos)
-                        locations.append(location)
-                    else:
-                        locations = []
-                        log.warning("'ImagePositionPatients' string format error, cannot check for missing slices!")
-                        break
 
+class RuleAccumulator:
+    """Base of the file rules, fed the data dict of each file one at a time then finalized
+
+    Rules keep only what they need of the data dicts (e.g. the instance numbers), not
+    the headers, so that the data dicts can be dropped once added. Rules are
+    independent from each other and are registered with register_rule.
+    """
+
+    name = None
+
+    def add(self, dcm_dict):
+        """Adds the data dict (keys: 'path', 'size', 'force', 'pydicom_exception', 'header') of a file"""
+        raise NotImplementedError
+
+    def finalize(self):
+        """Returns the list of errors of the files added"""
+        raise NotImplementedError
+
+
+def run_rule(accumulator, dcm_dict_list):
+    for dcm_dict in dcm_dict_list:
+        accumulator.add(dcm_dict)
+    return accumulator.finalize()
+
+
+def _check_missing_slices(slice_records, seq_mes):
+    """Returns the missing slice errors of the slice records of a sequence"""
+    import pandas as pd
+
+    error_list = []
+    locations = []
+    df = pd.DataFrame(slice_records, columns=SLICE_RECORD_KEYS)
+
+    # Attempt to find locations via SliceLocation header
+    if all(elem in df.columns for elem in ['SliceLocation', 'ImageType']) and \
+            len(df.dropna(subset=['SliceLocation', 'ImageType'])) > 1:
+        df.dropna(subset=['SliceLocation', 'ImageType'], inplace=True)
+        # This line iterates through all SliceLocations in rows where LOCALIZER not in ImageType
+        for location in (df.loc[~df['ImageType'].str.join('').str.contains('LOCALIZER')])['SliceLocation']:
+            locations.append(location)
+
+    # Attempt to find locations by ImageOrientationPatient and ImagePositionPatient headers
+    elif all(elem in df.columns for elem in ['ImageOrientationPatient', 'ImagePositionPatient', 'ImageType']) and \
+        len(df.dropna(subset=['ImageOrientationPatient', 'ImagePositionPatient', 'ImageType'])) > 1:
+        df.dropna(subset=['ImageOrientationPatient', 'ImageType', 'ImagePositionPatient'], inplace=True)
+        # DICOM headers annoyingly hold arrays as strings with puncuation
+        # This function is needed to turn that string into a real data structure
+        def string_to_array(input_str, expected_length):
+            s = input_str.replace('[', '')
+            s = s.replace(']', '')
+            s = s.replace(',', '')
+            s = s.replace('(', '')
+            s = s.replace(')', '')
+            array = s.split()
+            return_arr = [float(x) for x in array]
+            # If new array is not expected length, something's gone wrong
+            if len(return_arr) == expected_length:
+                return return_arr
             else:
-                log.warning("'ImageOrientationPatient' string format error, cannot check for missing slices!")
+                return False
+
+        # Find normal vector of patient's orientation
+        # This line below finds the first ImageOrientationPatient where LOCALIZER not in ImageType
+        arr = (df.loc[~df['ImageType'].str.join('').str.contains('LOCALIZER')])['ImageOrientationPatient'].values[0]
+        if arr:
+            v1 = [arr[0], arr[1], arr[2]]
+            v2 = [arr[3], arr[4], arr[5]]
+            normal = np.cross(v2, v1)
+
+            # Slice locations are the position vectors times the normal vector from above
+            # This line iterates through all ImagePositionPatient in rows where LOCALIZER not in ImageType
+            for pos in (df.loc[~df['ImageType'].str.join('').str.contains('LOCALIZER')])['ImagePositionPatient']:
+                if pos:
+                    location = np.dot(normal, pos)
+                    locations.append(location)
+                else:
+                    locations = []
+                    log.warning("'ImagePositionPatients' string format error, cannot check for missing slices!")
+                    break
 
-        # Unable to find locations
         else:
-            log.warning(
-                "'SliceLocation' or 'ImageOrientationPatient' and 'ImagePositionPatient' missing, "
-                "cannot check for missing slices!")
-
-        # If locations is not empty (i.e. if nothing's gone wrong), sort it to get accurate intervals
-        # Also if there's only one location found, we don't need to check intervals
-        if len(locations) > 1:
-            locations.sort()
-
-            # Now we use the locations to measure intervals
-            intervals = []
-            for i, loc in enumerate(locations[1:]):
-                intervals.append(locations[i + 1] - locations[i])
-
-            # We want to ignore (i.e. remove) all intervals near 0 because they most likely come from duplicate images
-            intervals = [elem for elem in intervals if elem > 0.001]
-
-            # Get the most frequent interval in intervals
-            # If most_frequent_interval returns None, end function early
-            mode = get_most_frequent(intervals)
-            if not mode:
+            log.warning("'ImageOrientationPatient' string format error, cannot check for missing slices!")
+
+    # Unable to find locations
+    else:
+        log.warning(
+            "'SliceLocation' or 'ImageOrientationPatient' and 'ImagePositionPatient' missing, "
+            "cannot check for missing slices!")
+
+    # If locations is not empty (i.e. if nothing's gone wrong), sort it to get accurate intervals
+    # Also if there's only one location found, we don't need to check intervals
+    if len(locations) > 1:
+        locations.sort()
+
+        # Now we use the locations to measure intervals
+        intervals = []
+        for i, loc in enumerate(locations[1:]):
+            intervals.append(locations[i + 1] - locations[i])
+
+        # We want to ignore (i.e. remove) all intervals near 0 because they most likely come from duplicate images
+        intervals = [elem for elem in intervals if elem > 0.001]
+
+        # Get the most frequent interval in intervals
+        # If most_frequent_interval returns None, end function early
+        mode = get_most_frequent(intervals)
+        if not mode:
+            error_dict = {
+                "error_message": "Inconsistent slice intervals; no common interval found!",
+                "revalidate": False
+            }
+            error_list.append(error_dict)
+            return error_list
+
+        tolerance = 0.2 * mode
+        abnormal_intervals = []
+
+        for i, val in enumerate(intervals):
+            if abs(mode - val) > tolerance:
+                rounded_val = round(val, 3)
+                if rounded_val not in abnormal_intervals:
+                    abnormal_intervals.append(rounded_val)
+
+        if len(abnormal_intervals) > 0:
+            abnormal_intervals_str = str(abnormal_intervals).strip('[]')
+            error_dict = {
+                "error_message": "Inconsistent slice intervals. Majority are ~{}mm but intervals include {}.{}"
+                                 .format(mode, abnormal_intervals_str, seq_mes),
+                "revalidate": False
+            }
+            error_list.append(error_dict)
+
+    return error_list
+
+
+def is_localizer(image_type):
+    """Returns True if the ImageType value contains LOCALIZER"""
+    if isinstance(image_type, (list, tuple)):
+        image_type = ''.join(str(value) for value in image_type)
+    return isinstance(image_type, str) and 'LOCALIZER' in image_type
+
+
+@register_rule('check_missing_slices')
+class MissingSlices(RuleAccumulator):
+    """Check for missing slices based on some geometric heuristic
+
+    Check is performed for each individual sequence (SequenceName) in the dicom header,
+    i.e. on each run of consecutive files of the same SequenceName. Only the slice
+    records (see SLICE_RECORD_KEYS) of the current sequence are kept. Localizer-only
+    sequences are skipped, localizer slices are never checked.
+    """
+
+    def __init__(self):
+        self.error_list = []
+        self.sequence_names = []
+        self._sequence_name = None
+        self._slice_records = None
+
+    def add(self, dcm_dict):
+        header = dcm_dict.get('header')
+        if not header:
+            return
+        sequence_name = header.get('SequenceName')
+        if self._slice_records is None or sequence_name != self._sequence_name:
+            self._check_sequence()
+            self._sequence_name = sequence_name
+            self._slice_records = []
+            self.sequence_names.append(sequence_name)
+        self._slice_records.append(tuple(header.get(key) for key in SLICE_RECORD_KEYS))
+
+    def _check_sequence(self):
+        if self._slice_records is None:
+            return
+        seq, slice_records = self._sequence_name, self._slice_records
+        self._slice_records = None
+        if len(slice_records) < MIN_NUM_SLICES_TO_CHECK_MISSING_SLICES:
+            log.warning('Small number of images in sequence. '
+                        'Slice interval checking will not be performed for SequenceName=%s', seq)
+            return
+
+        image_type_index = SLICE_RECORD_KEYS.index('ImageType')
+        if all(is_localizer(slice_record[image_type_index]) for slice_record in slice_records):
+            log.info('Only localizer images in sequence, skipping slice interval checking for SequenceName=%s',
+                     seq)
+            return
+
+        log.info('Checking missing slices for SequenceName=%s', seq)
+
+        # sequence_message is added to slice error message if we are dealing with multiple sequences
+        sequence_message = ' (SequenceName is {}, in case there are multiple.)'.format(seq)
+
+        self.error_list += _check_missing_slices(slice_records, sequence_message)
+
+    def finalize(self):
+        self._check_sequence()
+        if len(self.sequence_names) > 1:
+            log.warning('Multiple image sequences found in acquisition (%s), checked each individually',
+                        self.sequence_names)
+        return self.error_list
+
+
+@register_rule('check_instance_number_uniqueness')
+class InstanceNumberUniqueness(RuleAccumulator):
+    """Check if InstanceNumber is unique (not duplicated)"""
+
+    def __init__(self):
+        self.instance_numbers = []
+
+    def add(self, dcm_dict):
+        if dcm_dict.get('header'):
+            self.instance_numbers.append(dcm_dict['header'].get('InstanceNumber'))
+
+    def finalize(self):
+        # Integers, the usual case, are checked without pandas
+        if all(type(number) is int for number in self.instance_numbers) and \
+                len(set(self.instance_numbers)) == len(self.instance_numbers):
+            return []
+
+        import pandas as pd
+
+        df = pd.DataFrame([{'InstanceNumber': number} for number in self.instance_numbers])
+        error_list = []
+        if 'InstanceNumber' in df:
+            if df['InstanceNumber'].is_unique:
+                pass
+            else:
+                duplicated_values = df.loc[df['InstanceNumber'].duplicated(), 'InstanceNumber'].values
                 error_dict = {
-                    "error_message": "Inconsistent slice intervals; no common interval found!",
+                    "error_message": "InstanceNumber is duplicated for values:{}".format(duplicated_values),
                     "revalidate": False
                 }
                 error_list.append(error_dict)
-                return error_list
+        return error_list
+
+
+@register_rule('check_duplicate_files')
+class DuplicateFiles(RuleAccumulator):
+    """Check if files are duplicated: same SOPInstanceUID or identical content
+
+    Only files of identical zip CRC and size (data dict keys 'crc' and 'size') have
+    their content compared, by digest (data dict key 'sha256' if set), so that the other
+    files are not read again. Files without CRC, e.g. tar members, are compared on their
+    size alone.
+    """
+
+    def __init__(self):
+        self.sop_instance_uids = set()
+        self.duplicated_uids = []
+        self.duplicate_finder = DuplicateFinder()
+        self.duplicated_files = []
+
+    def add(self, dcm_dict):
+        header = dcm_dict.get('header')
+        uid = header.get('SOPInstanceUID') if header else None
+        if uid:
+            if uid in self.sop_instance_uids:
+                if uid not in self.duplicated_uids:
+                    self.duplicated_uids.append(uid)
+            else:
+                self.sop_instance_uids.add(uid)
+        if dcm_dict['size'] > 0:
+            original_path = self.duplicate_finder.find(
+                dcm_dict['path'], (dcm_dict.get('crc'), dcm_dict['size']), dcm_dict.get('sha256')
+            )
+            if original_path:
+                self.duplicated_files.append(
+                    '{} (same as {})'.format(os.path.basename(dcm_dict['path']), os.path.basename(original_path))
+                )
+
+    def finalize(self):
+        error_list = []
+        if self.duplicated_uids:
+            error_list.append({
+                "error_message": "SOPInstanceUID is duplicated for values:{}".format(self.duplicated_uids),
+                "revalidate": False
+            })
+        if self.duplicated_files:
+            error_list.append({
+                "error_message": "Files have identical content:{}".format(self.duplicated_files),
+                "revalidate": False
+            })
+        return error_list
+
+
+@register_rule('check_0_byte_files')
+class ZeroByteFiles(RuleAccumulator):
+    """Check if dcm file is 0-byte size"""
+
+    def __init__(self):
+        self.error_list = []
+
+    def add(self, dcm_dict):
+        if dcm_dict['size'] == 0:
+            error_dict = {
+                "error_message": "Dicom file is empty: {}".format(os.path.basename(dcm_dict['path'])),
+                "revalidate": False
+            }
+            self.error_list.append(error_dict)
 
-            tolerance = 0.2 * mode
-            abnormal_intervals = []
+    def finalize(self):
+        return self.error_list
 
-            for i, val in enumerate(intervals):
-                if abs(mode - val) > tolerance:
-                    rounded_val = round(val, 3)
-                    if rounded_val not in abnormal_intervals:
-                        abnormal_intervals.append(rounded_val)
 
-            if len(abnormal_intervals) > 0:
-                abnormal_intervals_str = str(abnormal_intervals).strip('[]')
+@register_rule('check_pydicom_exception')
+class PydicomException(RuleAccumulator):
+    """Check if pydicom raised exception"""
+
+    def __init__(self):
+        self.error_list = []
+
+    def add(self, dcm_dict):
+        if dcm_dict['pydicom_exception']:
+            if dcm_dict['force']:
                 error_dict = {
-                    "error_message": "Inconsistent slice intervals. Majority are ~{}mm but intervals include {}.{}"
-                                     .format(mode, abnormal_intervals_str, seq_mes),
+                    "error_message": "Pydicom raised an exception with force=True for file: {}".format(
+                        os.path.basename(dcm_dict['path'])),
                     "revalidate": False
                 }
-                error_list.append(error_dict)
+            else:
+                error_dict = {
+                    "error_message": "Dicom signature not found in: {}. Try running gear with force=True".format(
+                        os.path.basename(dcm_dict['path'])),
+                    "revalidate": False
+                }
+            self.error_list.append(error_dict)
 
-        return error_list
+    def finalize(self):
+        return self.error_list
 
-    def _is_enough_slice_to_check_missing_slice(dcm_dict_list):
-        """Returns True if enough number of slices in sequence to check missing slices, False otherwise"""
-        if len(dcm_dict_list) < MIN_NUM_SLICES_TO_CHECK_MISSING_SLICES:
-            return False
-        return True
 
-    # Groups dcm_dict_list by SequenceName
-    dcm_dict_list = [el for el in dcm_dict_list if el.get('header')]
-    dcm_dict_list_grouped = itertools.groupby(dcm_dict_list, key=lambda x: x['header'].get('SequenceName'))
-    sequences_group = [(el[0], list(el[1])) for el in dcm_dict_list_grouped]
-    sequences = list(zip(sequences_group))[0]
+@register_rule('check_pixel_data')
+class PixelData(RuleAccumulator):
+    """Check if the pixel data is truncated or inconsistent with the pixel description,
+    as found when reading the file (data dict key 'pixel_data_error')"""
 
-    # If there's only one sequence, we don't bother logging
-    if len(sequences_group) > 1:
-        log.warning('Multiple image sequences found in acquisition (%s), will check each individually', sequences)
+    def __init__(self):
+        self.error_list = []
 
-    # For every frame in new_frame, add any missing slice errors to error_list
-    error_list = []
-    for seq, dcm_dict_list_sub in sequences_group:
+    def add(self, dcm_dict):
+        if dcm_dict.get('pixel_data_error'):
+            error_dict = {
+                "error_message": "PixelData is inconsistent in file: {} ({})".format(
+                    os.path.basename(dcm_dict['path']), dcm_dict['pixel_data_error']),
+                "revalidate": False
+            }
+            self.error_list.append(error_dict)
 
-        dcm_dict_list_sub_l = list(dcm_dict_list_sub)
-        if not _is_enough_slice_to_check_missing_slice(dcm_dict_list_sub_l):
-            log.warning('Small number of images in sequence. '
-                        'Slice interval checking will not be performed for SequenceName=%s'.format(seq))
-            continue
+    def finalize(self):
+        return self.error_list
 
-        log.info('Checking missing slices for SequenceName=%s', seq)
 
-        # sequence_message is added to slice error message if we are dealing with multiple sequences
-        sequence_message = ' (SequenceName is {}, in case there are multiple.)'.format(seq)
+def check_missing_slices(dcm_dict_list):
+    """Check for missing slices based on some geometric heuristic, see MissingSlices
 
-        error_list += _check_missing_slices(dcm_dict_list_sub_l, sequence_message)
+    Args:
+        dcm_dict_list (list): List of dict containing dicom data with keys: 'path', 'size', 'header'.
 
-    return error_list
+    Returns:
+        list: List of errors.
+    """
+    return run_rule(MissingSlices(), dcm_dict_list)
+
+
+def check_duplicate_files(dcm_dict_list):
+    """Check if files are duplicated, see DuplicateFiles
+
+    Args:
+        dcm_dict_list (list): List of dict containing dicom data with keys: 'path', 'size', 'header', 'crc'.
+
+    Returns:
+        list: List of errors.
+    """
+    return run_rule(DuplicateFiles(), dcm_dict_list)
 
 
 def check_instance_number_uniqueness(dcm_dict_list):
@@ -246,23 +501,7 @@ def check_instance_number_uniqueness(dcm_dict_list):
     Returns:
         list: List of errors.
     """
-    data = []
-    for el in dcm_dict_list:
-        if el.get('header'):
-            data.append({'path': el['path'], 'InstanceNumber': el['header'].get('InstanceNumber')})
-    df = pd.DataFrame(data)
-    error_list = []
-    if 'InstanceNumber' in df:
-        if df['InstanceNumber'].is_unique:
-            pass
-        else:
-            duplicated_values = df.loc[df['InstanceNumber'].duplicated(), 'InstanceNumber'].values
-            error_dict = {
-                "error_message": "InstanceNumber is duplicated for values:{}".format(duplicated_values),
-                "revalidate": False
-            }
-            error_list.append(error_dict)
-    return error_list
+    return run_rule(InstanceNumberUniqueness(), dcm_dict_list)
 
 
 def check_0_byte_files(dcm_dict_list):
@@ -274,15 +513,7 @@ def check_0_byte_files(dcm_dict_list):
     Returns:
         list: List of errors.
     """
-    error_list = []
-    for el in dcm_dict_list:
-        if el['size'] == 0:
-            error_dict = {
-                "error_message": "Dicom file is empty: {}".format(os.path.basename(el['path'])),
-                "revalidate": False
-            }
-            error_list.append(error_dict)
-    return error_list
+    return run_rule(ZeroByteFiles(), dcm_dict_list)
 
 
 def check_pydicom_exception(dcm_dict_list):
@@ -294,21 +525,81 @@ def check_pydicom_exception(dcm_dict_list):
     Returns:
         list: List of errors.
     """
-    error_list = []
-    for el in dcm_dict_list:
-        if el['pydicom_exception']:
-            if el['force']:
-                error_dict = {
-                    "error_message": "Pydicom raised an exception with force=True for file: {}".format(os.path.basename(el['path'])),
-                    "revalidate": False
-                }
-            else:
-                error_dict = {
-                    "error_message": "Dicom signature not found in: {}. Try running gear with force=True".format(os.path.basename(el['path'])),
-                    "revalidate": False
-                }
-            error_list.append(error_dict)
-    return error_list
+    return run_rule(PydicomException(), dcm_dict_list)
+
+
+class RuleValidator:
+    """Validates files against rules one data dict at a time, so that the data dicts of
+    all the files are not needed at once
+
+    Rules are finalized in order. The wall time, CPU time and number of errors of each
+    rule are logged, recorded as the stage rule.<name> and kept in report.
+
+    Args:
+        rules (list): Names of the registered rules, DEFAULT_RULE_LIST by default.
+        deadline (Deadline): Time budget of the job, unlimited by default. Once spent,
+            the rules fed since are skipped, as they would see part of the files only,
+            and the rules left are not finalized.
+    """
+
+    def __init__(self, rules=None, deadline=None):
+        if rules is None:
+            rules = DEFAULT_RULE_LIST
+        self.accumulators = {rule: RULE_REGISTRY[rule]() for rule in rules}
+        self.deadline = deadline or Deadline()
+        # Wall and CPU time of the add calls of each rule
+        self.times = {rule: [0.0, 0.0] for rule in self.accumulators}
+        self.file_count = 0
+        # Wall time, CPU time and number of errors of each rule, set on finalize
+        self.report = dict()
+
+    def add(self, dcm_dict):
+        """Adds the data dict of a file to every rule"""
+        if self.deadline.expired():
+            for rule in self.accumulators:
+                self.deadline.skip(rule)
+            self.accumulators = dict()
+        self.file_count += 1
+        for rule, accumulator in self.accumulators.items():
+            wall_start = time.perf_counter()
+            cpu_start = time.thread_time()
+            accumulator.add(dcm_dict)
+            self.times[rule][0] += time.perf_counter() - wall_start
+            self.times[rule][1] += time.thread_time() - cpu_start
+
+    def _finalize_rule(self, rule):
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        error_list = self.accumulators[rule].finalize()
+        self.report[rule] = {
+            'wall_time': self.times[rule][0] + time.perf_counter() - wall_start,
+            'cpu_time': self.times[rule][1] + time.thread_time() - cpu_start,
+            'errors': len(error_list),
+        }
+        metrics.record(f'rule.{rule}', files=self.file_count, **self.report[rule])
+        log.info('Rule %s: %s errors in %.3f s', rule, len(error_list), self.report[rule]['wall_time'])
+        return error_list
+
+    def finalize(self):
+        """Returns the list of errors found by the rules, in the order of the rules"""
+        error_list = []
+        for rule in self.accumulators:
+            if self.deadline.allows(rule):
+                error_list += self._finalize_rule(rule)
+        return error_list
+
+
+def check_pixel_data(dcm_dict_list):
+    """Check if the pixel data is truncated or inconsistent, see PixelData
+
+    Args:
+        dcm_dict_list (list): List of dict containing dicom data with keys: 'path', 'size', 'header',
+            'pixel_data_error'.
+
+    Returns:
+        list: List of errors.
+    """
+    return run_rule(PixelData(), dcm_dict_list)
 
 
 def validate_against_rules(dcm_dict_list, rules=None):
@@ -316,19 +607,15 @@ def validate_against_rules(dcm_dict_list, rules=None):
 
     Args:
         dcm_dict_list (list): List of dict containing dicom data with keys: 'path', 'size', 'header'.
-        rules (list): List of function name to validate `dcm_dict_list` against.
+        rules (list): List of rule names to validate `dcm_dict_list` against.
 
     Returns:
         list: List of errors found.
     """
-    if not rules:
-        rules = DEFAULT_RULE_LIST
-
-    error_list = []
-    for rule in rules:
-        error_list += get_rule_function(rule)(dcm_dict_list)
-
-    return error_list
+    validator = RuleValidator(rules or None)
+    for dcm_dict in dcm_dict_list:
+        validator.add(dcm_dict)
+    return validator.finalize()
 
 
 def get_validation_error_dict(validation_error, file_dict_key='info.header.dicom'):
@@ -367,6 +654,30 @@ def get_validation_error_dict(validation_error, file_dict_key='info.header.dicom
     return error_dict
 
 
+def get_template_validator(template):
+    """Returns the Draft7Validator of template, checking and compiling it only once per
+    process for a given template
+
+    Args:
+        template (dict): A JSON schema template.
+
+    Returns:
+        jsonschema.Draft7Validator: The validator.
+
+    Raises:
+        jsonschema.exceptions.SchemaError: If template is not a valid schema.
+    """
+    import jsonschema
+
+    key = json.dumps(template, sort_keys=True)
+    validator = _template_validators.get(key)
+    if validator is None:
+        jsonschema.Draft7Validator.check_schema(template)
+        validator = jsonschema.Draft7Validator(template)
+        _template_validators[key] = validator
+    return validator
+
+
 def validate_against_template(input_dict, template):
     """This is a function for validating a dictionary against a template.
 
@@ -381,23 +692,23 @@ def validate_against_template(input_dict, template):
 
     Returns:
         list: List of validation_errors.
+
+    Raises:
+        InvalidTemplateError: If template is not a valid JSON schema.
     """
     try:
-        jsonschema.Draft7Validator.check_schema(template)
+        validator = get_template_validator(template)
     except Exception as e:
-        log.fatal(
-            'The json_template is invalid. Please make the correction and try again.'
-        )
-        log.exception(e)
-        os.sys.exit(1)
-
-    # Initialize json schema validator
-    validator = jsonschema.Draft7Validator(template)
+        raise InvalidTemplateError(
+            f'The json_template is invalid ({e}). Please make the correction and try again.'
+        ) from e
+
     # Initialize list object for storing validation errors
     validation_errors = []
-    for error in sorted(validator.iter_errors(input_dict), key=str):
-        error_dict = get_validation_error_dict(error)
-        # Append individual error object to the return validation_errors object
-        validation_errors.append(error_dict)
+    with metrics.stage('validate_template'):
+        for error in sorted(validator.iter_errors(input_dict), key=str):
+            error_dict = get_validation_error_dict(error)
+            # Append individual error object to the return validation_errors object
+            validation_errors.append(error_dict)
 
     return validation_errors
\ No newline at end of file